@@ -1,15 +1,41 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from flask import Flask, render_template, request, redirect, url_for, flash, session, abort, jsonify, make_response, g
+from flask import before_render_template, template_rendered
+from flask_login import LoginManager, login_user, login_required, logout_user, current_user
+from sqlalchemy import and_, func, insert, literal, or_, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload, selectinload
 import os
-import json
+import base64
+import hmac
+import re
 from datetime import datetime, timedelta
 import uuid  
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+import time
+import threading
+from functools import wraps
+from urllib.parse import urlencode
 from dotenv import load_dotenv
+import migrations
+from spotify_cache import SpotifyCache
+from spotify_sync import SyncWorker
+from spotify_client import SpotifyClientFactory, OAUTH_TOKEN_URL
+from page_cache import PageCache, create_backend
+from user_cache import UserCache, UserSnapshot
+from ranking import RankingEngine
+from recommendations import Recommender, taste_features
+from image_pipeline import ImagePipeline
+from media_store import MediaStore, is_stored_name
+from uploads import StreamingRequest, UploadStream
+from db_engine import (
+    engine_options, install_sqlite_pragmas, SQLITE_PRAGMAS, REPLICA, dialect_insert,
+    copy_sqlite_database
+)
+from write_queue import WriteQueue
+from instrumentation import Metrics
+from models import (
+    db, followers, follow_graph, load_follow_pairs, User, Post, Like, Comment, Song, SpotifyTopTrack, SpotifyPlaylist, TimelineEntry, MediaRef,
+    FavoriteSong, UserGenre, ChangeCounter
+)
 
 #Hämtar variabler från .env filen
 load_dotenv()
@@ -18,20 +44,122 @@ load_dotenv()
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
 SPOTIFY_REDIRECT_URI = 'http://localhost:5000/spotify/callback'
+# Kan pekas om till en lokal fejkserver när man testar
+SPOTIFY_API_URL = os.getenv('SPOTIFY_API_URL', 'https://api.spotify.com/v1/')
+SPOTIFY_TOKEN_URL = os.getenv('SPOTIFY_TOKEN_URL', OAUTH_TOKEN_URL)
 
-# Startar flask-appen
+# Startar flask-appen. Uppladdningar skrivs till disk medan requesten läses, se uploads.py
 app = Flask(__name__)
+app.request_class = StreamingRequest
 app.config['SECRET_KEY'] = '1234567812312'  # Slängde in lite random siffror som blir vår client-secret
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///users.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pool och SQLite-pragmas (WAL m.m.), se db_engine.py. DB_TUNING=0 stänger av pragmas.
+app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 10))
+app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', 20))
+app.config['SQLITE_PRAGMAS'] = SQLITE_PRAGMAS if os.getenv('DB_TUNING', '1') == '1' else {}
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'],
+    pool_size=app.config['DB_POOL_SIZE'],
+    max_overflow=app.config['DB_MAX_OVERFLOW']
+)
+# Valfri läsreplika. Sidor som bara läser (se reads_from_replica) hämtar sin data därifrån,
+# utom en stund efter att besökaren själv har skrivit något, så att man ser sina egna ändringar.
+app.config['DATABASE_REPLICA_URL'] = os.getenv('DATABASE_REPLICA_URL')
+app.config['DB_REPLICA_STICKY_SECONDS'] = float(os.getenv('DB_REPLICA_STICKY_SECONDS', 10))
+if app.config['DATABASE_REPLICA_URL']:
+    app.config['SQLALCHEMY_BINDS'] = {REPLICA: {
+        'url': app.config['DATABASE_REPLICA_URL'],
+        **engine_options(
+            app.config['DATABASE_REPLICA_URL'],
+            pool_size=app.config['DB_POOL_SIZE'],
+            max_overflow=app.config['DB_MAX_OVERFLOW']
+        )
+    }}
+# Likes, kommentarer och follows committas i grupper av en skrivtråd, se write_queue.py
+app.config['DB_WRITE_QUEUE'] = os.getenv('DB_WRITE_QUEUE', '0') == '1'
+app.config['DB_WRITE_BATCH'] = int(os.getenv('DB_WRITE_BATCH', 64))
+app.config['DB_WRITE_WAIT_MS'] = float(os.getenv('DB_WRITE_WAIT_MS', 2))
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max-limit
+# Konton med fler följare än så här fan-out:as inte vid create_post, deras posts hämtas istället när feeden läses
+app.config['TIMELINE_FANOUT_LIMIT'] = int(os.getenv('TIMELINE_FANOUT_LIMIT', 1000))
+# Sidstorlekar för keyset-pagineringen
+app.config['FEED_PAGE_SIZE'] = 10
+app.config['PROFILE_PAGE_SIZE'] = 10
+app.config['COMMENTS_PAGE_SIZE'] = 20
+app.config['USERS_PAGE_SIZE'] = 24
+# Hur länge Spotify-data är färsk, hur länge gammal data får visas medan den uppdateras, och max antal användare i cachen
+app.config['SPOTIFY_CACHE_TTL'] = int(os.getenv('SPOTIFY_CACHE_TTL', 300))
+app.config['SPOTIFY_CACHE_MAX_STALE'] = int(os.getenv('SPOTIFY_CACHE_MAX_STALE', 3600))
+app.config['SPOTIFY_CACHE_SIZE'] = int(os.getenv('SPOTIFY_CACHE_SIZE', 1000))
+# Bakgrundssynken av Spotify-data, se spotify_sync.py. Intervallet är i sekunder.
+app.config['SPOTIFY_SYNC_ENABLED'] = os.getenv('SPOTIFY_SYNC_ENABLED', '1') == '1'
+app.config['SPOTIFY_SYNC_INTERVAL'] = int(os.getenv('SPOTIFY_SYNC_INTERVAL', 900))
+app.config['SPOTIFY_SYNC_WORKERS'] = int(os.getenv('SPOTIFY_SYNC_WORKERS', 2))
+# Hur ofta schemaläggaren letar efter användare som behöver synkas, även nyss kopplade
+app.config['SPOTIFY_SYNC_SCAN_INTERVAL'] = int(os.getenv('SPOTIFY_SYNC_SCAN_INTERVAL', 60))
+# Storleken på den delade HTTP-poolen mot Spotify
+app.config['SPOTIFY_POOL_SIZE'] = int(os.getenv('SPOTIFY_POOL_SIZE', 10))
+# Tokens som går ut inom så här många sekunder refresh:as i bakgrunden, och hur ofta vi letar efter dem
+app.config['SPOTIFY_TOKEN_REFRESH_MARGIN'] = int(os.getenv('SPOTIFY_TOKEN_REFRESH_MARGIN', 300))
+app.config['SPOTIFY_TOKEN_REFRESH_INTERVAL'] = int(os.getenv('SPOTIFY_TOKEN_REFRESH_INTERVAL', 60))
+# Den inloggade användaren cachas per process, se user_cache.py. TTL i sekunder.
+app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 30))
+app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 1000))
+# Hur ofta varje process läser om följargrafen från databasen (se follow_graph.py), 0 = aldrig, och hur
+# ofta den kollar om en annan process har ändrat followers. Båda i sekunder.
+app.config['FOLLOW_GRAPH_REFRESH'] = int(os.getenv('FOLLOW_GRAPH_REFRESH', 300))
+app.config['FOLLOW_GRAPH_CHECK'] = float(os.getenv('FOLLOW_GRAPH_CHECK', 1))
+# Den rankade feeden (?sort=top), se ranking.py. Poängen halveras på FEED_RANKING_HALF_LIFE timmar,
+# posts äldre än FEED_RANKING_HORIZON dagar rankas inte, och poängen läses om var FEED_RANKING_REFRESH sekund.
+app.config['FEED_RANKING_HALF_LIFE'] = float(os.getenv('FEED_RANKING_HALF_LIFE', 12))
+app.config['FEED_RANKING_HORIZON'] = int(os.getenv('FEED_RANKING_HORIZON', 7))
+app.config['FEED_RANKING_PER_AUTHOR'] = int(os.getenv('FEED_RANKING_PER_AUTHOR', 200))
+app.config['FEED_RANKING_REFRESH'] = int(os.getenv('FEED_RANKING_REFRESH', 300))
+# Förslag på konton att följa på /users, se recommendations.py. Hur många lika användare som sparas
+# per konto, hur många förslag som visas och hur ofta allt byggs om från början i sekunder (0 = aldrig).
+app.config['RECOMMENDATIONS_TOP_N'] = int(os.getenv('RECOMMENDATIONS_TOP_N', 50))
+app.config['RECOMMENDATIONS_SHOWN'] = int(os.getenv('RECOMMENDATIONS_SHOWN', 6))
+app.config['RECOMMENDATIONS_REFRESH'] = int(os.getenv('RECOMMENDATIONS_REFRESH', 3600))
+# Hur ofta varje process letar efter profiler som har ändrats i andra processer, i sekunder (0 = aldrig)
+app.config['RECOMMENDATIONS_CHECK'] = int(os.getenv('RECOMMENDATIONS_CHECK', 10))
+# Hur många av ett kontos senaste posts som läggs in i tidslinjen när man börjar följa det
+app.config['TIMELINE_BACKFILL'] = 200
+# Sidcache för utloggade besökare: 'memory' per process eller 'disk' som delas mellan processer.
+# Generationen i PAGE_CACHE_DIR delas alltid, så invalidate() tömmer cachen i alla processer på maskinen.
+# PAGE_CACHE_SIZE är taket för antalet sidor och PAGE_CACHE_TTL hur länge en sida gäller i sekunder.
+app.config['PAGE_CACHE_BACKEND'] = os.getenv('PAGE_CACHE_BACKEND', 'memory')
+app.config['PAGE_CACHE_DIR'] = os.getenv('PAGE_CACHE_DIR', os.path.join(app.instance_path, 'page_cache'))
+app.config['PAGE_CACHE_SIZE'] = int(os.getenv('PAGE_CACHE_SIZE', 256))
+app.config['PAGE_CACHE_TTL'] = int(os.getenv('PAGE_CACHE_TTL', 300))
+# Bildbearbetningen i bakgrunden, se image_pipeline.py
+app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', 2))
+app.config['IMAGE_QUALITY'] = int(os.getenv('IMAGE_QUALITY', 80))
+# Hur gammal en fil utan referenser måste vara innan gc-media tar bort den, i sekunder
+app.config['MEDIA_GC_GRACE'] = int(os.getenv('MEDIA_GC_GRACE', 3600))
+# Där uppladdningar hamnar medan de tas emot. Bör ligga på samma filsystem som static/.
+app.config['UPLOAD_TMP_DIR'] = os.getenv('UPLOAD_TMP_DIR', os.path.join(app.instance_path, 'uploads'))
+# Mätning per request och /metrics, se instrumentation.py. Avstängt om inte METRICS_ENABLED=1.
+# Med METRICS_TOKEN satt kräver /metrics "Authorization: Bearer <token>", utan den svarar /metrics
+# bara på anrop från den egna maskinen (127.0.0.1 och ::1). Står appen bakom en proxy på samma
+# maskin ska METRICS_TOKEN alltså sättas. SLOW_REQUEST_MS > 0 loggar requests som tar längre tid än så.
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', '0') == '1'
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+app.config['SLOW_REQUEST_MS'] = float(os.getenv('SLOW_REQUEST_MS', 0))
 
 # File upload konfiguration
 UPLOAD_FOLDER = 'static'
 PROFILE_PICS_FOLDER = os.path.join(UPLOAD_FOLDER, 'profile_pics')
 SONG_PICS_FOLDER = os.path.join(UPLOAD_FOLDER, 'song_pics')
 POST_PICS_FOLDER = os.path.join(UPLOAD_FOLDER, 'post_pics')
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'jfif', 'gif', 'webp'}
+# Bredderna som varje uppladdad bild skalas ner till. Profilbilder visas som 24-40px
+# i feeden och större på profilsidan, postbilder upp till ungefär 700px.
+IMAGE_SIZES = {
+    'profile_pics': (64, 128, 256, 512),
+    'post_pics': (480, 960, 1440),
+    'song_pics': (160, 320, 640),
+}
 
 # Spotify OAuth konfig
 SPOTIFY_SCOPES = [
@@ -42,160 +170,723 @@ SPOTIFY_SCOPES = [
     'playlist-read-private'  # User's playlists
 ]
 
-# Vi kollar att uppladdnings konfigen finns
-os.makedirs(PROFILE_PICS_FOLDER, exist_ok=True)
-os.makedirs(SONG_PICS_FOLDER, exist_ok=True)
-os.makedirs(POST_PICS_FOLDER, exist_ok=True)
+# Tid, SQL, mallar och Spotify-anrop per request. Skapas före allt annat så att hela requesten mäts.
+request_metrics = Metrics(slow_threshold=app.config['SLOW_REQUEST_MS'] / 1000 or None)
+if app.config['METRICS_ENABLED']:
+    request_metrics.install_sql()
+    before_render_template.connect(request_metrics.render_started, app)
+    template_rendered.connect(request_metrics.render_finished, app)
+
+# Registreras först, så att before_request körs före och after_request efter alla andra
+@app.before_request
+def start_request_metrics():
+    if app.config['METRICS_ENABLED']:
+        request_metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    if app.config['METRICS_ENABLED']:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_metrics.finish_request(route, request.method, response.status_code)
+    return response
+
+# Alla Spotify-klienter delar på samma HTTP-pool, se spotify_client.py
+spotify_clients = SpotifyClientFactory(
+    client_id=SPOTIFY_CLIENT_ID,
+    client_secret=SPOTIFY_CLIENT_SECRET,
+    redirect_uri=SPOTIFY_REDIRECT_URI,
+    scopes=SPOTIFY_SCOPES,
+    api_url=SPOTIFY_API_URL,
+    token_url=SPOTIFY_TOKEN_URL,
+    pool_size=app.config['SPOTIFY_POOL_SIZE'],
+    trace=request_metrics.record_spotify if app.config['METRICS_ENABLED'] else None
+)
+
+# Cachen för topplåtar och spellistor, se spotify_cache.py
+spotify_cache = SpotifyCache(
+    ttl=app.config['SPOTIFY_CACHE_TTL'],
+    max_stale=app.config['SPOTIFY_CACHE_MAX_STALE'],
+    max_users=app.config['SPOTIFY_CACHE_SIZE']
+)
+
+# Snapshots av inloggade användare, se user_cache.py
+user_cache = UserCache(ttl=app.config['USER_CACHE_TTL'], max_users=app.config['USER_CACHE_SIZE'])
+
+# Engagemangspoängen för den rankade feeden, se ranking.py. Läses in av create_app() och sedan om i bakgrunden.
+def load_ranking_rows():
+    since = datetime.utcnow() - timedelta(days=app.config['FEED_RANKING_HORIZON'])
+    return db.session.execute(
+        select(Post.postId, Post.userId, Post.created_at, Post.like_count, Post.comment_count)
+        .where(Post.created_at >= since)
+    ).all()
+
+ranking = RankingEngine(
+    load_ranking_rows,
+    half_life=app.config['FEED_RANKING_HALF_LIFE'] * 3600,
+    per_author=app.config['FEED_RANKING_PER_AUTHOR']
+)
+
+# Musiksmaken för användarna i user_ids, eller alla om None, som dimensioner för recommendations.py
+def load_taste_profiles(user_ids=None):
+    profiles = db.session.query(User.userId, User.sotd_artist)
+    genre_rows = db.session.query(UserGenre.userId, UserGenre.genre)
+    song_rows = db.session.query(FavoriteSong.userId, FavoriteSong.artist)
+    top_rows = db.session.query(SpotifyTopTrack.userId, SpotifyTopTrack.artist)
+    if user_ids is not None:
+        profiles = profiles.filter(User.userId.in_(user_ids))
+        genre_rows = genre_rows.filter(UserGenre.userId.in_(user_ids))
+        song_rows = song_rows.filter(FavoriteSong.userId.in_(user_ids))
+        top_rows = top_rows.filter(SpotifyTopTrack.userId.in_(user_ids))
+    genres, artists = {}, {}
+    for user_id, genre in genre_rows:
+        genres.setdefault(user_id, []).append(genre)
+    for user_id, artist in song_rows.union_all(top_rows):
+        artists.setdefault(user_id, []).append(artist)
+    return [
+        (user_id, taste_features(genres.get(user_id, ()), [sotd_artist] + artists.get(user_id, []),
+                                 follow_graph.following_ids(user_id)))
+        for user_id, sotd_artist in profiles
+    ]
+
+# Användare vars musiksmak har ändrats efter since, som (userId, taste_changed_at)
+def load_taste_changes(since):
+    return db.session.query(User.userId, User.taste_changed_at).filter(User.taste_changed_at > since).all()
+
+# Lika användare per konto. Byggs i bakgrunden första gången någon ber om förslag, sedan räknas bara ändrade profiler om.
+recommender = Recommender(load_taste_profiles, load_taste_changes, top_n=app.config['RECOMMENDATIONS_TOP_N'])
+
+# Färdigrenderade sidor för utloggade besökare, se page_cache.py
+page_cache = PageCache(
+    create_backend(
+        app.config['PAGE_CACHE_BACKEND'],
+        directory=app.config['PAGE_CACHE_DIR'],
+        max_entries=app.config['PAGE_CACHE_SIZE']
+    ),
+    generation_file=os.path.join(app.config['PAGE_CACHE_DIR'], 'generation'),
+    ttl=app.config['PAGE_CACHE_TTL']
+)
+# De enda parametrarna som de cachade sidorna läser. Annat i query-strängen ingår inte i nyckeln,
+# så /?x=1, /?x=2 osv. blir samma sida.
+PAGE_CACHE_ARGS = ('cursor', 'genre', 'q', 'sort')
+
+# Uppladdade filer sparas under hashen av innehållet, se media_store.py
+media_store = MediaStore(UPLOAD_FOLDER, IMAGE_SIZES)
+
+# Skalar ner uppladdade bilder i bakgrunden. Utloggade sidor i cachen byggs om när
+# varianterna är klara så att de får srcset.
+image_pipeline = ImagePipeline(
+    UPLOAD_FOLDER,
+    IMAGE_SIZES,
+    workers=app.config['IMAGE_WORKERS'],
+    quality=app.config['IMAGE_QUALITY'],
+    on_processed=page_cache.invalidate
+)
 
 # Funktion som kollar om filen är i korrekt format
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# startar SQLAlchemy
-db = SQLAlchemy(app)
+# startar SQLAlchemy, modellerna finns i models.py
+install_sqlite_pragmas(app.config['SQLITE_PRAGMAS'])
+db.init_app(app)
 
 # startar Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
- # Här under så definierar vi databasen
+# Ändrar en posts räknare direkt i databasen (like_count = like_count + 1), i samma transaktion som anroparen.
+def bump_post_counter(post_id, column, amount):
+    Post.query.filter_by(postId=post_id).update(
+        {column: column + amount}, synchronize_session=False
+    )
+
+# Kör en grupp jobb från skrivkön i en transaktion. Går något fel körs de om ett och ett.
+def execute_write_batch(jobs):
+    with app.app_context():
+        try:
+            results = [job() for job in jobs]
+            db.session.commit()
+            return [(result, None) for result in results]
+        except Exception as e:
+            db.session.rollback()
+            if len(jobs) == 1:
+                return [(None, e)]
+
+        outcomes = []
+        for job in jobs:
+            try:
+                result = job()
+                db.session.commit()
+                outcomes.append((result, None))
+            except Exception as e:
+                db.session.rollback()
+                outcomes.append((None, e))
+        return outcomes
 
-# Först ut så är tabellen för followers, med ID för den som följer och blir följd.
-followers = db.Table('followers',
-    db.Column('follower_id', db.String(36), db.ForeignKey('users.userId'), primary_key=True),
-    db.Column('followed_id', db.String(36), db.ForeignKey('users.userId'), primary_key=True)
+write_queue = WriteQueue(
+    execute_write_batch,
+    max_batch=app.config['DB_WRITE_BATCH'],
+    max_wait=app.config['DB_WRITE_WAIT_MS'] / 1000
 )
 
-# Allt som sparas i databasen för en User
-class User(UserMixin, db.Model):
-    __tablename__ = 'users'
-    userId = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    username = db.Column(db.String(80), nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
-    password = db.Column(db.String(128))
-    profilePicture = db.Column(db.String, nullable=True, default='default.jpg')
-    favoriteGenres = db.Column(db.String, nullable=True)
-    createdAt = db.Column(db.DateTime, default=datetime.utcnow)
-    spotify_access_token = db.Column(db.String(255), nullable=True)
-    spotify_refresh_token = db.Column(db.String(255), nullable=True)
-    spotify_user_id = db.Column(db.String(255), nullable=True)
-    spotify_token_expiry = db.Column(db.DateTime, nullable=True)
-    bio = db.Column(db.Text, nullable=True)
-    sotd_title = db.Column(db.String(200), nullable=True)
-    sotd_artist = db.Column(db.String(200), nullable=True)
-    song_picture = db.Column(db.String(200), nullable=True)
-    favorite_songs = db.Column(db.String, nullable=True)
-
-    # Followers relationen med mer explicit metod
-    followed = db.relationship(
-        'User', 
-        secondary=followers,
-        primaryjoin=(followers.c.follower_id == userId),
-        secondaryjoin=(followers.c.followed_id == userId),
-        backref=db.backref('followers', lazy='dynamic'),
-        lazy='dynamic'
+# INSERT med ON CONFLICT för den primära databasens dialekt (SQLite eller PostgreSQL)
+def upsert(table):
+    return dialect_insert(db.engine.dialect.name)(table)
+
+# Kör en liten skrivning och returnerar jobbets värde. Med DB_WRITE_QUEUE går den via
+# skrivkön och committas tillsammans med andra requests, annars direkt här.
+# Jobbet körs kanske i en annan tråd, så det får bara använda id:n och inte objekt från requesten.
+# Dess SQL räknas ändå till requesten i /metrics, men inte den gemensamma commiten.
+def run_write(job):
+    g.db_wrote = True
+    if app.config['DB_WRITE_QUEUE']:
+        return write_queue.submit(request_metrics.bind(job)).result()
+    result = job()
+    db.session.commit()
+    return result
+
+# Bygger om like_count och comment_count för alla posts från likes- och comments-tabellerna.
+def reconcile_post_counters():
+    like_total = (
+        db.select(func.count(Like.likeId))
+        .where(Like.postId == Post.postId)
+        .scalar_subquery()
     )
+    comment_total = (
+        db.select(func.count(Comment.commentId))
+        .where(Comment.postId == Post.postId)
+        .scalar_subquery()
+    )
+    updated = Post.query.update(
+        {Post.like_count: like_total, Post.comment_count: comment_total},
+        synchronize_session=False
+    )
+    db.session.commit()
+    return updated
 
-    # Lägg till following som en property för kompatibilitet
-    @property
-    def following(self):
-        return self.followed
-
-    # Hämtar id:et för en användare
-    def get_id(self):
-        return self.userId
-
-    def __init__(self, username, email, password=None, **kwargs):
-        # ETT UUID genereras om inte det finns
-        self.userId = kwargs.get('userId', str(uuid.uuid4()))
-        
-        #Grundläggande information tilldelas och om ett lösen finns så hashas det.
-        self.username = username
-        self.email = email
-        if password:
-            self.set_password(password)
-        
-        # Här kollar vi på attributen som skickats med och lägger till de som redan finns i klassen
-        for key, value in kwargs.items():
-            if hasattr(self, key):
-                setattr(self, key, value)
-    
-    # Dessa är ganska självklara
-    def set_password(self, password):
-        self.password = generate_password_hash(password)
-        
-    def check_password(self, password):
-        return check_password_hash(self.password, password)
-    
-    def follow(self, user):
-        """Follow another user."""
-        if not self.is_following(user):
-            self.followed.append(user)
-            
-    def unfollow(self, user):
-        """Unfollow another user."""
-        if self.is_following(user):
-            self.followed.remove(user)
-
-    def is_following(self, user):
-        """Check if current user is following another user."""
-        return self.followed.filter(followers.c.followed_id == user.userId).count() > 0
-    
-    def followers_count(self):
-        """Get the number of followers."""
-        return self.followers.count()
+# Antalet rader i followers för varje användare, som subquery
+def counted_followers():
+    return (
+        db.select(func.count())
+        .select_from(followers)
+        .where(followers.c.followed_id == User.userId)
+        .scalar_subquery()
+    )
 
-    
-    # Tabell i databasen för posts
-class Post(db.Model):
-    __tablename__ = 'posts'
-    postId = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    userId = db.Column(db.String(36), db.ForeignKey('users.userId'), nullable=False)
-    content = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    post_picture = db.Column(db.String(200), nullable=True) 
-    
-    user = db.relationship('User', backref=db.backref('posts', lazy='dynamic'))
-    likes = db.relationship('Like', primaryjoin='Post.postId==Like.postId', 
-                            backref='post', lazy='dynamic')
-    comments = db.relationship('Comment', primaryjoin='Post.postId==Comment.postId', 
-                               backref='post', lazy='dynamic')
-
-# Tabell för likes
-class Like(db.Model):
-    __tablename__ = 'likes'
-    likeId = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    userId = db.Column(db.String(36), db.ForeignKey('users.userId'), nullable=False)
-    postId = db.Column(db.String(36), db.ForeignKey('posts.postId'), nullable=False)
-    
-    # Relation med user
-    user = db.relationship('User', backref='likes')
-
-# Tabell för kommentarer
-class Comment(db.Model):
-    __tablename__ = 'comments'
-    commentId = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    userId = db.Column(db.String(36), db.ForeignKey('users.userId'), nullable=False)
-    postId = db.Column(db.String(36), db.ForeignKey('posts.postId'), nullable=False)
-    content = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    
-    # Relation
-    user = db.relationship('User', backref='comments')
-
-# Lägger dynamiskt till nya metoder
-def add_methods_to_user_model(User):
-    # Om en användare gillar ett inlägg så kollar den upp i databasen efter userid, postid och om det hittas blir det en like, annars none.
-    def has_liked_post(self, post):
-        return Like.query.filter_by(userId=self.userId, postId=post.postId).first() is not None
-    
-    User.has_liked_post = has_liked_post
-    return User
+# Räknar om follower_count från followers, t.ex. efter en import direkt i tabellen
+def reconcile_follower_counts():
+    updated = User.query.update({User.follower_count: counted_followers()}, synchronize_session=False)
+    db.session.commit()
+    return updated
+
+# Här under finns bakgrundssynken av Spotify-data
+
+# Hämtar topplåtar och spellistor för en användare och ersätter det som finns sparat. Körs i en arbetartråd.
+# Fel kastas vidare så att SyncWorker kan försöka igen med backoff.
+def sync_spotify_user(user_id):
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        if user is None or not user.spotify_access_token:
+            return
+        if user.spotify_token_expiry and datetime.utcnow() >= user.spotify_token_expiry:
+            if not refresh_spotify_token(user):
+                raise RuntimeError('Spotify token refresh failed')
+
+        tracks = fetch_spotify_top_tracks(user.spotify_access_token)
+        playlists = fetch_spotify_playlists(user.spotify_access_token)
+
+        add_songs_to_catalog(tracks)
+        SpotifyTopTrack.query.filter_by(userId=user_id).delete(synchronize_session=False)
+        SpotifyPlaylist.query.filter_by(userId=user_id).delete(synchronize_session=False)
+        db.session.add_all([
+            SpotifyTopTrack(
+                userId=user_id, position=position, spotify_id=track['spotify_id'], name=track['name'],
+                artist=track['artist'], album_art=track['album_art'], external_url=track['external_url'],
+                preview_url=track['preview_url']
+            ) for position, track in enumerate(tracks)
+        ])
+        db.session.add_all([
+            SpotifyPlaylist(
+                userId=user_id, position=position, name=playlist['name'], tracks_count=playlist['tracks_count'],
+                external_url=playlist['external_url'], image_url=playlist['image_url']
+            ) for position, playlist in enumerate(playlists)
+        ])
+        user.spotify_synced_at = user.taste_changed_at = datetime.utcnow()
+        db.session.commit()
+        spotify_cache.invalidate(user.spotify_user_id)
+        # Körs synken i en egen process hittar webbprocesserna ändringen med taste_changed_at
+        recommender.invalidate(user_id)
+
+# Refresh:ar en användares token innan den går ut. Körs av token_refresher, inte i requests.
+def refresh_spotify_token_job(user_id):
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        if user is None or not user.spotify_refresh_token:
+            return
+        if not refresh_spotify_token(user):
+            raise RuntimeError('Spotify token refresh failed')
+
+# Användare vars token går ut inom SPOTIFY_TOKEN_REFRESH_MARGIN sekunder
+def spotify_tokens_due_for_refresh():
+    soon = datetime.utcnow() + timedelta(seconds=app.config['SPOTIFY_TOKEN_REFRESH_MARGIN'])
+    with app.app_context():
+        return [
+            user_id for (user_id,) in db.session.query(User.userId).filter(
+                User.spotify_refresh_token.isnot(None),
+                User.spotify_token_expiry < soon
+            )
+        ]
+
+# Kopplade användare som inte har synkats på ett helt intervall
+def spotify_users_due_for_sync():
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['SPOTIFY_SYNC_INTERVAL'])
+    with app.app_context():
+        return [
+            user_id for (user_id,) in db.session.query(User.userId).filter(
+                User.spotify_access_token.isnot(None),
+                or_(User.spotify_synced_at.is_(None), User.spotify_synced_at < cutoff)
+            )
+        ]
+
+# Läser den synkade datan ur databasen. Körs både i requesten och i cachens bakgrundstråd, därav app_context.
+def load_synced_spotify_data(user_id, kind):
+    model = SpotifyTopTrack if kind == 'top_tracks' else SpotifyPlaylist
+    with app.app_context():
+        rows = model.query.filter_by(userId=user_id).order_by(model.position).all()
+        return [row.as_dict() for row in rows]
+
+spotify_sync_worker = SyncWorker(
+    sync_spotify_user,
+    spotify_users_due_for_sync,
+    workers=app.config['SPOTIFY_SYNC_WORKERS'],
+    interval=app.config['SPOTIFY_SYNC_SCAN_INTERVAL']
+)
+
+# Samma sorts kö, men för att byta tokens i god tid innan de går ut
+spotify_token_refresher = SyncWorker(
+    refresh_spotify_token_job,
+    spotify_tokens_due_for_refresh,
+    workers=1,
+    interval=app.config['SPOTIFY_TOKEN_REFRESH_INTERVAL'],
+    name='spotify-token'
+)
+
+# Köerna i bakgrunden visas också på /metrics
+request_metrics.add_gauges('app_spotify_sync', spotify_sync_worker.metrics)
+request_metrics.add_gauges('app_spotify_token_refresh', spotify_token_refresher.metrics)
+request_metrics.add_gauges('app_write_queue', write_queue.metrics)
+
+# Ett original i media_store skrivs om en gång av image_pipeline när EXIF tas bort. Det är klart
+# när varianterna finns. Varianterna skrivs bara en gång. Animerade bilder får inga varianter och
+# cachas därför aldrig för alltid, fast de inte skrivs om.
+def stored_media_is_final(folder, name):
+    if name.count('.') > 1 or not image_pipeline.available:
+        return True
+    return bool(image_pipeline.variants(folder, name))
+
+# Filer i media_store som inte ändras mer får cachas för alltid. Ett original som inte är bearbetat
+# än får Flasks vanliga no-cache, med en ETag som byts när filen skrivs om.
+@app.after_request
+def cache_stored_media(response):
+    if request.endpoint == 'static' and response.status_code in (200, 304):
+        folder, _, name = request.view_args.get('filename', '').partition('/')
+        if folder in IMAGE_SIZES and is_stored_name(name) and stored_media_is_final(folder, name):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = 365 * 24 * 3600
+            response.cache_control.immutable = True
+    return response
+
+# Varje process har sin egen följargraf. En tråd i bakgrunden kollar var FOLLOW_GRAPH_CHECK sekund
+# om versionen i change_counters har ändrats och läser då om grafen, så att follows som gjorts i
+# andra processer syns här. Var FOLLOW_GRAPH_REFRESH sekund läses den om oavsett.
+follow_graph_reloading = threading.Lock()
+
+def reload_follow_graph():
+    try:
+        with app.app_context():
+            interval = app.config['FOLLOW_GRAPH_REFRESH']
+            if not follow_graph.changed() and not (interval and follow_graph.stale(interval)):
+                return
+            missing, extra = follow_graph.reload()
+        if missing or extra:
+            print(f"Follow graph reloaded: {len(missing)} follows added, {len(extra)} removed")
+    finally:
+        follow_graph_reloading.release()
+
+@app.before_request
+def refresh_follow_graph():
+    interval = app.config['FOLLOW_GRAPH_REFRESH']
+    check = app.config['FOLLOW_GRAPH_CHECK']
+    due = (check and follow_graph.unchecked(check)) or (interval and follow_graph.stale(interval))
+    if due and follow_graph_reloading.acquire(blocking=False):
+        threading.Thread(target=reload_follow_graph, name='follow-graph', daemon=True).start()
+
+# Ökar en räknare i change_counters i den pågående transaktionen och returnerar det nya värdet
+def bump_change_counter(name):
+    statement = upsert(ChangeCounter).values(name=name, value=1)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['name'], set_={'value': ChangeCounter.value + 1}
+    ))
+    return db.session.scalar(select(ChangeCounter.value).where(ChangeCounter.name == name))
+
+# follower_count för den som blev följd eller avföljd, i samma transaktion som followers
+def bump_follower_count(user_id, amount):
+    User.query.filter_by(userId=user_id).update(
+        {User.follower_count: User.follower_count + amount}, synchronize_session=False
+    )
+
+# Den som följer eller avföljer får nya förslag, även i andra processer (se load_taste_changes)
+def mark_taste_changed(user_id):
+    User.query.filter_by(userId=user_id).update(
+        {User.taste_changed_at: datetime.utcnow()}, synchronize_session=False
+    )
+
+# Samma sak för poängen i den rankade feeden, så att likes och kommentarer från andra processer kommer med
+ranking_reloading = threading.Lock()
+
+def reload_ranking():
+    try:
+        with app.app_context():
+            ranking.reload()
+    finally:
+        ranking_reloading.release()
+
+@app.before_request
+def refresh_ranking():
+    interval = app.config['FEED_RANKING_REFRESH']
+    if interval and ranking.stale(interval) and ranking_reloading.acquire(blocking=False):
+        threading.Thread(target=reload_ranking, name='feed-ranking', daemon=True).start()
+
+# Och förslagen på vilka man kan följa, så att IDF-vikterna kommer med
+recommender_rebuilding = threading.Lock()
+
+def rebuild_recommendations():
+    try:
+        with app.app_context():
+            recommender.rebuild()
+    finally:
+        recommender_rebuilding.release()
+
+def rebuild_recommendations_in_background():
+    if recommender_rebuilding.acquire(blocking=False):
+        threading.Thread(target=rebuild_recommendations, name='recommendations', daemon=True).start()
+
+# Ändrade profiler räknas om i en egen tråd och inte i requesten, som kanske läser från repliken.
+# Var RECOMMENDATIONS_CHECK sekund letar den också efter profiler som ändrats i andra processer.
+recommender_updating = threading.Lock()
+
+def update_recommendations():
+    try:
+        with app.app_context():
+            check = app.config['RECOMMENDATIONS_CHECK']
+            if check and recommender.unchecked(check):
+                recommender.pull_changes()
+            recommender.apply_pending()
+    finally:
+        recommender_updating.release()
+
+@app.before_request
+def refresh_recommendations():
+    interval = app.config['RECOMMENDATIONS_REFRESH']
+    if interval and recommender.stale(interval):
+        rebuild_recommendations_in_background()
+    check = app.config['RECOMMENDATIONS_CHECK']
+    due = recommender.pending or (check and recommender.unchecked(check))
+    if recommender.built and due and recommender_updating.acquire(blocking=False):
+        threading.Thread(target=update_recommendations, name='recommendations-update', daemon=True).start()
+
+# Arbetartrådarna startas vid första requesten, så att CLI-kommandon och importer inte startar dem
+@app.before_request
+def start_spotify_sync():
+    if app.config['SPOTIFY_SYNC_ENABLED'] and not spotify_sync_worker.running:
+        spotify_sync_worker.start()
+        spotify_token_refresher.start()
+
+# Här under finns låtkatalogen
+
+# Lägger in låtar från Spotify i katalogen, eller uppdaterar dem om de redan finns
+def add_songs_to_catalog(tracks):
+    rows = {
+        track['spotify_id']: {
+            'songId': track['spotify_id'],
+            'title': track['name'],
+            'artist': track['artist'],
+            'album': track.get('album'),
+            'coverUrl': track.get('album_art')
+        } for track in tracks
+    }
+    if not rows:
+        return
+    statement = upsert(Song).values(list(rows.values()))
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['songId'],
+        set_={
+            'title': statement.excluded.title,
+            'artist': statement.excluded.artist,
+            'album': statement.excluded.album,
+            'coverUrl': statement.excluded.coverUrl
+        }
+    ))
+
+# Gör om det användaren skrev till en FTS5-fråga där varje ord matchas som prefix, t.ex. "bara bad" -> "bara"* "bad"*
+def song_search_query(q):
+    words = re.findall(r'\w+', q.lower())
+    return ' '.join(f'"{word}"*' for word in words)
+
+# % och _ i det användaren skrev ska matchas som tecken, inte som jokertecken i LIKE
+def search_songs_by_title(q, limit):
+    prefix = q.strip().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return Song.query.filter(Song.title.ilike(prefix + '%', escape='\\')).order_by(Song.title).limit(limit).all()
+
+# Söker i låtkatalogen på titel, artist och album. Utan FTS5 (t.ex. på PostgreSQL) faller vi tillbaka på LIKE på titeln.
+def search_songs(q, limit=10):
+    match = song_search_query(q)
+    if not match:
+        return []
+    if db.engine.dialect.name != 'sqlite':
+        return search_songs_by_title(q, limit)
+    try:
+        return Song.query.from_statement(text(
+            'SELECT songs.* FROM songs_fts JOIN songs ON songs.rowid = songs_fts.rowid '
+            'WHERE songs_fts MATCH :match ORDER BY songs_fts.rank LIMIT :limit'
+        ).bindparams(match=match, limit=limit)).all()
+    except OperationalError:
+        db.session.rollback()
+        return search_songs_by_title(q, limit)
+
+# Keyset-paginering. En cursor pekar på den sista raden på sidan, (created_at, id), så nästa sida
+# blir en indexsökning istället för OFFSET som måste läsa igenom alla rader innan.
+
+def encode_cursor(key, row_id):
+    if isinstance(key, datetime):
+        key = key.isoformat()
+    raw = f"{key}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+# Returnerar (created_at, id) eller None om ingen cursor skickades. En trasig cursor ger 400.
+# Sidor som inte sorteras på tid skickar in parse_key=str.
+def decode_cursor(cursor, parse_key=datetime.fromisoformat):
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        key, row_id = raw.rsplit('|', 1)
+        return parse_key(key), row_id
+    except (ValueError, UnicodeDecodeError):
+        abort(400)
+
+# Rader som kommer efter cursorn i en lista sorterad nyast först
+def keyset_before(created_col, id_col, cursor):
+    created_at, row_id = cursor
+    return or_(created_col < created_at, and_(created_col == created_at, id_col < row_id))
+
+# Rader som kommer efter cursorn i en lista sorterad äldst först
+def keyset_after(created_col, id_col, cursor):
+    created_at, row_id = cursor
+    return or_(created_col > created_at, and_(created_col == created_at, id_col > row_id))
+
+# Vi hämtar alltid en rad extra. Finns den så finns det en sida till och cursorn pekar på sista raden vi visar.
+def split_page(rows, limit, key):
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(*key(rows[-1]))
+
+# Här under finns allt som håller tidslinjen uppdaterad
+
+# Skriver in en ny post i författarens egen och alla följares tidslinjer med en INSERT ... SELECT.
+# Konton med väldigt många följare hoppas över, de läses in i pull-läge av read_timeline().
+def fan_out_post(post):
+    db.session.add(TimelineEntry(
+        userId=post.userId, postId=post.postId, authorId=post.userId, created_at=post.created_at
+    ))
+    # follower_count läses i samma transaktion, så att valet stämmer med pull_mode_followed_ids() i alla processer
+    author_followers = db.session.scalar(select(User.follower_count).where(User.userId == post.userId))
+    if (author_followers or 0) > app.config['TIMELINE_FANOUT_LIMIT']:
+        return
+    db.session.execute(
+        insert(TimelineEntry).from_select(
+            ['userId', 'postId', 'authorId', 'created_at'],
+            select(
+                followers.c.follower_id,
+                literal(post.postId),
+                literal(post.userId),
+                literal(post.created_at)
+            ).where(followers.c.followed_id == post.userId)
+        )
+    )
+
+# Id:n på de konton som användaren följer och som är för stora för fan-out. Samma follower_count som
+# fan_out_post() använder, inte follow_graph, som kan ligga efter i en annan process.
+def pull_mode_followed_ids(user_id):
+    return db.session.scalars(
+        select(followers.c.followed_id)
+        .join(User, User.userId == followers.c.followed_id)
+        .where(followers.c.follower_id == user_id, User.follower_count > app.config['TIMELINE_FANOUT_LIMIT'])
+    ).all()
+
+# Läser en användares feed: tidslinjetabellen plus de senaste postsen från konton i pull-läge.
+# cursor är (created_at, postId) för den sista posten på föregående sida.
+def read_timeline(user_id, limit, cursor=None):
+    query = (
+        Post.query.options(joinedload(Post.user))
+        .join(TimelineEntry, TimelineEntry.postId == Post.postId)
+        .filter(TimelineEntry.userId == user_id)
+    )
+    if cursor:
+        query = query.filter(keyset_before(TimelineEntry.created_at, TimelineEntry.postId, cursor))
+    posts = query.order_by(TimelineEntry.created_at.desc(), TimelineEntry.postId.desc()).limit(limit).all()
+
+    pull_ids = pull_mode_followed_ids(user_id)
+    if pull_ids:
+        query = Post.query.options(joinedload(Post.user)).filter(Post.userId.in_(pull_ids))
+        if cursor:
+            query = query.filter(keyset_before(Post.created_at, Post.postId, cursor))
+        posts += query.order_by(Post.created_at.desc(), Post.postId.desc()).limit(limit).all()
+        # Samma post kan finnas på båda ställena om kontot växte efter att den skrevs
+        posts = list({post.postId: post for post in posts}.values())
+        posts.sort(key=lambda post: (post.created_at, post.postId), reverse=True)
+    return posts[:limit]
+
+# När man börjar följa någon läggs deras senaste posts in i ens tidslinje
+def backfill_timeline(follower_id, followed_id):
+    recent = (
+        select(
+            literal(follower_id),
+            Post.postId,
+            Post.userId,
+            Post.created_at
+        )
+        .where(Post.userId == followed_id)
+        .order_by(Post.created_at.desc())
+        .limit(app.config['TIMELINE_BACKFILL'])
+    )
+    db.session.execute(
+        upsert(TimelineEntry)
+        .from_select(['userId', 'postId', 'authorId', 'created_at'], recent)
+        .on_conflict_do_nothing()
+    )
+
+# När man slutar följa någon plockas deras posts bort ur ens tidslinje
+def prune_timeline(follower_id, followed_id):
+    TimelineEntry.query.filter_by(userId=follower_id, authorId=followed_id).delete(
+        synchronize_session=False
+    )
+
+# Bygger om alla tidslinjer från posts och followers, t.ex. efter en import
+def rebuild_timelines():
+    TimelineEntry.query.delete(synchronize_session=False)
+    own_posts = select(Post.userId, Post.postId, Post.userId, Post.created_at)
+    followed_posts = select(
+        followers.c.follower_id, Post.postId, Post.userId, Post.created_at
+    ).join(followers, followers.c.followed_id == Post.userId)
+    db.session.execute(
+        insert(TimelineEntry).from_select(
+            ['userId', 'postId', 'authorId', 'created_at'], own_posts.union(followed_posts)
+        )
+    )
+    db.session.commit()
+    return TimelineEntry.query.count()
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Bygger om hemtidslinjerna från posts och followers."""
+    entries = rebuild_timelines()
+    print(f"Rebuilt timelines with {entries} entries")
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Skapar tabeller som saknas och kör schemamigreringarna."""
+    applied = migrations.upgrade(db.engine, db.metadata)
+    print(f"Applied migrations: {applied or 'none'}")
+
+# Skapar varianter för bilder som laddades upp innan bildbearbetningen fanns
+@app.cli.command('process-images')
+def process_images_command():
+    if not image_pipeline.available:
+        print("Pillow is not installed, nothing to do")
+        return
+    processed = 0
+    for folder in IMAGE_SIZES:
+        directory = os.path.join(UPLOAD_FOLDER, folder)
+        # Äldre uppladdningar ligger direkt i mappen, nya i media_store
+        legacy = [
+            filename for filename in sorted(os.listdir(directory))
+            if os.path.isfile(os.path.join(directory, filename))
+            and not re.search(r'\.\d+w\.webp$', filename) and not filename.endswith('.tmp')
+        ]
+        stored = [name for name, _ in media_store.originals(folder)]
+        for filename in legacy + stored:
+            if image_pipeline.variants(folder, filename):
+                continue
+            try:
+                # Animerade bilder får inga varianter
+                if image_pipeline.process(folder, filename):
+                    processed += 1
+            except Exception as e:
+                print(f"Skipping {folder}/{filename}: {e}")
+    print(f"Processed {processed} images")
+
+# Tar bort uppladdade filer som ingen användare eller post pekar på längre
+@app.cli.command('gc-media')
+def gc_media_command():
+    grace = app.config['MEDIA_GC_GRACE']
+    MediaRef.query.filter(
+        MediaRef.refcount <= 0,
+        MediaRef.updated_at < datetime.utcnow() - timedelta(seconds=grace)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    referenced = {path for (path,) in db.session.query(MediaRef.path).filter(MediaRef.refcount > 0)}
+    removed = 0
+    for folder in IMAGE_SIZES:
+        names = {path.split('/', 1)[1] for path in referenced if path.startswith(folder + '/')}
+        removed += media_store.gc(folder, names, grace=grace)
+    print(f"Removed {removed} unreferenced files")
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Räknar om like_count och comment_count från likes och comments, och follower_count från followers."""
+    updated = reconcile_post_counters()
+    print(f"Reconciled counters for {updated} posts")
+    updated = reconcile_follower_counts()
+    print(f"Reconciled follower counts for {updated} users")
+
+# Jämför följargrafen med followers-tabellen, och antalet följare med COUNT i databasen
+@app.cli.command('check-follow-graph')
+def check_follow_graph_command():
+    """Kontrollerar att följargrafen i minnet stämmer med followers-tabellen."""
+    started = time.perf_counter()
+    follow_graph.reload()
+    print(f"Loaded {len(follow_graph)} follows in {time.perf_counter() - started:.2f} s")
+
+    missing, extra = follow_graph.diff(load_follow_pairs())
+    broken = follow_graph.check_symmetry()
+    counts = db.session.query(followers.c.followed_id, func.count()).group_by(followers.c.followed_id).all()
+    wrong_counts = [user_id for user_id, count in counts if follow_graph.followers_count(user_id) != count]
+    wrong_stored = User.query.filter(User.follower_count != counted_followers()).count()
+    print(f"Missing from graph: {len(missing)}, only in graph: {len(extra)}, "
+          f"asymmetric edges: {broken}, wrong follower counts: {len(wrong_counts)}, "
+          f"wrong users.follower_count: {wrong_stored}")
+    if missing or extra or broken or wrong_counts or wrong_stored:
+        raise SystemExit(1)
+
+# Lokalt kan repliken vara en andra SQLite-fil. Den här kopierar då över den primära, som en
+# replikering som körs för hand eller från cron. Riktiga repliker (PostgreSQL) sköter det själva.
+@app.cli.command('sync-replica')
+def sync_replica_command():
+    """Kopierar den primära SQLite-databasen till läsrepliken."""
+    if REPLICA not in db.engines:
+        print("DATABASE_REPLICA_URL is not set")
+        return
+    primary, replica = db.engines[None].url, db.engines[REPLICA].url
+    if primary.get_backend_name() != 'sqlite' or replica.get_backend_name() != 'sqlite':
+        print("sync-replica only copies between SQLite files, use the database's own replication")
+        return
+    copy_sqlite_database(primary.database, replica.database)
+    print(f"Copied {primary.database} to {replica.database}")
 
-#Metod tillägget appliceras här
-User = add_methods_to_user_model(User)
-         
 #Refreshar Spotifys token om den har gått ut. Returnerar en bool om den byttes succesfully.         
 def refresh_spotify_token(user):
   
@@ -203,15 +894,8 @@ def refresh_spotify_token(user):
         return False
     
     try:
-        sp_oauth = SpotifyOAuth(
-            client_id=SPOTIFY_CLIENT_ID,
-            client_secret=SPOTIFY_CLIENT_SECRET,
-            redirect_uri=SPOTIFY_REDIRECT_URI,
-            scope=' '.join(SPOTIFY_SCOPES)
-        )
-        
         # Försöker refresh:a token
-        new_token = sp_oauth.refresh_access_token(user.spotify_refresh_token)
+        new_token = spotify_clients.oauth().refresh_access_token(user.spotify_refresh_token)
         
         # Uppdaterar användarens token information
         user.spotify_access_token = new_token['access_token']
@@ -227,43 +911,227 @@ def refresh_spotify_token(user):
         print(f"Error refreshing Spotify token: {e}")
         return False
 
+# Hämtar användarens 5 topplåtar från Spotify. Kastar exception om anropet misslyckas.
+def fetch_spotify_top_tracks(access_token):
+    sp = spotify_clients.client(access_token)
+    top_tracks = sp.current_user_top_tracks(limit=5, time_range='medium_term')
+    
+    #Lägger låtarna i en lista
+    formatted_tracks = []
+    for track in top_tracks['items']:
+        # Generate embed URL
+        embed_link = f"https://open.spotify.com/embed/track/{track['id']}"
+        
+        formatted_tracks.append({
+            'name': track['name'],
+            'artist': track['artists'][0]['name'],
+            'album': track['album'].get('name'),
+            'album_art': track['album']['images'][0]['url'] if track['album']['images'] else None,
+            'external_url': track['external_urls']['spotify'],
+            'preview_url': track['preview_url'],
+            'spotify_id': track['id'],
+            'embed_url': embed_link
+        })
+    
+    return formatted_tracks
 
+# Hämtar max 6 av användarens spellistor från Spotify. Kastar exception om anropet misslyckas.
+def fetch_spotify_playlists(access_token):
+    sp = spotify_clients.client(access_token)
+    playlists = sp.current_user_playlists(limit=6)
+    
+    formatted_playlists = []
+    for playlist in playlists['items']:
+        formatted_playlists.append({
+            'name': playlist['name'],
+            'tracks_count': playlist['tracks']['total'],
+            'external_url': playlist['external_urls']['spotify'],
+            'image_url': playlist['images'][0]['url'] if playlist['images'] else None
+        })
+    
+    return formatted_playlists
 
 
 
-# Här så försöker vi konvertera en JSON-sträng till en lista, om det inte går blir det en tom lista.
-@app.template_filter('load_json')
-def load_json(value):
-    try:
-        return json.loads(value) if value else []
-    except json.JSONDecodeError:
-        return []
-# Hämtar en användare baserat på user_id från databasen
+
+
+# Flyttar in en uppladdad fil i media_store och returnerar namnet som ska in i databasen, eller
+# None om det inte är en bild vi tar emot. Både ändelsen och filens första bytes måste stämma.
+# Nya bilder skickas till bildbearbetningen, en dubblett har redan bearbetats.
+def store_upload(folder, file):
+    upload = file.stream
+    if not allowed_file(file.filename) or not isinstance(upload, UploadStream) or upload.extension is None:
+        return None
+    upload.flush()
+    name, created = media_store.adopt(folder, upload.path, upload.content_hash, upload.extension)
+    if created:
+        image_pipeline.submit(folder, name)
+    return name
+
+# Räknar upp eller ner referenserna till en fil i samma transaktion som raden som pekar på den.
+# Äldre filnamn som 'default.jpg' ligger utanför media_store och räknas inte.
+def change_media_refs(folder, name, amount):
+    if not is_stored_name(name):
+        return
+    now = datetime.utcnow()
+    db.session.execute(
+        upsert(MediaRef)
+        .values(path=f'{folder}/{name}', refcount=max(amount, 0), updated_at=now)
+        .on_conflict_do_update(
+            index_elements=['path'],
+            set_={'refcount': MediaRef.refcount + amount, 'updated_at': now}
+        )
+    )
+
+# srcset och sizes för en uppladdad bild, tomt tills bakgrundsbearbetningen är klar
+@app.template_global('image_srcset')
+def image_srcset(folder, filename, sizes):
+    return image_pipeline.srcset(folder, filename, url_for, sizes)
+
+# Hämtar en användare baserat på user_id. current_user blir en UserSnapshot ur user_cache,
+# så en vanlig sidvisning frågar inte databasen efter användaren.
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, user_id)
+    return user_cache.get(user_id, load_user_snapshot)
+
+def load_user_snapshot(user_id):
+    user = db.session.get(User, user_id)
+    return UserSnapshot(user) if user is not None else None
+
+# User-raden för den inloggade, för routes som ändrar den. current_user är bara en snapshot.
+def current_user_record():
+    return db.session.get(User, current_user.userId)
+
+# Vilka av postsen som den inloggade har gillat, hämtas med en query för hela sidan
+def get_liked_post_ids(posts):
+    post_ids = [post.postId for post in posts]
+    if not post_ids or not current_user.is_authenticated:
+        return set()
+    return {
+        post_id for (post_id,) in db.session.query(Like.postId)
+        .filter(Like.userId == current_user.userId, Like.postId.in_(post_ids))
+    }
+
+# Bygger feed-objekten för en sida med posts i ett fast antal queries, oavsett hur många posts det är.
+# Författarna måste vara eager-loadade (joinedload) på posts som skickas in.
+# Antal likes och kommentarer läses direkt från räknarna på Post.
+def build_feed(posts):
+    liked_post_ids = get_liked_post_ids(posts)
+    return [
+        {
+            'post': post,
+            'user': post.user,
+            'liked': post.postId in liked_post_ids
+        } for post in posts
+    ]
+
+# Hämtar en sida av feeden, används både av startsidan och infinite scroll
+def load_feed_page(cursor):
+    limit = app.config['FEED_PAGE_SIZE']
+    if current_user.is_authenticated:
+        # Hämtar posts från andra och sig själv ur den förberäknade tidslinjen
+        posts = read_timeline(current_user.userId, limit + 1, cursor)
+    else:
+        # Om du inte är inloggad ser du posts från alla
+        query = Post.query.options(joinedload(Post.user))
+        if cursor:
+            query = query.filter(keyset_before(Post.created_at, Post.postId, cursor))
+        posts = query.order_by(Post.created_at.desc(), Post.postId.desc()).limit(limit + 1).all()
+    posts, next_cursor = split_page(posts, limit, lambda post: (post.created_at, post.postId))
+    return build_feed(posts), next_cursor
+
+# En sida av den rankade feeden: top-K bland de konton man följer och sig själv, se ranking.py.
+# cursor är (nyckel, postId) för den sista posten på föregående sida.
+def load_ranked_page(cursor):
+    limit = app.config['FEED_PAGE_SIZE']
+    author_ids = follow_graph.following_ids(current_user.userId) + [current_user.userId]
+    top, next_cursor = split_page(ranking.top(author_ids, limit + 1, after=cursor), limit, lambda entry: entry)
+    post_ids = [post_id for _, post_id in top]
+    found = {
+        post.postId: post
+        for post in Post.query.options(joinedload(Post.user)).filter(Post.postId.in_(post_ids))
+    } if post_ids else {}
+    # Posts som har tagits bort, eller som repliken inte har fått än, hoppas över
+    return build_feed([found[post_id] for post_id in post_ids if post_id in found]), next_cursor
+
+# Sidan av feeden som requesten ber om. ?sort=top ger den rankade feeden, men bara för inloggade.
+def requested_feed_page():
+    if current_user.is_authenticated and request.args.get('sort') == 'top':
+        return ('top', *load_ranked_page(decode_cursor(request.args.get('cursor'), parse_key=float)))
+    return ('latest', *load_feed_page(decode_cursor(request.args.get('cursor'))))
+
+# Vilka av användarna på sidan som den inloggade följer, från follow_graph
+def get_following_ids(users):
+    if not current_user.is_authenticated or not users:
+        return set()
+    return {user.userId for user in users if follow_graph.is_following(current_user.userId, user.userId)}
+
+# Cachar sidan för utloggade besökare, som alla ser samma sak. Inloggade och den som har
+# flash-meddelanden på väg får alltid en nyrenderad sida.
+def cached_for_anonymous(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_user.is_authenticated or session.get('_flashes'):
+            return view(*args, **kwargs)
+
+        key = request.path
+        params = urlencode([(name, request.args[name]) for name in PAGE_CACHE_ARGS if name in request.args])
+        if params:
+            key += '?' + params
+        generation = page_cache.generation()
+        page = page_cache.get(key, generation)
+        if page is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            page = page_cache.store(key, response.get_data(), response.mimetype, generation)
+
+        response = make_response(page.body)
+        response.mimetype = page.mimetype
+        response.set_etag(page.etag)
+        response.last_modified = page.last_modified
+        # Webbläsaren får spara sidan men måste fråga om den har ändrats, vilket ger 304
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response.make_conditional(request)
+    return wrapper
+
+# Sidor som bara läser hämtar sin data från läsrepliken, om det finns en. Har besökaren skrivit
+# något de senaste DB_REPLICA_STICKY_SECONDS sekunderna läses allt från den primära istället,
+# eftersom repliken kanske inte har fått ändringen än.
+def reads_from_replica(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_replica = session.get('db_primary_until', 0) < time.time()
+        return view(*args, **kwargs)
+    return wrapper
+
+# RoutingSession och run_write sätter g.db_wrote när requesten skrev till den primära
+@app.after_request
+def stick_to_primary_after_write(response):
+    if g.get('db_wrote') and app.config['DATABASE_REPLICA_URL']:
+        session['db_primary_until'] = time.time() + app.config['DB_REPLICA_STICKY_SECONDS']
+    return response
 
 # Route-handlers 
 @app.route('/')
+@reads_from_replica
+@cached_for_anonymous
 def index():
     # Här leds man till homepagen där vi har recent posts och man kan logga in
-    if current_user.is_authenticated:
-        # Hämtar posts från andra och sig själv
-        followed_user_ids = [user.userId for user in current_user.following] + [current_user.userId]
-        posts = Post.query.filter(Post.userId.in_(followed_user_ids)).order_by(Post.created_at.desc()).limit(10).all()
-    else:
-        # Om du inte är inloggad ser du posts från alla
-        posts = Post.query.order_by(Post.created_at.desc()).limit(10).all()
-    
-    # Vi använder en dictionary för att koppla posts till användare
-    posts_with_users = [
-        {
-            'post': post, 
-            'user': db.session.get(User, post.userId)  
-        } for post in posts
-    ]
-    
-    return render_template('index.html', posts=posts_with_users)
+    sort, posts, next_cursor = requested_feed_page()
+    return render_template('index.html', posts=posts, next_cursor=next_cursor, sort=sort)
+
+# Nästa sida av feeden för infinite scroll. Returnerar färdig HTML och cursorn till sidan efter.
+@app.route('/feed/page')
+@reads_from_replica
+@login_required
+def feed_page():
+    _, posts, next_cursor = requested_feed_page()
+    return jsonify(
+        html=render_template('feed_items.html', posts=posts),
+        next_cursor=next_cursor
+    )
 
 #Hanterar registrationen
 @app.route('/register', methods=['GET', 'POST'])
@@ -292,22 +1160,26 @@ def register():
         if 'profilePicture' in request.files:
             file = request.files['profilePicture']
             if file.filename != '':
-                filename = secure_filename(file.filename)
-                file.save(os.path.join(PROFILE_PICS_FOLDER, filename))
-                profile_pic = filename
+                profile_pic = store_upload('profile_pics', file)
+                if profile_pic is None:
+                    flash('Profile picture must be a PNG, JPEG, GIF or WebP image.')
+                    return redirect(url_for('register'))
         
         # Vi skapar en ny användare
         new_user = User(
             username=username, 
             email=email, 
             password=password,
-            profilePicture=profile_pic, 
-            favoriteGenres=favorite_genre
+            profilePicture=profile_pic
         )
+        new_user.set_genres([favorite_genre])
         
         # Lägger till användaren till databasen
         db.session.add(new_user)
+        change_media_refs('profile_pics', profile_pic, 1)
         db.session.commit()
+        page_cache.invalidate()
+        recommender.invalidate(new_user.userId)
         
         # Flash-notis som dyker upp lite snabbt bara på sidan
         flash('Registration successful! Please log in.')
@@ -333,11 +1205,11 @@ def create_post():
         if 'post_picture' in request.files:
             file = request.files['post_picture']
             if file and file.filename != '':
-                # Generate a unique filename
-                filename = secure_filename(f"{current_user.username}_{int(datetime.utcnow().timestamp())}_post.{file.filename.rsplit('.', 1)[1].lower()}")
-                # Save the file
-                file.save(os.path.join(POST_PICS_FOLDER, filename))
-                post_picture = filename
+                # Save the file under the hash of its content
+                post_picture = store_upload('post_pics', file)
+                if post_picture is None:
+                    flash('Image must be a PNG, JPEG, GIF or WebP file.')
+                    return redirect(url_for('create_post'))
         
         # Create the post
         new_post = Post(
@@ -346,9 +1218,15 @@ def create_post():
             post_picture=post_picture
         )
         
-        # Add and commit to database
+        # Add and commit to database. created_at sätts här så att tidslinjen får samma tid som posten.
+        new_post.created_at = datetime.utcnow()
         db.session.add(new_post)
+        change_media_refs('post_pics', post_picture, 1)
+        db.session.flush()
+        fan_out_post(new_post)
         db.session.commit()
+        page_cache.invalidate()
+        ranking.add_post(new_post.postId, new_post.userId, new_post.created_at)
         
         flash('Post created successfully!')
         return redirect(url_for('view_post', post_id=new_post.postId))
@@ -357,10 +1235,22 @@ def create_post():
 
 # Route för att hantera post id och visa dess detaljer 
 @app.route('/post/<post_id>')
+@reads_from_replica
 def view_post(post_id):
     post = Post.query.get_or_404(post_id)
     # Om sidan hittas så returneras det, annars skapar den en 404-sida att det inte fanns
-    return render_template('view_post.html', post=post, Comment=Comment, user=post.user)
+
+    # Kommentarerna visas äldst först, en sida i taget
+    limit = app.config['COMMENTS_PAGE_SIZE']
+    cursor = decode_cursor(request.args.get('cursor'))
+    query = Comment.query.options(joinedload(Comment.user)).filter(Comment.postId == post.postId)
+    if cursor:
+        query = query.filter(keyset_after(Comment.created_at, Comment.commentId, cursor))
+    comments = query.order_by(Comment.created_at, Comment.commentId).limit(limit + 1).all()
+    comments, next_cursor = split_page(comments, limit, lambda comment: (comment.created_at, comment.commentId))
+
+    return render_template('view_post.html', post=post, Comment=Comment, user=post.user,
+                           comments=comments, next_cursor=next_cursor)
 
 #Hanterar hur likes funkar
 @app.route('/post/<post_id>/like', methods=['POST'])
@@ -368,29 +1258,31 @@ def view_post(post_id):
 def like_post(post_id):
     #Försöker hitta sidan annars blir det 404 sida
     post = Post.query.get_or_404(post_id)
-    
-    # Kollar så inte den redan är gillad
-    existing_like = Like.query.filter_by(
-        userId=current_user.userId, 
-        postId=post.postId
-    ).first()
-    
-    if existing_like:
-        # Unlike:a posten
-        db.session.delete(existing_like)
-        # Notis
-        flash('Post unliked.')
-    else:
-        # Like:a posten
-        new_like = Like(
-            userId=current_user.userId,
-            postId=post.postId
+    post_id = post.postId
+    user_id = current_user.userId
+
+    # Returnerar (gillad efteråt, om något ändrades)
+    def toggle_like():
+        # Fanns det redan en like så tas den bort direkt, utan att läsa den först
+        unliked = Like.query.filter_by(userId=user_id, postId=post_id).delete(synchronize_session=False)
+        if unliked:
+            bump_post_counter(post_id, Post.like_count, -1)
+            return False, True
+        # Like:a posten. Unika indexet på (userId, postId) gör att en dubbelklickad like inte räknas två gånger.
+        result = db.session.execute(
+            upsert(Like)
+            .values(likeId=str(uuid.uuid4()), userId=user_id, postId=post_id)
+            .on_conflict_do_nothing(index_elements=['userId', 'postId'])
         )
-        #Commitar till databasen
-        db.session.add(new_like)
-        flash('Post liked.')
-    
-    db.session.commit()
+        if result.rowcount:
+            bump_post_counter(post_id, Post.like_count, 1)
+        return True, bool(result.rowcount)
+
+    liked, changed = run_write(toggle_like)
+    if changed:
+        ranking.like(post_id, post.userId, post.created_at, liked)
+    # Notis
+    flash('Post liked.' if liked else 'Post unliked.')
     return redirect(url_for('view_post', post_id=post_id))
 
 #Hanterar kommentarer, väldigt snarlik likes. 
@@ -407,14 +1299,15 @@ def add_comment(post_id):
         return redirect(url_for('view_post', post_id=post_id))
     
     #Skapar kommentaren
-    new_comment = Comment(
-        userId=current_user.userId,
-        postId=post.postId,
-        content=content
-    )
-    
-    db.session.add(new_comment)
-    db.session.commit()
+    user_id = current_user.userId
+    post_id = post.postId
+
+    def save_comment():
+        db.session.add(Comment(userId=user_id, postId=post_id, content=content))
+        bump_post_counter(post_id, Post.comment_count, 1)
+
+    run_write(save_comment)
+    ranking.comment(post_id, post.userId, post.created_at)
     
     flash('Comment added successfully!')
     return redirect(url_for('view_post', post_id=post_id))
@@ -449,28 +1342,38 @@ def logout():
 
 #För användarens profilsida
 @app.route('/profile/<username>')
+@reads_from_replica
 def profile(username):
     #Försöker hitta användaren eller 404-sida att det inte fanns. 
     user = User.query.filter_by(username=username).first_or_404()
     
-    # Här hämtar vi alla posts från bara användaren
-    posts = Post.query.filter_by(userId=user.userId).order_by(Post.created_at.desc()).all()
+    # Här hämtar vi en sida av användarens posts, nyast först
+    limit = app.config['PROFILE_PAGE_SIZE']
+    cursor = decode_cursor(request.args.get('cursor'))
+    query = Post.query.filter_by(userId=user.userId)
+    if cursor:
+        query = query.filter(keyset_before(Post.created_at, Post.postId, cursor))
+    posts = query.order_by(Post.created_at.desc(), Post.postId.desc()).limit(limit + 1).all()
+    posts, next_cursor = split_page(posts, limit, lambda post: (post.created_at, post.postId))
     
-    return render_template('profile.html', user=user, posts=posts)
+    return render_template('profile.html', user=user, posts=posts, next_cursor=next_cursor,
+                           liked_post_ids=get_liked_post_ids(posts))
 
 #För att redigera profilen
 @app.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
     if request.method == 'POST':
+        user = current_user_record()
         # Uppdatera grundläggande profilinformation
-        current_user.email = request.form.get('email', current_user.email)
-        current_user.favoriteGenres = request.form.get('favorite_genre', current_user.favoriteGenres)
-        current_user.bio = request.form.get('bio', current_user.bio)
+        user.email = request.form.get('email', user.email)
+        if 'favorite_genre' in request.form:
+            user.set_genres([request.form['favorite_genre']])
+        user.bio = request.form.get('bio', user.bio)
         
         # Uppdatera Song of the Day
-        current_user.sotd_title = request.form.get('sotd_title', '')
-        current_user.sotd_artist = request.form.get('sotd_artist', '')
+        user.sotd_title = request.form.get('sotd_title', '')
+        user.sotd_artist = request.form.get('sotd_artist', '')
         
         # Hantera favoritlåtar
         favorite_songs = []
@@ -478,61 +1381,71 @@ def edit_profile():
             title = request.form.get(f'song_title_{i}')
             artist = request.form.get(f'song_artist_{i}')
             icon = request.form.get(f'song_icon_{i}')
+            song_id = request.form.get(f'song_id_{i}')  # Sätts om låten valdes från katalogen
             
             # Lägg bara till om både titel och artist finns
             if title and artist:
-                favorite_songs.append({
+                song = {
                     'title': title,
                     'artist': artist,
                     'icon': icon or '🎵'  # Vi har en default emoji om inget annat uppges
-                })
+                }
+                if song_id:
+                    song['spotify_id'] = song_id
+                favorite_songs.append(song)
         
-        # Spara favoritlåtar som JSON-sträng
-        current_user.favorite_songs = json.dumps(favorite_songs) if favorite_songs else None
+        # Sparas som rader i user_favorite_songs
+        user.set_favorite_songs(favorite_songs)
         
         # Hantera profilbild
         if 'profilePicture' in request.files:
             file = request.files['profilePicture']
             if file and file.filename != '':
-                filename = secure_filename(f"{current_user.username}_{int(datetime.utcnow().timestamp())}_profile.{file.filename.rsplit('.', 1)[1].lower()}")
-                file.save(os.path.join(PROFILE_PICS_FOLDER, filename))
-                current_user.profilePicture = filename
+                filename = store_upload('profile_pics', file)
+                if filename is None:
+                    flash('Profile picture must be a PNG, JPEG, GIF or WebP image.')
+                    return redirect(url_for('edit_profile'))
+                change_media_refs('profile_pics', filename, 1)
+                change_media_refs('profile_pics', user.profilePicture, -1)
+                user.profilePicture = filename
         
         # Hantera låt-bild
         if 'song_picture' in request.files:
             file = request.files['song_picture']
             if file and file.filename != '':
-                filename = secure_filename(f"{current_user.username}_{int(datetime.utcnow().timestamp())}_song.{file.filename.rsplit('.', 1)[1].lower()}")
-                file.save(os.path.join(SONG_PICS_FOLDER, filename))
-                current_user.song_picture = filename
+                filename = store_upload('song_pics', file)
+                if filename is None:
+                    flash('Song picture must be a PNG, JPEG, GIF or WebP image.')
+                    return redirect(url_for('edit_profile'))
+                change_media_refs('song_pics', filename, 1)
+                change_media_refs('song_pics', user.song_picture, -1)
+                user.song_picture = filename
         
-        # Spotify-synkronisering
-        if current_user.spotify_access_token:
-            try:
-                # Skapa Spotify-klient
-                sp = spotipy.Spotify(auth=current_user.spotify_access_token)
-                
-                # Hämta topplåtar direkt via Spotify API
-                top_tracks = sp.current_user_top_tracks(limit=5, time_range='medium_term')
-                
-                spotify_favorite_songs = []
-                for track in top_tracks['items']:
-                    spotify_favorite_songs.append({
-                        'title': track['name'],
-                        'artist': track['artists'][0]['name'],
-                        'icon': User._get_track_emoji(track['name']),
-                        'spotify_id': track['id']
-                    })
-                
-                # Valfri: Lägg till Spotify-låtar om inga manuellt valts
-                if not favorite_songs and spotify_favorite_songs:
-                    current_user.favorite_songs = json.dumps(spotify_favorite_songs)
-            except Exception as e:
-                # Felhantering om Spotify-synk misslyckas
-                print(f"Spotify sync error: {e}")
+        # Spotify-synkronisering. Själva anropen till Spotify görs av bakgrundssynken,
+        # här läser vi bara det som redan är synkat.
+        if user.spotify_access_token:
+            spotify_sync_worker.enqueue(current_user.userId)
+            
+            # Valfri: Lägg till Spotify-låtar om inga manuellt valts
+            if not favorite_songs:
+                spotify_favorite_songs = [
+                    {
+                        'title': track.name,
+                        'artist': track.artist,
+                        'icon': '🎵',
+                        'spotify_id': track.spotify_id
+                    } for track in SpotifyTopTrack.query.filter_by(userId=current_user.userId)
+                    .order_by(SpotifyTopTrack.position)
+                ]
+                if spotify_favorite_songs:
+                    user.set_favorite_songs(spotify_favorite_songs)
         
         # Spara ändringar
+        user.taste_changed_at = datetime.utcnow()
         db.session.commit()
+        page_cache.invalidate()
+        user_cache.invalidate(user.userId)
+        recommender.invalidate(user.userId)
         
         flash('Your profile has been updated!')
         return redirect(url_for('profile', username=current_user.username))
@@ -554,11 +1467,29 @@ def follow(username):
         flash('You cannot follow yourself!')
         return redirect(url_for('profile', username=username))
     
-    # Om du inte redan följer människan så gör du det nu och uppdaterar databasen
-    if not current_user.is_following(user):
-        current_user.follow(user)
-        db.session.commit()
+    # Om du inte redan följer människan så gör du det nu och uppdaterar databasen.
+    # Tabellen avgör om du redan följer, follow_graph kan ligga efter om en annan process ändrat den.
+    follower_id = current_user.userId
+    followed_id = user.userId
+
+    def save_follow():
+        result = db.session.execute(
+            upsert(followers)
+            .values(follower_id=follower_id, followed_id=followed_id)
+            .on_conflict_do_nothing()
+        )
+        if not result.rowcount:
+            return None
+        backfill_timeline(follower_id, followed_id)
+        bump_follower_count(followed_id, 1)
+        mark_taste_changed(follower_id)
+        return bump_change_counter('follows')
+
+    version = run_write(save_follow)
+    if version is not None:
         flash(f'You are now following {username}!')
+    follow_graph.add(follower_id, followed_id, version)
+    recommender.invalidate(follower_id)
     
     return redirect(url_for('profile', username=username))
 
@@ -575,46 +1506,109 @@ def unfollow(username):
         flash('You cannot unfollow yourself!')
         return redirect(url_for('profile', username=username))
     
-    # kollar om du följer människan, annars görs inget.
-    if current_user.is_following(user):
-        current_user.unfollow(user)
-        db.session.commit()
+    # kollar om du följer människan, annars görs inget. Tabellen avgör, grafen kan vara efter.
+    follower_id = current_user.userId
+    followed_id = user.userId
+
+    def save_unfollow():
+        removed = db.session.execute(followers.delete().where(
+            followers.c.follower_id == follower_id, followers.c.followed_id == followed_id
+        )).rowcount
+        if not removed:
+            return None
+        prune_timeline(follower_id, followed_id)
+        bump_follower_count(followed_id, -1)
+        mark_taste_changed(follower_id)
+        return bump_change_counter('follows')
+
+    version = run_write(save_unfollow)
+    if version is not None:
         flash(f'You have unfollowed {username}.')
+    follow_graph.remove(follower_id, followed_id, version)
+    recommender.invalidate(follower_id)
     
     return redirect(url_for('profile', username=username))
 
-# Här hämtar vi datan för ALLA människor och skickar till Users-sidan där man kan se alla konton.
+
+# Konton med liknande musiksmak som den inloggade inte redan följer, mest lik först
+def get_suggested_users():
+    if not current_user.is_authenticated:
+        return []
+    if not recommender.built:
+        rebuild_recommendations_in_background()
+        return []
+    suggested_ids = recommender.suggestions(
+        current_user.userId,
+        app.config['RECOMMENDATIONS_SHOWN'],
+        exclude=follow_graph.following_ids(current_user.userId)
+    )
+    if not suggested_ids:
+        return []
+    found = {
+        user.userId: user
+        for user in User.query.options(selectinload(User.genres)).filter(User.userId.in_(suggested_ids))
+    }
+    return [found[user_id] for user_id in suggested_ids if user_id in found]
+
+# Users-sidan där man kan bläddra bland och söka efter konton, en sida i taget i bokstavsordning.
+# Sökningen matchar början av användarnamnet, ?genre= visar bara de som gillar en genre.
 @app.route('/users')
+@reads_from_replica
+@cached_for_anonymous
 def users():
-    users = User.query.all()
-    return render_template('users.html', users=users)
+    q = request.args.get('q', '').strip()
+    genre = request.args.get('genre', '').strip()
+    limit = app.config['USERS_PAGE_SIZE']
+    cursor = decode_cursor(request.args.get('cursor'), parse_key=str)
+    name = func.lower(User.username)
+
+    # lower() görs i databasen även för söksträngen och cursorn, SQLites lower() och
+    # Pythons str.lower() är inte likadana för tecken utanför ASCII
+    query = db.session.query(User, name).options(selectinload(User.genres))
+    if genre:
+        # Går via indexet på lower(genre) i user_genres
+        query = query.join(UserGenre, and_(
+            UserGenre.userId == User.userId, func.lower(UserGenre.genre) == func.lower(genre)
+        ))
+    if q:
+        # Ett intervall istället för LIKE så att indexet på lower(username) kan användas
+        query = query.filter(name >= func.lower(q), name < func.lower(q + '\U0010ffff'))
+    if cursor:
+        query = query.filter(keyset_after(name, User.userId, cursor))
+    rows = query.order_by(name, User.userId).limit(limit + 1).all()
+    rows, next_cursor = split_page(rows, limit, lambda row: (row[1], row[0].userId))
+    users = [user for user, _ in rows]
+    # Förslagen visas bara överst på första sidan, inte när man söker eller filtrerar
+    suggested = get_suggested_users() if not q and not genre and not cursor else []
+
+    return render_template(
+        'users.html',
+        users=users,
+        suggested=suggested,
+        following_ids=get_following_ids(users + suggested),
+        q=q,
+        genre=genre,
+        next_cursor=next_cursor
+    )
 
 # Här under har vi allt med vår Spotify koppling
 @app.route('/spotify/connect')
 @login_required
 def spotify_connect():
     """Startar Spotify OAuth connection"""
-    sp_oauth = SpotifyOAuth(
-        client_id=SPOTIFY_CLIENT_ID,
-        client_secret=SPOTIFY_CLIENT_SECRET,
-        redirect_uri='http://localhost:5000/spotify/callback',
-        scope=' '.join(SPOTIFY_SCOPES),
-        show_dialog=True
-    )
-    auth_url = sp_oauth.get_authorize_url()
+    auth_url = spotify_clients.oauth(show_dialog=True).get_authorize_url()
     return redirect(auth_url)
 
 #Här hanterar vi vad vi gör med callbacken
+# Den enda route som väntar på Spotify, två anrop (token och /me) på högst 5 s var. Den görs
+# synkront med flit: användaren ska se direkt om kopplingen lyckades, koden från Spotify gäller
+# bara några minuter, och med flera processer körs synken i en annan process och skulle behöva
+# få koden via databasen. Det händer en gång per användare, så det tar sällan en tråd.
 @app.route('/spotify/callback')
 @login_required
 def spotify_callback():
     try:
-        sp_oauth = SpotifyOAuth(
-            client_id=SPOTIFY_CLIENT_ID,
-            client_secret=SPOTIFY_CLIENT_SECRET,
-            redirect_uri=SPOTIFY_REDIRECT_URI,
-            scope=' '.join(SPOTIFY_SCOPES)
-        )
+        sp_oauth = spotify_clients.oauth()
         
         # Vi kollar om vi har fått en token
         code = request.args.get('code')
@@ -623,25 +1617,34 @@ def spotify_callback():
             return redirect(url_for('profile', username=current_user.username))
 
         # Vi tar fram datan från token:en och har lite felhantering
-        token_info = sp_oauth.get_access_token(code, as_dict=True)
+        token_info = sp_oauth.get_access_token(code, as_dict=True, check_cache=False)
         
         if not token_info:
             flash('Failed to retrieve access token.', 'error')
             return redirect(url_for('profile', username=current_user.username))
 
         # Vi skapar en Spotify client med token:en
-        sp = spotipy.Spotify(auth=token_info['access_token'])
+        sp = spotify_clients.client(token_info['access_token'])
         
         # Hämtar användarens playlists.
         spotify_user = sp.current_user()
         
+        # Nytt eller återkopplat konto, gammal cachad data ska inte visas
+        spotify_cache.invalidate(current_user.spotify_user_id)
+        spotify_cache.invalidate(spotify_user['id'])
+        
         # Updaterar användarens Spotify information
-        current_user.spotify_user_id = spotify_user['id']
-        current_user.spotify_access_token = token_info['access_token']
-        current_user.spotify_refresh_token = token_info.get('refresh_token')
-        current_user.spotify_token_expiry = datetime.utcnow() + timedelta(seconds=token_info['expires_in'])
+        user = current_user_record()
+        user.spotify_user_id = spotify_user['id']
+        user.spotify_access_token = token_info['access_token']
+        user.spotify_refresh_token = token_info.get('refresh_token')
+        user.spotify_token_expiry = datetime.utcnow() + timedelta(seconds=token_info['expires_in'])
         
         db.session.commit()
+        user_cache.invalidate(user.userId)
+        
+        # Topplåtar och spellistor hämtas i bakgrunden
+        spotify_sync_worker.enqueue(current_user.userId)
         
         flash('Successfully connected to Spotify!', 'success')
         return redirect(url_for('profile', username=current_user.username))
@@ -656,17 +1659,54 @@ def spotify_callback():
         flash(f'An error occurred: {str(e)}', 'error')
         return redirect(url_for('profile', username=current_user.username))
 
+# Räknare och kö-lagg för bakgrundssynken
+@app.route('/spotify/sync/status')
+@login_required
+def spotify_sync_status():
+    return jsonify(sync=spotify_sync_worker.metrics(), token_refresh=spotify_token_refresher.metrics())
+
+# Siffrorna från instrumentation.py, och köerna i bakgrunden, i Prometheus textformat
+@app.route('/metrics')
+def metrics():
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(403)
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)
+    response = make_response(request_metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.cache_control.no_store = True
+    return response
+
+# Autocomplete för låtar, svarar från den lokala katalogen utan att fråga Spotify
+@app.route('/songs/search')
+@login_required
+def song_search():
+    q = request.args.get('q', '')[:100]
+    return jsonify(songs=[song.as_dict() for song in search_songs(q)])
+
 #Disconnectar Spotify
 @app.route('/spotify/disconnect')
 @login_required
 def spotify_disconnect():
     #Rensar all data så att användaren blir utloggad
-    current_user.spotify_access_token = None
-    current_user.spotify_refresh_token = None
-    current_user.spotify_user_id = None
-    current_user.spotify_token_expiry = None
+    spotify_cache.invalidate(current_user.spotify_user_id)
+    user = current_user_record()
+    user.spotify_access_token = None
+    user.spotify_refresh_token = None
+    user.spotify_user_id = None
+    user.spotify_token_expiry = None
+    user.spotify_synced_at = None
+    user.taste_changed_at = datetime.utcnow()
+    SpotifyTopTrack.query.filter_by(userId=user.userId).delete(synchronize_session=False)
+    SpotifyPlaylist.query.filter_by(userId=user.userId).delete(synchronize_session=False)
     
     db.session.commit()
+    user_cache.invalidate(user.userId)
+    recommender.invalidate(user.userId)
     
     flash('Spotify account disconnected.')
     return redirect(url_for('profile', username=current_user.username))
@@ -676,39 +1716,27 @@ def spotify_context_processor():
     
     # Context_processorn hjälper att lägga till Spotify relaterade funktioner tillgänliga överallt
     
+    # Datan kommer från bakgrundssynken. Har användaren aldrig synkats läggs ett jobb i kön
+    # och listan visas vid nästa sidvisning.
+    def get_synced(user, kind):
+        if user.spotify_synced_at is None:
+            spotify_sync_worker.enqueue(user.userId)
+            return []
+        user_id = user.userId
+        return spotify_cache.get(
+            user.spotify_user_id, kind,
+            lambda: load_synced_spotify_data(user_id, kind)
+        )
+    
     def get_spotify_top_tracks(user):
         
         #Kollar om användaren inte är inloggad, returnerar tom lista isåfall
         if not user.spotify_access_token:
             return []
         
-        #Försöker skapa en Spotify client och hämta deras 5 top tracks
+        #Försöker hämta deras 5 top tracks
         try:
-            # Refresh token if needed
-            if (user.spotify_token_expiry and 
-                datetime.utcnow() >= user.spotify_token_expiry):
-                refresh_spotify_token(user)
-            
-            sp = spotipy.Spotify(auth=user.spotify_access_token)
-            top_tracks = sp.current_user_top_tracks(limit=5, time_range='medium_term')
-            
-            #Lägger låtarna i en lista
-            formatted_tracks = []
-            for track in top_tracks['items']:
-                # Generate embed URL
-                embed_link = f"https://open.spotify.com/embed/track/{track['id']}"
-                
-                formatted_tracks.append({
-                    'name': track['name'],
-                    'artist': track['artists'][0]['name'],
-                    'album_art': track['album']['images'][0]['url'] if track['album']['images'] else None,
-                    'external_url': track['external_urls']['spotify'],
-                    'preview_url': track['preview_url'],
-                    'spotify_id': track['id'],
-                    'embed_url': embed_link
-                })
-            
-            return formatted_tracks
+            return get_synced(user, 'top_tracks')
         except Exception as e:
             print(f"Error fetching top tracks: {e}")
             return []
@@ -719,21 +1747,9 @@ def spotify_context_processor():
         if not user.spotify_access_token:
             return []
         
-        #Försöker göra en Spotify Client och hämta max 6 spellistor
+        #Försöker hämta max 6 spellistor
         try:
-            sp = spotipy.Spotify(auth=user.spotify_access_token)
-            playlists = sp.current_user_playlists(limit=6)
-            
-            formatted_playlists = []
-            for playlist in playlists['items']:
-                formatted_playlists.append({
-                    'name': playlist['name'],
-                    'tracks_count': playlist['tracks']['total'],
-                    'external_url': playlist['external_urls']['spotify'],
-                    'image_url': playlist['images'][0]['url'] if playlist['images'] else None
-                })
-            
-            return formatted_playlists
+            return get_synced(user, 'playlists')
         except Exception as e:
             print(f"Error fetching playlists: {e}")
             return []
@@ -745,7 +1761,43 @@ def spotify_context_processor():
     )
 
 # FÖR ATT KÖRA PROGRAMMET
-if __name__ == '__main__':
+# Används av wsgi.py, asgi.py och serve.py. Inställningar som läses när modulen importeras
+# (cachar, pooler, bakgrundssynk) sätts med miljövariabler, config här gäller resten.
+def create_app():
+    """Skapar mappar och tabeller som saknas, kör migreringarna och läser in följargrafen och poängen.
+
+    Konfigurationen läses från miljön (och .env) när modulen importeras, eftersom databasen,
+    cacharna och bakgrundstrådarna skapas då. Den som vill ändra något sätter miljövariablerna
+    innan `import app`.
+
+    Varje process i gunicorn och uvicorn kör den samtidigt, migrations.upgrade() tar ett lås så
+    att bara en av dem skapar tabeller och migrerar.
+    """
+    # Vi kollar att uppladdnings konfigen finns
+    media_store.create_folders()
+    page_cache.create_folders()
+    os.makedirs(app.config['UPLOAD_TMP_DIR'], exist_ok=True)
     with app.app_context():
-        db.create_all()
-    app.run(debug=True)
+        migrations.upgrade(db.engine, db.metadata)
+        follow_graph.reload()
+        ranking.reload()
+    return app
+
+# Kör bakgrundssynken i en egen process. serve.py använder den när appen körs med flera
+# processer, så att inte varje process synkar samma användare.
+@app.cli.command('spotify-sync')
+def spotify_sync_command():
+    """Kör Spotify-synken och token-refreshen i förgrunden tills processen stoppas."""
+    spotify_sync_worker.start()
+    spotify_token_refresher.start()
+    print("Spotify sync running, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"Spotify sync: {spotify_sync_worker.metrics()}")
+    except KeyboardInterrupt:
+        spotify_sync_worker.stop()
+        spotify_token_refresher.stop()
+
+if __name__ == '__main__':
+    create_app().run(debug=True)
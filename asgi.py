@@ -0,0 +1,13 @@
+"""ASGI-ingång, t.ex. uvicorn asgi:app.
+
+Flask är en WSGI-app, så varje request körs fortfarande i en tråd (asgirefs trådpool).
+ASGI-läget är till för att kunna köra bakom en ASGI-server som redan finns i driften, det gör
+inga requests asynkrona. /spotify/callback väntar fortfarande på Spotify i sin tråd, se
+spotify_callback() i app.py för varför.
+Kräver asgiref (pip install 'flask[async]').
+"""
+from asgiref.wsgi import WsgiToAsgi
+
+from app import create_app
+
+app = WsgiToAsgi(create_app())
@@ -0,0 +1,123 @@
+"""Kontrollerar att routernas SQL-queries använder index.
+
+Skriptet kör varje route mot en temporär databas, fångar alla SQL-satser som körs
+och kör EXPLAIN QUERY PLAN på dem. En rad som "SCAN posts" utan index betyder en
+full tabellskanning och gör att skriptet avslutas med felkod.
+
+    python benchmarks/explain_queries.py
+"""
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+_db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+_db_file.close()
+os.environ['DATABASE_URL'] = 'sqlite:///' + _db_file.name
+# Bakgrundssynkens queries ska inte räknas in
+os.environ['SPOTIFY_SYNC_ENABLED'] = '0'
+
+from sqlalchemy import event  # noqa: E402
+
+from app import app, db, migrations, recommender, Post  # noqa: E402
+
+# En SCAN utan index, t.ex. "SCAN posts" men inte "SCAN posts USING INDEX ix_posts_created"
+FULL_SCAN = re.compile(r'^SCAN (\w+)\b(?! USING (COVERING )?INDEX)')
+
+# Tabellskanningar som är väntade, per route
+ALLOWED_SCANS = {}
+
+
+def explain(connection, statement, parameters):
+    parameters = [str(value) if isinstance(value, datetime) else value for value in parameters]
+    cursor = connection.cursor()
+    try:
+        return [row[3] for row in cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)]
+    finally:
+        cursor.close()
+
+
+def capture(engine, request):
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and not statement.lstrip().upper().startswith(('PRAGMA', 'CREATE')):
+            statements.append((statement, tuple(parameters or ())))
+
+    event.listen(engine, 'before_cursor_execute', on_execute)
+    try:
+        response = request()
+    finally:
+        event.remove(engine, 'before_cursor_execute', on_execute)
+    assert response.status_code < 400, response.status_code
+    return statements
+
+
+def main():
+    with app.app_context():
+        migrations.upgrade(db.engine, db.metadata)
+        engine = db.engine
+
+    alice = app.test_client()
+    bob = app.test_client()
+    for client, name in ((alice, 'alice'), (bob, 'bob')):
+        client.post('/register', data={'username': name, 'email': f'{name}@example.com', 'password': 'pw',
+                                       'favorite_genre': 'Jazz'})
+        client.post('/login', data={'username': name, 'password': 'pw'})
+    alice.post('/create_post', data={'content': 'hello'})
+    with app.app_context():
+        post_id = Post.query.first().postId
+        # Förslagen på /users byggs annars i en bakgrundstråd med en läsning av hela users-tabellen,
+        # som skulle hamna bland queries för den route som råkar köras då
+        recommender.rebuild()
+
+    routes = [
+        ('POST /login', lambda: app.test_client().post('/login', data={'username': 'alice', 'password': 'pw'})),
+        ('POST /register', lambda: app.test_client().post(
+            '/register', data={'username': 'carol', 'email': 'carol@example.com', 'password': 'pw'})),
+        ('GET /follow', lambda: bob.get('/follow/alice')),
+        ('POST /create_post', lambda: alice.post('/create_post', data={'content': 'second'})),
+        ('GET /', lambda: bob.get('/')),
+        ('GET / (anonymous)', lambda: app.test_client().get('/')),
+        ('GET /profile', lambda: bob.get('/profile/alice')),
+        ('GET /post', lambda: bob.get(f'/post/{post_id}')),
+        ('POST /like', lambda: bob.post(f'/post/{post_id}/like')),
+        ('POST /comment', lambda: bob.post(f'/post/{post_id}/comment', data={'content': 'nice'})),
+        ('GET /unfollow', lambda: bob.get('/unfollow/alice')),
+        ('GET /users', lambda: bob.get('/users')),
+        ('GET /users?q=', lambda: bob.get('/users?q=Al')),
+        ('GET /users?genre=', lambda: bob.get('/users?genre=jazz')),
+        ('POST /edit_profile', lambda: bob.post('/edit_profile', data={
+            'email': 'bob@example.com', 'favorite_genre': 'Rock', 'song_title_0': 'So What', 'song_artist_0': 'Miles Davis'})),
+    ]
+
+    failures = 0
+    for name, request in routes:
+        statements = capture(engine, request)
+        allowed = ALLOWED_SCANS.get(name, set())
+        raw = engine.raw_connection()
+        try:
+            for statement, parameters in statements:
+                for line in explain(raw.driver_connection, statement, parameters):
+                    match = FULL_SCAN.match(line)
+                    if match and match.group(1) not in allowed:
+                        failures += 1
+                        print(f'FAIL {name}: {line}\n    {" ".join(statement.split())[:200]}')
+        finally:
+            raw.close()
+        print(f'{name:<22} {len(statements)} statements')
+
+    os.unlink(_db_file.name)
+    if failures:
+        print(f'{failures} queries utan index')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""En lokal fejkserver för Spotify Web API och token-endpointen.
+
+Svarar på de anrop som appen gör (/v1/me, /v1/me/top/tracks, /v1/me/playlists och
+/api/token) med påhittad data, med en valfri fördröjning för att simulera nätverket.
+Starta appen med SPOTIFY_API_URL och SPOTIFY_TOKEN_URL pekade hit:
+
+    python benchmarks/fake_spotify.py --port 8765 --latency 0.2
+    SPOTIFY_API_URL=http://127.0.0.1:8765/v1/ SPOTIFY_TOKEN_URL=http://127.0.0.1:8765/api/token python app.py
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+def _track(i):
+    return {
+        'id': f'track{i}',
+        'name': f'Fake Track {i}',
+        'artists': [{'id': f'artist{i % 3}', 'name': f'Fake Artist {i % 3}'}],
+        'album': {'name': f'Fake Album {i}', 'images': [{'url': f'https://example.com/cover{i}.jpg'}]},
+        'external_urls': {'spotify': f'https://open.spotify.com/track/track{i}'},
+        'preview_url': None,
+        'popularity': 50,
+    }
+
+
+def _playlist(i):
+    return {
+        'id': f'playlist{i}',
+        'name': f'Fake Playlist {i}',
+        'tracks': {'total': 10 + i},
+        'external_urls': {'spotify': f'https://open.spotify.com/playlist/playlist{i}'},
+        'images': [],
+    }
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    # Keep-alive, så att det syns om klienten återanvänder sina anslutningar
+    protocol_version = 'HTTP/1.1'
+    # Sätts av FakeSpotifyServer
+    latency = 0.0
+    stats = None
+
+    def setup(self):
+        super().setup()
+        self.stats['connections'] = self.stats.get('connections', 0) + 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, headers=None):
+        time.sleep(self.latency)
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        path = urlparse(self.path).path.rstrip('/')
+        self.stats[path] = self.stats.get(path, 0) + 1
+        if path == '/v1/me':
+            self._reply(200, {'id': 'fake-user', 'display_name': 'Fake User'})
+        elif path == '/v1/me/top/tracks':
+            self._reply(200, {'items': [_track(i) for i in range(5)]})
+        elif path == '/v1/me/playlists':
+            self._reply(200, {'items': [_playlist(i) for i in range(6)]})
+        else:
+            self._reply(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+    def do_POST(self):
+        path = urlparse(self.path).path.rstrip('/')
+        self.stats[path] = self.stats.get(path, 0) + 1
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        if path == '/api/token':
+            self._reply(200, {
+                'access_token': f'fake-access-{time.time()}',
+                'token_type': 'Bearer',
+                'expires_in': 3600,
+                'refresh_token': 'fake-refresh',
+                'scope': 'user-top-read',
+            })
+        else:
+            self._reply(404, {'error': 'not_found'})
+
+
+class FakeSpotifyServer:
+    """Kör fejkservern i en bakgrundstråd. stats räknar anrop per sökväg och antal anslutningar."""
+
+    def __init__(self, port=0, latency=0.0):
+        self.stats = {}
+        handler = type('Handler', (FakeSpotifyHandler,), {'latency': latency, 'stats': self.stats})
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    @property
+    def api_url(self):
+        return self.base_url + '/v1/'
+
+    @property
+    def token_url(self):
+        return self.base_url + '/api/token'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='Fördröjning per anrop i sekunder')
+    args = parser.parse_args()
+    server = FakeSpotifyServer(args.port, args.latency)
+    print(f'Fake Spotify on {server.api_url} (token: {server.token_url})')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Räknar SQL-queries för startsidans feed.
+
+Feeden ska byggas med ett fast antal queries oavsett hur många posts som visas.
+Skriptet seedar en temporär databas, mäter antalet queries för en tom och en full
+feed och avslutar med felkod om antalet växer med antalet posts eller går över budgeten.
+
+    python benchmarks/feed_queries.py
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+_db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+_db_file.close()
+os.environ['DATABASE_URL'] = 'sqlite:///' + _db_file.name
+# Bakgrundssynkens queries ska inte räknas in
+os.environ['SPOTIFY_SYNC_ENABLED'] = '0'
+
+from sqlalchemy import event  # noqa: E402
+
+from app import (  # noqa: E402
+    app, db, follow_graph, User, Post, Like, Comment, reconcile_post_counters, rebuild_timelines
+)
+
+# Max antal queries för en inloggad GET /. load_user frågar inte databasen när användaren
+# redan finns i user_cache, vilket den gör efter första requesten.
+QUERY_BUDGET = 3
+PASSWORD = 'benchmark'
+
+
+def seed(n_posts):
+    viewer = User(username='viewer', email='viewer@example.com', password=PASSWORD)
+    authors = [User(username=f'author{i}', email=f'author{i}@example.com') for i in range(5)]
+    db.session.add(viewer)
+    db.session.add_all(authors)
+    for author in authors:
+        viewer.followed.append(author)
+    db.session.flush()
+
+    for i in range(n_posts):
+        author = authors[i % len(authors)]
+        post = Post(userId=author.userId, content=f'post {i}')
+        db.session.add(post)
+        db.session.flush()
+        for liker in authors[:i % 4]:
+            db.session.add(Like(userId=liker.userId, postId=post.postId))
+        db.session.add(Comment(userId=viewer.userId, postId=post.postId, content='nice'))
+        if i % 2:
+            db.session.add(Like(userId=viewer.userId, postId=post.postId))
+    db.session.commit()
+    reconcile_post_counters()
+    rebuild_timelines()
+    # Följarna lades in direkt i tabellen, grafen läses in på nytt vid nästa request
+    follow_graph.reset()
+
+
+def count_feed_queries(client):
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', on_execute)
+    try:
+        response = client.get('/')
+    finally:
+        event.remove(engine, 'before_cursor_execute', on_execute)
+    assert response.status_code == 200, response.status_code
+    return len(statements)
+
+
+def main():
+    results = {}
+    for n_posts in (0, 10):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            seed(n_posts)
+        # Varje request får sin egen app context, så load_user räknas som i drift
+        with app.test_client() as client:
+            client.post('/login', data={'username': 'viewer', 'password': PASSWORD})
+            client.get('/')
+            results[n_posts] = count_feed_queries(client)
+
+    os.unlink(_db_file.name)
+    for n_posts, count in results.items():
+        print(f'{n_posts:>3} posts: {count} queries')
+
+    failed = False
+    if results[10] > results[0] + 1:
+        print('FAIL: antalet queries växer med antalet posts i feeden')
+        failed = True
+    if results[10] > QUERY_BUDGET:
+        print(f'FAIL: {results[10]} queries, budgeten är {QUERY_BUDGET}')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+"""Jämför den rankade feeden (ranking.py) med den kronologiska tidslinjen vid många posts.
+
+Seedar en temporär databas med --posts posts från --users användare, spridda över de senaste
+--days dagarna, med slumpade like- och kommentarsräknare. --readers användare följer --follows
+konton var och får sina tidslinjer byggda. Sedan mäts för samma läsare:
+
+  - första sidan av tidslinjen med read_timeline(), som startsidan gör i dag
+  - ranking.top() ensam, och top() plus hämtningen av postsen med id
+  - samma ranking direkt i SQL (ORDER BY poäng), om SQLite har matematikfunktionerna
+  - en like i ranking.like(), som like_post() anropar efter commit
+
+Skriptet avslutar med felkod om top() ger en annan ordning än att sortera alla posts från
+de följda kontona, om poängen efter slumpade likes och kommentarer inte stämmer med summan
+räknad för hand, om top() tar längre tid än den kronologiska queryn, eller om en hel rankad
+sida (top() plus en query för postsen) tar mer än dubbelt så lång tid som en kronologisk.
+Till sist körs reload() med en loader som tar RELOAD_DELAY sekunder, och skriptet avslutar
+med felkod om like() eller top() väntar mer än MAX_STALL under tiden eller om en like som kom under
+inläsningen försvinner.
+
+    python benchmarks/feed_ranking.py --posts 1000000
+"""
+import argparse
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+_db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+_db_file.close()
+os.environ['DATABASE_URL'] = 'sqlite:///' + _db_file.name
+os.environ['SPOTIFY_SYNC_ENABLED'] = '0'
+
+# Appen läser konfigurationen när den importeras, så argumenten tolkas innan
+parser = argparse.ArgumentParser()
+parser.add_argument('--posts', type=int, default=1_000_000)
+parser.add_argument('--users', type=int, default=20000)
+parser.add_argument('--days', type=int, default=7)
+parser.add_argument('--readers', type=int, default=20)
+parser.add_argument('--follows', type=int, default=100)
+args = parser.parse_args()
+os.environ['FEED_RANKING_HORIZON'] = str(args.days)
+
+from sqlalchemy import insert, select, text  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from sqlalchemy.orm import joinedload  # noqa: E402
+
+from app import (  # noqa: E402
+    create_app, db, followers, follow_graph, ranking, read_timeline, load_ranking_rows,
+    User, Post, TimelineEntry
+)
+from ranking import EPOCH, RankingEngine  # noqa: E402
+
+PAGE = 10
+ROUNDS = 200
+CHUNK = 50000
+RELOAD_DELAY = 1.0
+MAX_STALL = 0.05
+
+
+def seed(rng, args):
+    user_ids = [str(uuid.uuid4()) for _ in range(args.users)]
+    db.session.execute(insert(User), [
+        {'userId': user_id, 'username': f'user{i}', 'email': f'user{i}@example.com'}
+        for i, user_id in enumerate(user_ids)
+    ])
+    now = datetime.utcnow()
+    span = args.days * 24 * 3600
+    for start in range(0, args.posts, CHUNK):
+        db.session.execute(insert(Post), [
+            {
+                'postId': str(uuid.uuid4()),
+                'userId': rng.choice(user_ids),
+                'content': 'post',
+                'created_at': now - timedelta(seconds=rng.uniform(0, span)),
+                # De flesta posts får inget, några får mycket
+                'like_count': int(rng.paretovariate(1.5)) - 1,
+                'comment_count': int(rng.paretovariate(2.5)) - 1,
+            }
+            for _ in range(start, min(start + CHUNK, args.posts))
+        ])
+        db.session.commit()
+
+    readers = user_ids[:args.readers]
+    db.session.execute(insert(followers), [
+        {'follower_id': reader, 'followed_id': followed}
+        for reader in readers
+        for followed in rng.sample(user_ids[args.readers:], args.follows)
+    ])
+    # Tidslinjerna byggs bara för läsarna, som fan_out_post() hade gjort
+    for reader in readers:
+        db.session.execute(
+            insert(TimelineEntry).from_select(
+                ['userId', 'postId', 'authorId', 'created_at'],
+                select(followers.c.follower_id, Post.postId, Post.userId, Post.created_at)
+                .join(Post, Post.userId == followers.c.followed_id)
+                .where(followers.c.follower_id == reader)
+            )
+        )
+    db.session.commit()
+    follow_graph.reset()
+    return readers
+
+
+def timed(readers, rounds, fns):
+    """Kör fns omväxlande, en runda i taget, så att brus på maskinen drabbar alla lika."""
+    times = {label: [] for label in fns}
+    for i in range(rounds):
+        reader = readers[i % len(readers)]
+        for label, fn in fns.items():
+            started = time.perf_counter()
+            fn(reader)
+            times[label].append((time.perf_counter() - started) * 1e6)
+    medians = {}
+    for label, values in times.items():
+        medians[label] = statistics.median(values)
+        print(f"{label:<36} median {medians[label]:9.1f} µs  p95 {sorted(values)[int(len(values) * 0.95)]:9.1f} µs")
+    return medians
+
+
+def authors_of(reader):
+    return follow_graph.following_ids(reader) + [reader]
+
+
+def ranked_page(reader):
+    post_ids = [post_id for _, post_id in ranking.top(authors_of(reader), PAGE + 1)]
+    found = {
+        post.postId: post
+        for post in Post.query.options(joinedload(Post.user)).filter(Post.postId.in_(post_ids))
+    }
+    return [found[post_id] for post_id in post_ids if post_id in found]
+
+
+def check_order(rows, readers):
+    """top() mot att sortera alla posts från de följda kontona, sida för sida."""
+    by_author = {}
+    for post_id, author_id, created_at, likes, comments in rows:
+        weight = ranking.post_weight + ranking.like_weight * likes + ranking.comment_weight * comments
+        by_author.setdefault(author_id, []).append((ranking.base_key(created_at, weight), post_id))
+    wrong = 0
+    for reader in readers:
+        expected = []
+        for author_id in set(authors_of(reader)):
+            expected += sorted(by_author.get(author_id, ()), key=lambda e: (-e[0], e[1]))[:ranking.per_author]
+        expected.sort(key=lambda e: (-e[0], e[1]))
+        got, after = [], None
+        while True:
+            page = ranking.top(authors_of(reader), PAGE, after=after)
+            if not page:
+                break
+            got += page
+            after = page[-1]
+        wrong += [post_id for _, post_id in got] != [post_id for _, post_id in expected]
+    return wrong
+
+
+def check_scores(rng):
+    """Poängen efter slumpade likes och kommentarer mot summan av avtagande vikter."""
+    engine = RankingEngine(half_life=math.log(2) / ranking.decay)
+    created = datetime.utcnow() - timedelta(hours=6)
+    engine.load([('post', 'author', created, 0, 0)])
+    events = sorted((created + timedelta(seconds=rng.uniform(0, 6 * 3600)),
+                     rng.choice((engine.like_weight, engine.comment_weight))) for _ in range(500))
+    for when, weight in events:
+        engine.engage('post', 'author', created, weight, when=when)
+    now = datetime.utcnow()
+    expected = engine.post_weight * math.exp(-engine.decay * (now - created).total_seconds()) + sum(
+        weight * math.exp(-engine.decay * (now - when).total_seconds()) for when, weight in events)
+    return abs(engine.score('post', now=now) - expected) / expected
+
+
+def check_reload(rows, reader):
+    """Kör reload() med en långsam loader. Returnerar (längsta like() eller top(), om liken under inläsningen fanns kvar)."""
+    started = threading.Event()
+
+    def slow_loader():
+        started.set()
+        time.sleep(RELOAD_DELAY)
+        return rows
+
+    engine = RankingEngine(slow_loader, half_life=math.log(2) / ranking.decay, per_author=ranking.per_author)
+    engine.load(rows)
+    authors = authors_of(reader)
+    post_id, author_id, created_at, *_ = next(row for row in rows if row[1] in authors)
+    reloading = threading.Thread(target=engine.reload)
+    reloading.start()
+    started.wait()
+    # Så många likes att posten hamnar överst. Varken like() eller top() ska behöva vänta på inläsningen.
+    stall = 0.0
+    for _ in range(1000):
+        begun = time.perf_counter()
+        engine.like(post_id, author_id, created_at)
+        stall = max(stall, time.perf_counter() - begun)
+    while reloading.is_alive():
+        begun = time.perf_counter()
+        engine.top(authors, PAGE + 1)
+        stall = max(stall, time.perf_counter() - begun)
+        time.sleep(0.01)
+    reloading.join()
+    return stall, engine.top(authors, 1)[0][1] == post_id
+
+
+def main():
+    rng = random.Random(1)
+    app = create_app()
+    with app.app_context():
+        started = time.perf_counter()
+        readers = seed(rng, args)
+        print(f"Seeded {args.posts} posts from {args.users} users in {time.perf_counter() - started:.0f} s")
+
+        started = time.perf_counter()
+        rows = load_ranking_rows()
+        query_time = time.perf_counter() - started
+        tracemalloc.start()
+        ranking.load(rows)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        # Tiden mäts på en andra inläsning, tracemalloc gör den första långsammare
+        started = time.perf_counter()
+        ranking.load(rows)
+        print(f"Ranked {len(ranking)} posts: query {query_time:.1f} s, load {time.perf_counter() - started:.1f} s, "
+              f"about {memory / 1024 / 1024:.0f} MB")
+
+        # Värmer upp cachen för båda vägarna innan något mäts
+        for reader in readers:
+            read_timeline(reader, PAGE + 1)
+            ranked_page(reader)
+
+        medians = timed(readers, ROUNDS, {
+            'chronological, read_timeline()': lambda r: read_timeline(r, PAGE + 1),
+            'ranked, top()': lambda r: ranking.top(authors_of(r), PAGE + 1),
+            'ranked, top() + fetch by id': ranked_page,
+        })
+        chronological, top_only, ranked = medians.values()
+
+        decay = ranking.decay
+        epoch = (EPOCH - datetime(1970, 1, 1)).total_seconds()
+        sql_rank = text(
+            "SELECT posts.postId FROM posts JOIN followers ON followers.followed_id = posts.userId "
+            "WHERE followers.follower_id = :reader AND posts.created_at >= :since "
+            "ORDER BY ln(:post_w + :like_w * like_count + :comment_w * comment_count) "
+            "+ :decay * (unixepoch(posts.created_at) - :epoch) DESC LIMIT :limit"
+        ).bindparams(
+            since=datetime.utcnow() - timedelta(days=args.days), post_w=ranking.post_weight,
+            like_w=ranking.like_weight, comment_w=ranking.comment_weight, decay=decay, epoch=epoch, limit=PAGE + 1
+        )
+        try:
+            db.session.execute(sql_rank, {'reader': readers[0]}).all()
+            timed(readers, 20, {'ranked in SQL, ORDER BY score': lambda r: db.session.execute(sql_rank, {'reader': r}).all()})
+        except OperationalError:
+            print("ranked in SQL, ORDER BY score       skipped, SQLite has no ln() or unixepoch()")
+
+        post_ids = [post_id for post_id, *_ in rng.sample(rows, min(len(rows), 10000))]
+        created = {post_id: (author_id, created_at) for post_id, author_id, created_at, *_ in rows}
+        started = time.perf_counter()
+        for post_id in post_ids:
+            ranking.like(post_id, *created[post_id])
+        print(f"{'ranking.like()':<36} {(time.perf_counter() - started) / len(post_ids) * 1e6:9.1f} µs/call")
+
+        ranking.load(rows)
+        wrong = check_order(rows, readers)
+        error = check_scores(rng)
+        print(f"Readers with wrong order: {wrong}, relative score error {error:.1e}")
+
+        stall, kept = check_reload(rows, readers[0])
+        print(f"like() and top() during a {RELOAD_DELAY:.0f} s reload: slowest {stall * 1000:.1f} ms, "
+              f"like during the reload {'kept' if kept else 'lost'}")
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(_db_file.name + suffix):
+            os.unlink(_db_file.name + suffix)
+    if wrong or error > 1e-9:
+        return 1
+    if stall > MAX_STALL or not kept:
+        print(f"FAIL: like() or top() waited {stall * 1000:.0f} ms during reload(), like kept: {kept}")
+        return 1
+    if top_only > chronological or ranked > 2 * chronological:
+        print(f"FAIL: top() {top_only:.0f} µs, ranked page {ranked:.0f} µs, chronological {chronological:.0f} µs")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
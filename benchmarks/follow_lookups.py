@@ -0,0 +1,131 @@
+"""Jämför följargrafen i minnet (follow_graph.py) med samma frågor mot followers-tabellen.
+
+Seedar en temporär databas med --users användare som följer --follows konton var,
+läser in grafen och mäter "följer A B?", antal följare och listan med de man följer,
+först med SQL och sedan mot grafen. Efter det görs slumpade follows och unfollows både i
+tabellen och i grafen, och skriptet avslutar med felkod om de inte stämmer överens.
+
+    python benchmarks/follow_lookups.py --users 5000 --follows 50
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+_db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+_db_file.close()
+os.environ['DATABASE_URL'] = 'sqlite:///' + _db_file.name
+os.environ['SPOTIFY_SYNC_ENABLED'] = '0'
+
+from sqlalchemy import func, insert  # noqa: E402
+
+from app import create_app, db, followers, follow_graph, load_follow_pairs, User  # noqa: E402
+
+LOOKUPS = 20000
+
+
+def seed(rng, n_users, n_follows):
+    user_ids = [str(uuid.uuid4()) for _ in range(n_users)]
+    db.session.execute(insert(User), [
+        {'userId': user_id, 'username': f'user{i}', 'email': f'user{i}@example.com'}
+        for i, user_id in enumerate(user_ids)
+    ])
+    edges = {
+        (follower, followed)
+        for follower in user_ids
+        for followed in rng.sample(user_ids, n_follows) if followed != follower
+    }
+    db.session.execute(insert(followers), [{'follower_id': a, 'followed_id': b} for a, b in edges])
+    db.session.commit()
+    return user_ids
+
+
+def timed(label, calls, fn):
+    started = time.perf_counter()
+    for args in calls:
+        fn(*args)
+    per_call = (time.perf_counter() - started) / len(calls) * 1e6
+    print(f"{label:<34} {per_call:9.2f} µs/call")
+    return per_call
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--follows', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    app = create_app()
+    with app.app_context():
+        user_ids = seed(rng, args.users, args.follows)
+        pairs_sample = [(rng.choice(user_ids), rng.choice(user_ids)) for _ in range(LOOKUPS)]
+        user_sample = [(rng.choice(user_ids),) for _ in range(LOOKUPS // 10)]
+
+        tracemalloc.start()
+        follow_graph.reload()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        # Tiden mäts på en andra inläsning, tracemalloc gör den första långsammare
+        started = time.perf_counter()
+        follow_graph.reload()
+        load_time = time.perf_counter() - started
+        print(f"Loaded {len(follow_graph)} follows for {args.users} users in {load_time:.2f} s, "
+              f"about {memory / 1024 / 1024:.1f} MB")
+
+        def sql_is_following(a, b):
+            return db.session.query(followers).filter_by(follower_id=a, followed_id=b).first() is not None
+
+        def sql_followers_count(user_id):
+            return db.session.query(func.count()).select_from(followers).filter(
+                followers.c.followed_id == user_id).scalar()
+
+        def sql_following_ids(user_id):
+            return db.session.scalars(db.select(followers.c.followed_id).where(
+                followers.c.follower_id == user_id)).all()
+
+        timed('is_following, SQL', pairs_sample[:LOOKUPS // 10], sql_is_following)
+        timed('is_following, graph', pairs_sample, follow_graph.is_following)
+        timed('followers_count, SQL', user_sample, sql_followers_count)
+        timed('followers_count, graph', user_sample, follow_graph.followers_count)
+        timed('following_ids, SQL', user_sample, sql_following_ids)
+        timed('following_ids, graph', user_sample, follow_graph.following_ids)
+
+        # Slumpade ändringar på båda ställena, som follow() och unfollow() gör dem
+        for _ in range(2000):
+            a, b = rng.choice(user_ids), rng.choice(user_ids)
+            if a == b:
+                continue
+            if rng.random() < 0.5:
+                db.session.execute(followers.delete().where(
+                    followers.c.follower_id == a, followers.c.followed_id == b))
+                follow_graph.remove(a, b)
+            else:
+                db.session.execute(followers.insert().prefix_with('OR IGNORE').values(
+                    follower_id=a, followed_id=b))
+                follow_graph.add(a, b)
+        db.session.commit()
+
+        missing, extra = follow_graph.diff(load_follow_pairs())
+        broken = follow_graph.check_symmetry()
+        wrong_counts = sum(
+            1 for (user_id,) in user_sample
+            if follow_graph.followers_count(user_id) != sql_followers_count(user_id)
+        )
+        print(f"After 2000 random changes: missing {len(missing)}, only in graph {len(extra)}, "
+              f"asymmetric {broken}, wrong counts {wrong_counts}")
+
+    os.unlink(_db_file.name)
+    return 1 if missing or extra or broken or wrong_counts else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""Kontrollerar att bildbearbetningen (image_pipeline.py) inte gör animerade bilder till stillbilder.
+
+Seedar en temporär databas och laddar upp två postbilder genom /create_post: en GIF med två
+bildrutor och en vanlig JPEG. När bildbearbetningen är klar hämtas startsidan. JPEG:en ska ha
+srcset med WebP-varianter, GIF:en ska inte ha något srcset och ska fortfarande ha båda rutorna.
+
+Skriptet avslutar med felkod om något av det inte stämmer. Utan Pillow görs ingen
+bearbetning, och skriptet hoppar över kontrollen.
+
+    python benchmarks/image_variants.py
+"""
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Uppladdningarna hamnar i static/ under arbetskatalogen, så vi kör i en temporär katalog
+_work_dir = tempfile.mkdtemp()
+os.chdir(_work_dir)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_work_dir, 'bench.db')
+os.environ['UPLOAD_TMP_DIR'] = os.path.join(_work_dir, 'uploads')
+os.environ['PAGE_CACHE_DIR'] = os.path.join(_work_dir, 'page_cache')
+os.environ['SPOTIFY_SYNC_ENABLED'] = '0'
+# En tråd, så att bilderna bearbetas i den ordning de laddas upp
+os.environ['IMAGE_WORKERS'] = '1'
+
+from app import create_app, image_pipeline, Post  # noqa: E402
+
+PASSWORD = 'benchmark'
+WIDTH = 1000
+TIMEOUT = 30
+
+
+def gif_bytes(image_module):
+    frames = [image_module.new('RGB', (WIDTH, 600), color) for color in ((255, 0, 0), (0, 0, 255))]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, 'GIF', save_all=True, append_images=frames[1:], duration=200, loop=0)
+    return buffer.getvalue()
+
+
+def jpeg_bytes(image_module):
+    buffer = io.BytesIO()
+    image_module.new('RGB', (WIDTH, 600), (0, 128, 0)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def img_tag(html, name):
+    match = re.search(r'<img[^>]*post_pics/' + re.escape(name) + r'"[^>]*>', html)
+    return match.group(0) if match else None
+
+
+def main():
+    if not image_pipeline.available:
+        print("Pillow is not installed, skipped")
+        return 0
+    from PIL import Image
+
+    app = create_app()
+    client = app.test_client()
+    client.post('/register', data={'username': 'viewer', 'email': 'viewer@example.com',
+                                   'password': PASSWORD, 'confirm_password': PASSWORD})
+    client.post('/login', data={'username': 'viewer', 'password': PASSWORD})
+    for filename, data in (('animated.gif', gif_bytes(Image)), ('still.jpg', jpeg_bytes(Image))):
+        response = client.post('/create_post', data={'content': filename, 'post_picture': (io.BytesIO(data), filename)},
+                               content_type='multipart/form-data')
+        assert response.status_code == 302, response.status_code
+    with app.app_context():
+        names = {post.content: post.post_picture for post in Post.query.all()}
+
+    # JPEG:en laddades upp sist, när den är klar är GIF:en också det
+    deadline = time.monotonic() + TIMEOUT
+    while not image_pipeline.variants('post_pics', names['still.jpg']):
+        if time.monotonic() > deadline:
+            print(f"FAIL: no variants for the JPEG after {TIMEOUT} s")
+            return 1
+        time.sleep(0.05)
+
+    html = client.get('/').get_data(as_text=True)
+    failed = False
+    animated, still = img_tag(html, names['animated.gif']), img_tag(html, names['still.jpg'])
+    print(f"animated GIF: {'srcset' if animated and 'srcset=' in animated else 'no srcset'}")
+    print(f"still JPEG:   {'srcset' if still and 'srcset=' in still else 'no srcset'}")
+    if animated is None or 'srcset=' in animated:
+        print("FAIL: the animated GIF is served with still variants in srcset")
+        failed = True
+    if still is None or 'srcset=' not in still:
+        print("FAIL: the JPEG has no srcset")
+        failed = True
+    with Image.open(os.path.join('static', 'post_pics', names['animated.gif'])) as original:
+        frames = getattr(original, 'n_frames', 1)
+    print(f"animated GIF original: {frames} frames")
+    if frames != 2:
+        print("FAIL: the animated GIF original lost its frames")
+        failed = True
+
+    shutil.rmtree(_work_dir, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,342 @@
+"""Lasttest för de viktigaste sidorna och ändringarna, mot syntetisk data från synthetic_data.py.
+
+Seedar en temporär databas och kör samma scenarier på två sätt:
+
+  - med Flasks testklient, en request i taget och ett scenario i taget. Ger latensen utan
+    nätverk och antalet SQL-satser per request, som läses från /metrics (instrumentation.py).
+  - mot en riktig flertrådad server (Werkzeug) med --clients samtidiga klienter som
+    blandar alla scenarier under --duration sekunder. Ger latens och genomströmning.
+
+Fejk-Spotify (fake_spotify.py) startas och --spotify-users av användarna har Spotify
+kopplat, så bakgrundssynken arbetar mot den under testet, med --spotify-latency per anrop.
+Profiler och posts väljs snedfördelat, populära konton och posts besöks oftast.
+
+Resultatet sparas med --output och jämförs med en tidigare körning med --baseline.
+Skriptet avslutar med felkod om någon request misslyckas, om ett scenario gör fler
+SQL-satser per request än i baseline, eller om p50 eller genomströmningen för alla
+scenarier tillsammans (raden total) har blivit mer än --tolerance sämre. Ändringen per
+scenario visas också, men den varierar för mycket mellan körningar för att avgöra något.
+
+    python benchmarks/load_test.py --users 2000 --posts 20000 --output baseline.json
+    python benchmarks/load_test.py --users 2000 --posts 20000 --baseline baseline.json
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+
+from fake_spotify import FakeSpotifyServer  # noqa: E402
+
+fake = FakeSpotifyServer().start()
+
+_db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+_db_file.close()
+os.environ['DATABASE_URL'] = 'sqlite:///' + _db_file.name
+os.environ['SPOTIFY_API_URL'] = fake.api_url
+os.environ['SPOTIFY_TOKEN_URL'] = fake.token_url
+os.environ['SPOTIFY_SYNC_ENABLED'] = '1'
+os.environ['METRICS_ENABLED'] = '1'
+
+import requests  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+from app import create_app, recommender  # noqa: E402
+from synthetic_data import add_arguments, generate_from_args  # noqa: E402
+
+# (namn, URL-regeln i /metrics, inloggad)
+SCENARIOS = (
+    ('home', '/', True),
+    ('home anonymous', '/', False),
+    ('profile', '/profile/<username>', True),
+    ('post', '/post/<post_id>', True),
+    ('users', '/users', True),
+    ('like', '/post/<post_id>/like', True),
+    ('comment', '/post/<post_id>/comment', True),
+    ('follow', '/follow/<username>', True),
+    ('unfollow', '/unfollow/<username>', True),
+)
+VIEWERS = 8
+WARMUP = 10
+# Så många fler SQL-satser per request i snitt än i baseline räknas inte som en försämring,
+# eftersom t.ex. like växlar mellan att lägga till och ta bort
+QUERY_MARGIN = 0.5
+
+
+class Traffic:
+    """Slumpar vilka sidor som besöks, snedfördelat mot populära konton och posts."""
+
+    def __init__(self, data, seed):
+        self.data = data
+        self.rng = random.Random(seed)
+        self._user_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(data.usernames))))
+        self._post_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(data.post_ids))))
+        self._followed = []
+
+    def user(self):
+        return self.rng.choices(self.data.usernames, cum_weights=self._user_weights)[0]
+
+    def post(self):
+        return self.rng.choices(self.data.post_ids, cum_weights=self._post_weights)[0]
+
+    def request(self, scenario):
+        """(metod, sökväg, formulärdata) för en request i scenariot."""
+        if scenario in ('home', 'home anonymous'):
+            return 'GET', '/', None
+        if scenario == 'profile':
+            return 'GET', f'/profile/{self.user()}', None
+        if scenario == 'post':
+            return 'GET', f'/post/{self.post()}', None
+        if scenario == 'users':
+            return 'GET', '/users', None
+        if scenario == 'like':
+            return 'POST', f'/post/{self.post()}/like', None
+        if scenario == 'comment':
+            return 'POST', f'/post/{self.post()}/comment', {'content': 'Load test comment'}
+        if scenario == 'follow':
+            # Vem som helst, inte bara de populära, så att det mest blir nya follows
+            username = self.rng.choice(self.data.usernames)
+            self._followed.append(username)
+            return 'GET', f'/follow/{username}', None
+        username = self._followed.pop() if self._followed else self.rng.choice(self.data.usernames)
+        return 'GET', f'/unfollow/{username}', None
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def summary(latencies, elapsed, errors, queries=None):
+    latencies = sorted(latencies)
+    result = {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'errors': errors,
+    }
+    if queries is not None:
+        result['queries'] = queries
+    return result
+
+
+def metric_total(text, name, route):
+    pattern = re.compile(r'^' + name + r'\{.*route="' + re.escape(route) + r'".*\} (\S+)$', re.MULTILINE)
+    return sum(float(value) for value in pattern.findall(text))
+
+
+def viewer_names(data):
+    # Några vanliga användare, inte de mest populära som har tusentals följare
+    rng = random.Random(0)
+    return rng.sample(data.usernames[len(data.usernames) // 10:], VIEWERS)
+
+
+def run_test_client(app, data, args):
+    viewers = []
+    for username in viewer_names(data):
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': data.password})
+        viewers.append(client)
+    anonymous = app.test_client()
+
+    results = {}
+    all_latencies, total_elapsed, total_errors = [], 0.0, 0
+    for index, (name, rule, logged_in) in enumerate(SCENARIOS):
+        traffic = Traffic(data, args.seed + index)
+
+        def send(i):
+            client = viewers[i % len(viewers)] if logged_in else anonymous
+            method, path, form = traffic.request(name)
+            started = time.perf_counter()
+            response = client.open(path, method=method, data=form)
+            return time.perf_counter() - started, response.status_code >= 400
+
+        for i in range(WARMUP):
+            send(i)
+        before = anonymous.get('/metrics').get_data(as_text=True)
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for i in range(args.requests):
+            latency, failed = send(i)
+            latencies.append(latency)
+            errors += failed
+        elapsed = time.perf_counter() - started
+        after = anonymous.get('/metrics').get_data(as_text=True)
+        statements = (metric_total(after, 'app_request_sql_statements_sum', rule)
+                      - metric_total(before, 'app_request_sql_statements_sum', rule))
+        count = (metric_total(after, 'app_request_sql_statements_count', rule)
+                 - metric_total(before, 'app_request_sql_statements_count', rule))
+        results[name] = summary(latencies, elapsed, errors, statements / count if count else 0.0)
+        all_latencies += latencies
+        total_elapsed += elapsed
+        total_errors += errors
+    results['total'] = summary(all_latencies, total_elapsed, total_errors)
+    return results
+
+
+def run_server(app, data, args):
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    names = viewer_names(data)
+    latencies = {name: [] for name, _, _ in SCENARIOS}
+    errors = dict.fromkeys(latencies, 0)
+    lock = threading.Lock()
+
+    def client(n):
+        viewer = requests.Session()
+        viewer.post(f'{base_url}/login', data={'username': names[n % len(names)], 'password': data.password},
+                    allow_redirects=False)
+        anonymous = requests.Session()
+        traffic = Traffic(data, args.seed + 100 + n)
+        # Klienterna börjar på olika scenarier, så att alla inte gör samma sak samtidigt
+        scenarios = itertools.islice(itertools.cycle(SCENARIOS), n, None)
+        while time.monotonic() < stop_at:
+            name, _, logged_in = next(scenarios)
+            method, path, form = traffic.request(name)
+            started = time.perf_counter()
+            try:
+                response = (viewer if logged_in else anonymous).request(
+                    method, base_url + path, data=form, allow_redirects=False)
+                failed = response.status_code >= 400
+            except requests.RequestException:
+                failed = True
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies[name].append(elapsed)
+                errors[name] += failed
+
+    try:
+        stop_at = time.monotonic() + args.duration
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(args.clients)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+    finally:
+        server.shutdown()
+    results = {name: summary(latencies[name], elapsed, errors[name]) for name in latencies}
+    results['total'] = summary(list(itertools.chain(*latencies.values())), elapsed, sum(errors.values()))
+    return results
+
+
+def report(title, results, baseline):
+    print(f"\n{title}")
+    print(f"{'scenario':<16} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>9} {'queries':>8} {'errors':>7}")
+    for name, result in results.items():
+        queries = f"{result['queries']:8.1f}" if 'queries' in result else f"{'-':>8}"
+        line = (f"{name:<16} {result['p50_ms']:9.2f} {result['p99_ms']:9.2f} {result['rps']:9.1f} "
+                f"{queries} {result['errors']:7d}")
+        if name in baseline:
+            old = baseline[name]
+            line += f"   p50 {change(result['p50_ms'], old['p50_ms'])}, req/s {change(result['rps'], old['rps'])}"
+        print(line)
+
+
+def change(new, old):
+    return f"{(new - old) / old:+.0%}" if old else 'n/a'
+
+
+def regressions(mode, results, baseline, tolerance):
+    failures = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if 'queries' in result and 'queries' in old and result['queries'] > old['queries'] + QUERY_MARGIN:
+            failures.append(f"{mode} {name}: {result['queries']:.1f} queries per request, was {old['queries']:.1f}")
+        if name != 'total':
+            continue
+        if old['p50_ms'] and result['p50_ms'] > old['p50_ms'] * (1 + tolerance):
+            failures.append(f"{mode} {name}: p50 {result['p50_ms']:.2f} ms, was {old['p50_ms']:.2f} ms")
+        if result['rps'] < old['rps'] * (1 - tolerance):
+            failures.append(f"{mode} {name}: {result['rps']:.1f} req/s, was {old['rps']:.1f}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.set_defaults(spotify_users=0.1)
+    parser.add_argument('--mode', choices=('test-client', 'server', 'both'), default='both')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario med testklienten')
+    parser.add_argument('--clients', type=int, default=8, help='Samtidiga klienter mot servern')
+    parser.add_argument('--duration', type=float, default=10.0, help='Sekunder mot servern')
+    parser.add_argument('--spotify-latency', type=float, default=0.05, help='Fejk-Spotifys fördröjning per anrop')
+    parser.add_argument('--output', help='Sparar resultatet som JSON')
+    parser.add_argument('--baseline', help='JSON från en tidigare körning att jämföra med')
+    # Två likadana körningar på samma maskin kan skilja 30 % i latens, så standardvärdet fångar
+    # bara stora försämringar. Antalet queries jämförs nästan exakt, se QUERY_MARGIN.
+    parser.add_argument('--tolerance', type=float, default=0.5, help='Tillåten försämring av p50 och req/s')
+    args = parser.parse_args()
+
+    fake.httpd.RequestHandlerClass.latency = args.spotify_latency
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    app = create_app()
+    try:
+        with app.app_context():
+            started = time.perf_counter()
+            data = generate_from_args(args)
+            # Förslagen på /users byggs annars i bakgrunden under testet, och /users gör fler
+            # queries när de är klara
+            recommender.rebuild()
+            print(f"Seeded and built suggestions in {time.perf_counter() - started:.1f} s")
+
+        config = {key: getattr(args, key) for key in (
+            'users', 'posts', 'follows', 'likes', 'comments', 'days', 'follow_exponent', 'spotify_users', 'seed',
+            'requests', 'clients', 'duration', 'spotify_latency')}
+        if baseline and baseline.get('config') != config:
+            print("Warning: the baseline was run with other arguments, the numbers may not be comparable")
+        output = {'config': config}
+        if args.mode in ('test-client', 'both'):
+            output['test_client'] = run_test_client(app, data, args)
+            report('Flask test client, one request at a time', output['test_client'], baseline.get('test_client', {}))
+        if args.mode in ('server', 'both'):
+            output['server'] = run_server(app, data, args)
+            report(f'Werkzeug server, {args.clients} concurrent clients for {args.duration:.0f} s',
+                   output['server'], baseline.get('server', {}))
+        spotify_calls = sum(count for path, count in fake.stats.items() if path.startswith('/v1/'))
+        print(f"\nSpotify calls by the background sync: {spotify_calls}")
+    finally:
+        fake.stop()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(_db_file.name + suffix):
+                os.unlink(_db_file.name + suffix)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+    failures = [
+        f"{mode} {name}: {result['errors']} failed requests"
+        for mode in ('test_client', 'server') for name, result in output.get(mode, {}).items()
+        if result['errors'] and name != 'total'
+    ]
+    for mode in ('test_client', 'server'):
+        failures += regressions(mode, output.get(mode, {}), baseline.get(mode, {}), args.tolerance)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
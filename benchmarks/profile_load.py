@@ -0,0 +1,148 @@
+"""Lasttest för profilsidan medan Spotify är långsamt.
+
+Startar fejk-Spotify (fake_spotify.py) och appen i en flertrådad server, med
+bakgrundssynken igång mot fejkservern. Sedan hämtar ett antal klienttrådar profilsidor
+så fort de kan, först med en snabb Spotify och sedan med --latency sekunders fördröjning
+per anrop. Profilsidan läser bara synkad data ur databasen, så genomströmningen ska inte
+sjunka när Spotify blir långsamt. Skriptet avslutar med felkod om den gör det.
+
+    python benchmarks/profile_load.py --latency 0.5 --clients 16 --duration 5
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+
+from fake_spotify import FakeSpotifyServer  # noqa: E402
+
+fake = FakeSpotifyServer().start()
+
+_db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+_db_file.close()
+os.environ['DATABASE_URL'] = 'sqlite:///' + _db_file.name
+os.environ['SPOTIFY_API_URL'] = fake.api_url
+os.environ['SPOTIFY_TOKEN_URL'] = fake.token_url
+# Alla användare är alltid "due", så att synken hela tiden väntar på Spotify under testet
+os.environ['SPOTIFY_SYNC_ENABLED'] = '1'
+os.environ['SPOTIFY_SYNC_INTERVAL'] = '0'
+os.environ['SPOTIFY_SYNC_SCAN_INTERVAL'] = '1'
+
+import requests  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+from app import create_app, db, User, Post  # noqa: E402
+
+USERS = 20
+POSTS_PER_USER = 10
+# Genomströmningen med långsamt Spotify får inte vara lägre än så här mycket av den snabba
+MIN_RATIO = 0.5
+
+
+def seed(app):
+    with app.app_context():
+        for i in range(USERS):
+            user = User(
+                username=f'user{i}', email=f'user{i}@example.com', password='pw',
+                spotify_access_token=f'token{i}', spotify_refresh_token='refresh',
+                spotify_user_id=f'spotify{i}',
+                spotify_token_expiry=datetime.utcnow() + timedelta(hours=1)
+            )
+            db.session.add(user)
+            db.session.flush()
+            for j in range(POSTS_PER_USER):
+                db.session.add(Post(userId=user.userId, content=f'post {j}', created_at=datetime.utcnow()))
+        db.session.commit()
+
+
+def run_load(base_url, clients, duration):
+    """Returnerar (antal requests, fel, latenser) under duration sekunder."""
+    stop_at = time.monotonic() + duration
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client(n):
+        session = requests.Session()
+        i = n
+        while time.monotonic() < stop_at:
+            started = time.monotonic()
+            response = session.get(f'{base_url}/profile/user{i % USERS}')
+            elapsed = time.monotonic() - started
+            with lock:
+                if response.status_code == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies), errors[0], sorted(latencies)
+
+
+def report(label, duration, result):
+    count, errors, latencies = result
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0
+    rate = count / duration
+    print(f'{label:<28} {rate:8.1f} req/s  p50 {p50:6.1f} ms  p95 {p95:6.1f} ms  errors {errors}')
+    return rate
+
+
+def spotify_calls():
+    return sum(count for path, count in fake.stats.items() if path.startswith('/v1/'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.5, help='Spotifys fördröjning per anrop i sekunder')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+
+    app = create_app()
+    seed(app)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    # Första requesten startar bakgrundssynken
+    requests.get(f'{base_url}/users')
+
+    try:
+        results = {}
+        for label, latency in (('Spotify fast', 0.0), (f'Spotify +{args.latency * 1000:.0f} ms', args.latency)):
+            fake.httpd.RequestHandlerClass.latency = latency
+            calls_before = spotify_calls()
+            rate = report(label, args.duration, run_load(base_url, args.clients, args.duration))
+            results[label] = (rate, spotify_calls() - calls_before)
+    finally:
+        server.shutdown()
+        fake.stop()
+        os.unlink(_db_file.name)
+
+    (fast_rate, _), (slow_rate, slow_calls) = results.values()
+    print(f'Spotify calls by the background sync during the slow run: {slow_calls}')
+    if slow_calls == 0:
+        print('FAIL: the background sync never called Spotify, the test measured nothing')
+        return 1
+    if slow_rate < fast_rate * MIN_RATIO:
+        print(f'FAIL: profile throughput dropped to {slow_rate / fast_rate:.0%} with slow Spotify')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""Kollar att läsningar går till läsrepliken och att man ser sina egna skrivningar.
+
+Kör appen mot två SQLite-filer, en primär och en replika som kopieras med
+`flask sync-replica`. Räknar vilka SQL-satser som går till vilken databas och kollar att:
+
+    1. sidor som bara läser (index, profile, view_post, users) frågar repliken
+    2. efter en like frågar nästa sida den primära, och visar liken fast repliken inte har den
+    3. när DB_REPLICA_STICKY_SECONDS har gått läses det från repliken igen
+
+Skriptet avslutar med felkod om något av det inte stämmer.
+
+    python benchmarks/replica_routing.py
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+_tmp = tempfile.mkdtemp()
+PRIMARY = os.path.join(_tmp, 'primary.db')
+REPLICA_FILE = os.path.join(_tmp, 'replica.db')
+STICKY_SECONDS = 1.0
+os.environ['DATABASE_URL'] = 'sqlite:///' + PRIMARY
+os.environ['DATABASE_REPLICA_URL'] = 'sqlite:///' + REPLICA_FILE
+os.environ['DB_REPLICA_STICKY_SECONDS'] = str(STICKY_SECONDS)
+os.environ['SPOTIFY_SYNC_ENABLED'] = '0'
+
+from sqlalchemy import event  # noqa: E402
+
+from app import create_app, db, User, Post  # noqa: E402
+from db_engine import REPLICA  # noqa: E402
+
+PASSWORD = 'benchmark'
+
+
+def main():
+    app = create_app()
+    app.logger.disabled = True
+    with app.app_context():
+        alice = User(username='alice', email='alice@example.com', password=PASSWORD)
+        bob = User(username='bob', email='bob@example.com', password=PASSWORD)
+        db.session.add_all([alice, bob])
+        db.session.flush()
+        post = Post(userId=alice.userId, content='hello from the primary')
+        db.session.add(post)
+        db.session.commit()
+        post_id = post.postId
+        engines = {'primary': db.engines[None], 'replica': db.engines[REPLICA]}
+
+    result = app.test_cli_runner().invoke(args=['sync-replica'])
+    print(result.output.strip())
+
+    # Bara satser från requesterna. Följargrafen kollar sin version mot den primära i en egen tråd.
+    statements = Counter()
+    request_thread = threading.get_ident()
+    for label, engine in engines.items():
+        event.listen(
+            engine, 'before_cursor_execute',
+            lambda *args, label=label: threading.get_ident() == request_thread and statements.update([label])
+        )
+
+    def fetch(http, path):
+        statements.clear()
+        response = http.get(path)
+        return response, dict(statements)
+
+    failures = []
+
+    def check(label, ok, detail):
+        print(f"{'ok  ' if ok else 'FAIL'} {label:<48} {detail}")
+        if not ok:
+            failures.append(label)
+
+    anonymous = app.test_client()
+    for path in ('/', '/users', '/profile/alice', f'/post/{post_id}'):
+        response, used = fetch(anonymous, path)
+        ok = response.status_code == 200 and not used.get('primary') and used.get('replica')
+        check(f"anonymous GET {path.replace(str(post_id), '<id>')}", ok, used)
+
+    http = app.test_client()
+    http.post('/login', data={'username': 'bob', 'password': PASSWORD})
+    response, used = fetch(http, f'/post/{post_id}')
+    check('logged in GET /post before writing', not used.get('primary') and used.get('replica'), used)
+
+    statements.clear()
+    http.post(f'/post/{post_id}/like')
+    used = dict(statements)
+    check('POST like writes to the primary', used.get('primary') and not used.get('replica'), used)
+
+    response, used = fetch(http, f'/post/{post_id}')
+    check('GET /post right after the like', not used.get('replica') and b'1 Likes' in response.data, used)
+
+    time.sleep(STICKY_SECONDS + 0.1)
+    response, used = fetch(http, f'/post/{post_id}')
+    # Repliken har inte synkats sedan liken, så sidan ska visa den gamla siffran
+    check(f'GET /post after {STICKY_SECONDS:.0f} s', not used.get('primary') and b'0 Likes' in response.data, used)
+
+    app.test_cli_runner().invoke(args=['sync-replica'])
+    response, used = fetch(http, f'/post/{post_id}')
+    check('GET /post after sync-replica', not used.get('primary') and b'1 Likes' in response.data, used)
+
+    for engine in engines.values():
+        engine.dispose()
+    for path in (PRIMARY, REPLICA_FILE):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+    os.rmdir(_tmp)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
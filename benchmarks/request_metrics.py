@@ -0,0 +1,202 @@
+"""Kontrollerar mätningen per request (instrumentation.py) och vad den kostar.
+
+Seedar en temporär databas och hämtar några sidor om och om igen, omväxlande med och utan
+METRICS_ENABLED. För varje route jämförs antalet SQL-satser som /metrics visar med en egen
+räknare på engine. Likes görs också genom skrivkön (DB_WRITE_QUEUE), där satserna körs i
+skrivtråden men ska räknas till requesten. Sedan görs anrop mot fejk-Spotify (fake_spotify.py) på den delade
+sessionen, både i och utanför en request, och de jämförs med app_spotify_requests_total.
+
+Skriptet avslutar med felkod om antalet SQL-satser eller Spotify-anrop inte stämmer, eller
+om en request tar mer än MAX_OVERHEAD längre tid med mätningen påslagen.
+
+    python benchmarks/request_metrics.py --rounds 300
+"""
+import argparse
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+
+from fake_spotify import FakeSpotifyServer  # noqa: E402
+
+SPOTIFY_LATENCY = 0.02
+fake = FakeSpotifyServer(latency=SPOTIFY_LATENCY).start()
+
+_db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+_db_file.close()
+os.environ['DATABASE_URL'] = 'sqlite:///' + _db_file.name
+os.environ['SPOTIFY_API_URL'] = fake.api_url
+os.environ['SPOTIFY_TOKEN_URL'] = fake.token_url
+os.environ['SPOTIFY_SYNC_ENABLED'] = '0'
+os.environ['METRICS_ENABLED'] = '1'
+
+from sqlalchemy import event  # noqa: E402
+
+from app import app, create_app, db, request_metrics, spotify_clients, Post, User  # noqa: E402
+
+PASSWORD = 'benchmark'
+# Så mycket längre får en request ta med mätningen, i andel och i mikrosekunder
+MAX_OVERHEAD = 0.10
+MAX_OVERHEAD_US = 100
+SPOTIFY_CALLS = 20
+WRITES = 50
+
+
+def seed():
+    viewer = User(username='viewer', email='viewer@example.com', password=PASSWORD)
+    authors = [User(username=f'author{i}', email=f'author{i}@example.com') for i in range(5)]
+    db.session.add(viewer)
+    db.session.add_all(authors)
+    for author in authors:
+        viewer.followed.append(author)
+    db.session.flush()
+    for i in range(50):
+        db.session.add(Post(userId=authors[i % len(authors)].userId, content=f'post {i}'))
+    db.session.commit()
+    return Post.query.first().postId
+
+
+def metric(text, name, **labels):
+    """Summan av alla rader för name med labels, ur Prometheus-texten."""
+    total = 0.0
+    for line in text.splitlines():
+        match = re.match(r'^(\w+)\{(.*)\} (\S+)$', line)
+        if not match or match.group(1) != name:
+            continue
+        found = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', match.group(2)))
+        if all(found.get(key) == str(value) for key, value in labels.items()):
+            total += float(match.group(3))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=300)
+    args = parser.parse_args()
+
+    create_app()
+    with app.app_context():
+        post_id = seed()
+        engine = db.engine
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'viewer', 'password': PASSWORD})
+    routes = {
+        '/': '/',
+        '/profile/<username>': '/profile/author0',
+        '/post/<post_id>': f'/post/{post_id}',
+        '/users': '/users',
+    }
+    # Värmer upp mallar och cachar
+    for path in routes.values():
+        client.get(path)
+
+    # Bara satser från requesterna, som /metrics. Följargrafen kollar sin version i en egen tråd.
+    statements = [0]
+    request_thread = threading.get_ident()
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == request_thread:
+            statements[0] += 1
+
+    failed = False
+    times = {(rule, enabled): [] for rule in routes for enabled in (True, False)}
+    expected = dict.fromkeys(routes, 0)
+    before = client.get('/metrics').get_data(as_text=True)
+    event.listen(engine, 'before_cursor_execute', count)
+    for _ in range(args.rounds):
+        for rule, path in routes.items():
+            for enabled in (True, False):
+                app.config['METRICS_ENABLED'] = enabled
+                statements[0] = 0
+                started = time.perf_counter()
+                response = client.get(path)
+                times[(rule, enabled)].append((time.perf_counter() - started) * 1e6)
+                assert response.status_code == 200, (path, response.status_code)
+                if enabled:
+                    expected[rule] += statements[0]
+    event.remove(engine, 'before_cursor_execute', count)
+    app.config['METRICS_ENABLED'] = True
+    after = client.get('/metrics').get_data(as_text=True)
+
+    print(f"{'route':<22} {'off':>9} {'on':>9} {'overhead':>9}  SQL statements")
+    for rule in routes:
+        off, on = statistics.median(times[(rule, False)]), statistics.median(times[(rule, True)])
+        counted = (metric(after, 'app_request_sql_statements_sum', route=rule)
+                   - metric(before, 'app_request_sql_statements_sum', route=rule))
+        print(f"{rule:<22} {off:7.0f}µs {on:7.0f}µs {on - off:7.0f}µs  {counted:.0f} in /metrics, {expected[rule]} counted")
+        if counted != expected[rule]:
+            print(f"FAIL: {rule} shows {counted:.0f} SQL statements, expected {expected[rule]}")
+            failed = True
+        if on - off > max(MAX_OVERHEAD * off, MAX_OVERHEAD_US):
+            print(f"FAIL: {rule} is {on - off:.0f} µs slower with instrumentation")
+            failed = True
+
+    # Likes genom skrivkön. Satserna från skrivtråden räknas med, men inte en annan requests.
+    app.config['DB_WRITE_QUEUE'] = True
+    rule = '/post/<post_id>/like'
+    writer_statements = [0]
+
+    def count_writes(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == request_thread:
+            statements[0] += 1
+        elif threading.current_thread().name == 'db-writer':
+            writer_statements[0] += 1
+
+    statements[0] = 0
+    before = client.get('/metrics').get_data(as_text=True)
+    event.listen(engine, 'before_cursor_execute', count_writes)
+    for _ in range(WRITES):
+        response = client.post(f'/post/{post_id}/like')
+        assert response.status_code == 302, response.status_code
+    event.remove(engine, 'before_cursor_execute', count_writes)
+    after = client.get('/metrics').get_data(as_text=True)
+    app.config['DB_WRITE_QUEUE'] = False
+    counted = (metric(after, 'app_request_sql_statements_sum', route=rule)
+               - metric(before, 'app_request_sql_statements_sum', route=rule))
+    expected_writes = statements[0] + writer_statements[0]
+    print(f"{rule}: {counted:.0f} SQL statements in /metrics, {expected_writes} counted "
+          f"({writer_statements[0]} in the write queue)")
+    if counted != expected_writes or not writer_statements[0]:
+        print(f"FAIL: {rule} shows {counted:.0f} SQL statements through the write queue, expected {expected_writes}")
+        failed = True
+
+    # Spotify-anrop på den delade sessionen, hälften inuti en request
+    session = spotify_clients.session
+    started = time.perf_counter()
+    in_request = 0
+    for i in range(SPOTIFY_CALLS):
+        if i % 2:
+            request_metrics.start_request()
+            session.get(fake.api_url + 'me', headers={'Authorization': 'Bearer token'})
+            in_request += request_metrics.finish_request('benchmark', 'GET', 200).spotify_calls
+        else:
+            session.get(fake.api_url + 'me', headers={'Authorization': 'Bearer token'})
+    elapsed = time.perf_counter() - started
+    text = client.get('/metrics').get_data(as_text=True)
+    calls = metric(text, 'app_spotify_requests_total', status=200)
+    traced = metric(text, 'app_spotify_request_duration_seconds_sum')
+    print(f"Spotify: {calls:.0f} calls traced, {in_request} during a request, "
+          f"{traced * 1000:.0f} ms traced of {elapsed * 1000:.0f} ms")
+    if calls != SPOTIFY_CALLS or in_request != SPOTIFY_CALLS // 2:
+        print(f"FAIL: expected {SPOTIFY_CALLS} Spotify calls, {SPOTIFY_CALLS // 2} during a request")
+        failed = True
+    if not SPOTIFY_CALLS * SPOTIFY_LATENCY <= traced <= elapsed:
+        print("FAIL: traced Spotify time is outside the measured time")
+        failed = True
+
+    fake.stop()
+    os.unlink(_db_file.name)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""Mäter hur lång tid en kall start av appen tar.
+
+Startar en ny Python-process per körning och mäter tre steg: `import app`, create_app()
+och den första requesten mot /. Det är vad en ny arbetarprocess eller en testkörning
+betalar innan den kan göra något.
+
+Tunga valfria beroenden (spotipy, requests, Pillow, NumPy, SciPy, PostgreSQL-dialekten) ska bara
+importeras när de används. Skriptet avslutar med felkod om någon av dem är importerad
+efter den första requesten, eller om medianen för hela starten är över --max-ms.
+
+    python benchmarks/startup_time.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LAZY_MODULES = ('spotipy', 'requests', 'PIL', 'numpy', 'scipy', 'sqlalchemy.dialects.postgresql')
+
+WORKER = '''
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+app.app.test_client().get('/')
+served = time.perf_counter()
+print(json.dumps({
+    'import': imported - started,
+    'create_app': created - imported,
+    'first_request': served - created,
+    'loaded': [name for name in %r if name in sys.modules],
+}))
+''' % (LAZY_MODULES,)
+
+
+def run_once():
+    db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    db_file.close()
+    try:
+        output = subprocess.run(
+            [sys.executable, '-c', WORKER], cwd=ROOT,
+            env=dict(os.environ, SPOTIFY_SYNC_ENABLED='0', DATABASE_URL='sqlite:///' + db_file.name),
+            capture_output=True, text=True, check=True
+        ).stdout
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_file.name + suffix):
+                os.unlink(db_file.name + suffix)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=2000, help='Högsta tillåtna median för hela starten')
+    args = parser.parse_args()
+
+    results = [run_once() for _ in range(args.runs)]
+    for phase in ('import', 'create_app', 'first_request'):
+        times = [result[phase] * 1000 for result in results]
+        print(f"{phase:<14} median {statistics.median(times):7.1f} ms  min {min(times):7.1f} ms")
+    total = statistics.median(sum(result[phase] for phase in ('import', 'create_app', 'first_request'))
+                              for result in results) * 1000
+    print(f"{'total':<14} median {total:7.1f} ms")
+
+    loaded = sorted({name for result in results for name in result['loaded']})
+    if loaded:
+        print(f"FAIL: imported at startup: {', '.join(loaded)}")
+        return 1
+    if total > args.max_ms:
+        print(f"FAIL: startup took {total:.0f} ms, more than {args.max_ms:.0f} ms")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
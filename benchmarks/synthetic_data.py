@@ -0,0 +1,185 @@
+"""Syntetisk data för lasttester: användare, en snedfördelad följargraf och posts med likes och kommentarer.
+
+Allt slumpas från ett frö, så samma argument ger samma data (tiderna räknas bakåt från när
+den genererades). Fördelningarna är snedfördelade som i verkligheten:
+
+  - kontona rangordnas efter popularitet, och vem man följer dras med vikten 1/rank^exponent
+    (Zipf), så att några få konton har väldigt många följare
+  - hur många man själv följer, och hur många likes och kommentarer en post får, dras från
+    en Paretofördelning med medelvärdet --follows, --likes respektive --comments
+  - populära konton skriver fler posts, och posts sprids jämnt över de senaste --days dagarna
+
+Efter inläsningen räknas like_count och comment_count om, och tidslinjerna byggs som
+fan-out hade byggt dem. Alla får samma lösenord (PASSWORD). En andel av användarna
+(--spotify-users) har en Spotify-token, så att bakgrundssynken har något att göra om appen
+pekar på fejk-Spotify (fake_spotify.py).
+
+Används av load_test.py, eller fristående mot en tom databas:
+
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/synthetic_data.py --users 2000 --posts 50000
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from sqlalchemy import insert  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+PASSWORD = 'benchmark'
+GENRES = ['Rock', 'Pop', 'Metal', 'EDM', 'Hip Hop', 'Classical', 'Jazz', 'Country', 'R&B', 'Indie']
+CHUNK = 20000
+
+
+class Dataset:
+    """Det som ett lasttest behöver veta om den genererade datan."""
+
+    def __init__(self, usernames, post_ids, password):
+        # Populärast först
+        self.usernames = usernames
+        self.post_ids = post_ids
+        self.password = password
+
+
+def _pareto(rng, mean, limit):
+    # paretovariate(1.5) har medelvärdet 3
+    return min(limit, int(rng.paretovariate(1.5) * mean / 3))
+
+
+def _insert(session, model, rows):
+    for start in range(0, len(rows), CHUNK):
+        session.execute(insert(model), rows[start:start + CHUNK])
+
+
+def generate(users=1000, posts=10000, follows=20, likes=5, comments=1, days=30,
+             follow_exponent=1.0, spotify_users=0.0, seed=1):
+    """Fyller databasen i appens app_context och returnerar ett Dataset."""
+    from app import (
+        db, followers, follow_graph, ranking, reconcile_post_counters, reconcile_follower_counts, rebuild_timelines,
+        User, Post, Like, Comment, UserGenre
+    )
+
+    rng = random.Random(seed)
+    user_ids = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(users)]
+    usernames = [f'user{i}' for i in range(users)]
+    # Index 0 är populärast. Vikterna används både för follows och för vem som skriver mest.
+    popularity = list(itertools.accumulate(1 / (rank + 1) ** follow_exponent for rank in range(users)))
+    activity = list(itertools.accumulate(1 / (rank + 1) ** (follow_exponent / 2) for rank in range(users)))
+
+    # Hashen är långsam med flit, så alla delar på samma
+    password_hash = generate_password_hash(PASSWORD)
+    expiry = datetime.utcnow() + timedelta(days=365)
+    user_rows = []
+    for i, user_id in enumerate(user_ids):
+        row = {'userId': user_id, 'username': usernames[i], 'email': f'{usernames[i]}@example.com',
+               'password': password_hash, 'bio': f'Synthetic user {i}'}
+        if rng.random() < spotify_users:
+            row.update(spotify_access_token=f'token-{i}', spotify_refresh_token='refresh',
+                       spotify_user_id=f'spotify-{i}', spotify_token_expiry=expiry)
+        user_rows.append(row)
+    _insert(db.session, User, user_rows)
+    _insert(db.session, UserGenre, [
+        {'userId': user_id, 'genre': genre}
+        for user_id in user_ids for genre in rng.sample(GENRES, rng.randint(0, 2))
+    ])
+
+    follow_rows = []
+    for i, user_id in enumerate(user_ids):
+        wanted = _pareto(rng, follows, users - 1)
+        targets = set()
+        # Några extra dragningar, eftersom dubbletter och en själv sorteras bort
+        for index in rng.choices(range(users), cum_weights=popularity, k=wanted + wanted // 4 + 1):
+            if index != i:
+                targets.add(index)
+        follow_rows += [{'follower_id': user_id, 'followed_id': user_ids[index]} for index in list(targets)[:wanted]]
+    _insert(db.session, followers, follow_rows)
+
+    now = datetime.utcnow()
+    span = days * 24 * 3600
+    post_rows, like_rows, comment_rows = [], [], []
+    for author in rng.choices(range(users), cum_weights=activity, k=posts):
+        post_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        created_at = now - timedelta(seconds=rng.uniform(0, span))
+        post_rows.append({'postId': post_id, 'userId': user_ids[author], 'content': f'Synthetic post by user{author}',
+                          'created_at': created_at})
+        for liker in rng.sample(range(users), _pareto(rng, likes, users)):
+            like_rows.append({'likeId': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                              'userId': user_ids[liker], 'postId': post_id})
+        for _ in range(_pareto(rng, comments, 200)):
+            comment_rows.append({
+                'commentId': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                'userId': user_ids[rng.randrange(users)], 'postId': post_id, 'content': 'Synthetic comment',
+                'created_at': created_at + timedelta(seconds=rng.uniform(0, (now - created_at).total_seconds())),
+            })
+    _insert(db.session, Post, post_rows)
+    _insert(db.session, Like, like_rows)
+    _insert(db.session, Comment, comment_rows)
+    db.session.commit()
+
+    reconcile_post_counters()
+    reconcile_follower_counts()
+    rebuild_timelines()
+    # Allt ovan lades in direkt i tabellerna, förbi grafen och poängen i minnet
+    follow_graph.reset()
+    ranking.reset()
+
+    # De mest gillade posts först, så att ett lasttest kan välja dem snedfördelat
+    post_ids = [row['postId'] for row in post_rows]
+    like_totals = {}
+    for row in like_rows:
+        like_totals[row['postId']] = like_totals.get(row['postId'], 0) + 1
+    post_ids.sort(key=lambda post_id: -like_totals.get(post_id, 0))
+    print(f"Generated {users} users, {len(follow_rows)} follows, {posts} posts, "
+          f"{len(like_rows)} likes and {len(comment_rows)} comments")
+    return Dataset(usernames, post_ids, PASSWORD)
+
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--follows', type=float, default=20, help='Medelantal konton som varje användare följer')
+    parser.add_argument('--likes', type=float, default=5, help='Medelantal likes per post')
+    parser.add_argument('--comments', type=float, default=1, help='Medelantal kommentarer per post')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--follow-exponent', type=float, default=1.0, help='Zipf-exponenten för vem som blir följd')
+    parser.add_argument('--spotify-users', type=float, default=0.0, help='Andel användare med Spotify kopplat')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def generate_from_args(args):
+    return generate(
+        users=args.users, posts=args.posts, follows=args.follows, likes=args.likes, comments=args.comments,
+        days=args.days, follow_exponent=args.follow_exponent, spotify_users=args.spotify_users, seed=args.seed
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    os.environ.setdefault('SPOTIFY_SYNC_ENABLED', '0')
+    from app import create_app, User
+
+    app = create_app()
+    with app.app_context():
+        # Syntetisk data ska inte blandas med riktiga användare
+        if User.query.first() is not None:
+            print(f"{app.config['SQLALCHEMY_DATABASE_URI']} already has users, point DATABASE_URL at an empty database")
+            return 1
+        started = time.perf_counter()
+        generate_from_args(args)
+        print(f"Done in {time.perf_counter() - started:.1f} s, every user has the password '{PASSWORD}'")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""Mäter förslagen på vilka man kan följa (recommendations.py).
+
+Seedar en temporär databas med --users användare med genre, favoritlåtar, Spotify-topplåtar
+och follows, där artisterna är snedfördelade som i verkligheten. Sedan mäts:
+
+  - ett helt bygge med NumPy/SciPy (om de finns) och med det inverterade indexet i ren Python
+  - att jämföra en användare mot alla andra en i taget, utan index, som referens
+  - en ändrad profil som hittas med pull_changes(), som när den ändrats i en annan process,
+    och räknas om med apply_pending()
+
+Skriptet avslutar med felkod om de två byggena ger olika listor, om pull_changes() inte hittar
+exakt de ändrade profilerna, eller om listorna efter slumpade ändringar skiljer sig från att
+räkna om allt från början.
+
+    python benchmarks/who_to_follow.py --users 5000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+_db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+_db_file.close()
+os.environ['DATABASE_URL'] = 'sqlite:///' + _db_file.name
+os.environ['SPOTIFY_SYNC_ENABLED'] = '0'
+
+from sqlalchemy import delete, insert  # noqa: E402
+
+from app import (  # noqa: E402
+    create_app, db, followers, follow_graph, load_taste_profiles, load_taste_changes,
+    User, SpotifyTopTrack, FavoriteSong, UserGenre
+)
+from recommendations import NUMPY_AVAILABLE, Recommender  # noqa: E402
+
+GENRES = ['Pop', 'Rock', 'Hip Hop', 'Jazz', 'Classical', 'Electronic', 'R&B', 'Country', 'Metal', 'Indie']
+TOP_N = 20
+# Så många användare jämförs mot alla andra utan index, det tar för lång tid för alla
+NAIVE_SAMPLE = 50
+
+
+def random_profile(rng, user_id, artists):
+    """Rader för user_genres och user_favorite_songs."""
+    genres = [{'userId': user_id, 'genre': genre} for genre in rng.sample(GENRES, rng.randint(0, 2))]
+    songs = [
+        {'userId': user_id, 'position': position, 'title': f'song {rng.randrange(1000)}',
+         'artist': pick_artist(rng, artists), 'icon': '🎵'}
+        for position in range(rng.randint(0, 5))
+    ]
+    return genres, songs
+
+
+def insert_profiles(rng, user_ids, artists):
+    genres, songs = [], []
+    for user_id in user_ids:
+        user_genres, user_songs = random_profile(rng, user_id, artists)
+        genres += user_genres
+        songs += user_songs
+    if genres:
+        db.session.execute(insert(UserGenre), genres)
+    if songs:
+        db.session.execute(insert(FavoriteSong), songs)
+
+
+def pick_artist(rng, artists):
+    return artists[min(int(rng.paretovariate(0.8)) - 1, len(artists) - 1)]
+
+
+def seed(rng, n_users, artists):
+    user_ids = [str(uuid.uuid4()) for _ in range(n_users)]
+    db.session.execute(insert(User), [
+        {
+            'userId': user_id, 'username': f'user{i}', 'email': f'user{i}@example.com',
+            'sotd_artist': pick_artist(rng, artists) if rng.random() < 0.3 else None,
+        }
+        for i, user_id in enumerate(user_ids)
+    ])
+    insert_profiles(rng, user_ids, artists)
+    db.session.execute(insert(SpotifyTopTrack), [
+        {'userId': user_id, 'position': position, 'spotify_id': uuid.uuid4().hex[:22],
+         'name': 'track', 'artist': pick_artist(rng, artists)}
+        for user_id in user_ids if rng.random() < 0.4
+        for position in range(5)
+    ])
+    db.session.execute(insert(followers), [
+        {'follower_id': user_id, 'followed_id': followed}
+        for user_id in user_ids
+        for followed in set(rng.sample(user_ids, rng.randint(0, 10))) - {user_id}
+    ])
+    db.session.commit()
+    follow_graph.reset()
+    return user_ids
+
+
+def naive_top(user_id, vectors):
+    """Samma lista som Recommender, men genom att gå igenom alla andra användare en och en."""
+    vector = vectors[user_id]
+    scores = []
+    for other, other_vector in vectors.items():
+        if other == user_id:
+            continue
+        score = sum(weight * other_vector.get(name, 0.0) for name, weight in vector.items())
+        if score > 1e-12:
+            scores.append((score, other))
+    scores.sort(key=lambda entry: (-entry[0], entry[1]))
+    return scores[:TOP_N]
+
+
+def differing(a, b):
+    """Antal användare vars listor skiljer sig. Likheterna jämförs, lika poäng kan sorteras olika."""
+    return sum(
+        [round(score, 9) for score, _ in a.get(user_id, ())] != [round(score, 9) for score, _ in b.get(user_id, ())]
+        for user_id in set(a) | set(b)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--artists', type=int, default=2000)
+    parser.add_argument('--changes', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    artists = [f'Artist {i}' for i in range(args.artists)]
+    app = create_app()
+    failed = False
+    with app.app_context():
+        user_ids = seed(rng, args.users, artists)
+
+        builds = {}
+        for use_numpy in ([True, False] if NUMPY_AVAILABLE else [False]):
+            recommender = Recommender(load_taste_profiles, load_taste_changes, top_n=TOP_N, use_numpy=use_numpy)
+            started = time.perf_counter()
+            recommender.rebuild()
+            label = 'NumPy/SciPy' if use_numpy else 'inverted index'
+            print(f"{'full build, ' + label:<34} {time.perf_counter() - started:8.2f} s for {len(recommender)} users")
+            builds[use_numpy] = recommender
+        if not NUMPY_AVAILABLE:
+            print("full build, NumPy/SciPy           skipped, not installed")
+
+        recommender = builds[False]
+        sample = rng.sample(list(recommender._vectors), min(NAIVE_SAMPLE, len(recommender)))
+        started = time.perf_counter()
+        naive = {user_id: naive_top(user_id, recommender._vectors) for user_id in sample}
+        per_user = (time.perf_counter() - started) / len(sample)
+        print(f"{'one by one, no index':<34} {per_user * 1000:8.2f} ms per user, "
+              f"about {per_user * len(recommender):.1f} s for everyone")
+        wrong = differing(naive, {user_id: recommender._top.get(user_id, []) for user_id in sample})
+        if True in builds:
+            wrong += differing(builds[True]._top, builds[False]._top)
+        print(f"Users whose list differs between the builds: {wrong}")
+        failed |= wrong > 0
+
+        # Slumpade profiländringar, som edit_profile och Spotify-synken gör dem
+        changed = rng.sample(user_ids, min(args.changes, len(user_ids)))
+        db.session.execute(delete(UserGenre).where(UserGenre.userId.in_(changed)))
+        db.session.execute(delete(FavoriteSong).where(FavoriteSong.userId.in_(changed)))
+        insert_profiles(rng, changed, artists)
+        User.query.filter(User.userId.in_(changed)).update(
+            {User.taste_changed_at: datetime.utcnow()}, synchronize_session=False
+        )
+        db.session.commit()
+        found = recommender.pull_changes()
+        print(f"pull_changes() found {found} of {len(changed)} changed profiles")
+        failed |= found != len(changed)
+        started = time.perf_counter()
+        recommender.apply_pending()
+        print(f"{'changed profile, apply_pending()':<34} {(time.perf_counter() - started) / len(changed) * 1000:8.2f} ms "
+              f"per change, including loading the profile")
+
+        for user_id in user_ids:
+            recommender.similar(user_id)
+        expected = recommender._top_python(recommender._vectors, recommender._postings)
+        drift = differing(recommender._top, {user_id: entries for user_id, entries in expected.items() if entries})
+        print(f"Users whose list differs from a recompute after {len(changed)} changes: {drift}")
+        failed |= drift > 0
+
+    os.unlink(_db_file.name)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""Mäter skrivningar per sekund när många användare gillar, kommenterar, följer och avföljer samtidigt.
+
+Kör samma last tre gånger, var och en i en egen process med en ny databas:
+
+    default   SQLite som det kommer, utan pragmas och utan skrivkö
+    tuned     WAL, synchronous=NORMAL m.m. (db_engine.py)
+    queued    som tuned, plus skrivkön med group commit (write_queue.py)
+
+Skriptet avslutar med felkod om tuned eller queued fick fel (t.ex. "database is locked").
+
+    python benchmarks/write_throughput.py --clients 16 --duration 5
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    'default': {'DB_TUNING': '0', 'DB_WRITE_QUEUE': '0'},
+    'tuned': {'DB_TUNING': '1', 'DB_WRITE_QUEUE': '0'},
+    'queued': {'DB_TUNING': '1', 'DB_WRITE_QUEUE': '1'},
+}
+PASSWORD = 'benchmark'
+POSTS = 50
+
+
+def run_worker(clients, duration):
+    """Körs i underprocessen. Skriver resultatet som JSON på sista raden."""
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    from app import create_app, db, User, Post, write_queue
+
+    app = create_app()
+    logging.getLogger('app').setLevel(logging.CRITICAL)
+    app.logger.disabled = True
+    with app.app_context():
+        users = [User(username=f'writer{i}', email=f'writer{i}@example.com', password=PASSWORD) for i in range(clients)]
+        db.session.add_all(users)
+        db.session.flush()
+        for i in range(POSTS):
+            db.session.add(Post(userId=users[i % clients].userId, content=f'post {i}'))
+        db.session.commit()
+        post_ids = [post.postId for post in Post.query.all()]
+
+    counts = {'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    stop_at = [0.0]
+    # Klockan startar när alla har loggat in. Inloggningen (scrypt) tar flera sekunder med många klienter.
+    ready = threading.Barrier(clients + 1, action=lambda: stop_at.__setitem__(0, time.monotonic() + duration))
+
+    def client(n):
+        rng = random.Random(n)
+        http = app.test_client()
+        http.post('/login', data={'username': f'writer{n}', 'password': PASSWORD})
+        ready.wait()
+        while time.monotonic() < stop_at[0]:
+            action = rng.random()
+            if action < 0.6:
+                response = http.post(f'/post/{rng.choice(post_ids)}/like')
+            elif action < 0.9:
+                response = http.post(f'/post/{rng.choice(post_ids)}/comment', data={'content': 'nice'})
+            elif action < 0.95:
+                response = http.get(f'/follow/writer{rng.randrange(clients)}')
+            else:
+                response = http.get(f'/unfollow/writer{rng.randrange(clients)}')
+            with lock:
+                counts['writes' if response.status_code < 400 else 'errors'] += 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    for thread in threads:
+        thread.join()
+
+    result = dict(counts, per_second=counts['writes'] / duration)
+    if app.config['DB_WRITE_QUEUE']:
+        result['avg_batch_size'] = write_queue.metrics()['avg_batch_size']
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.clients, args.duration)
+        return 0
+
+    failures = 0
+    for mode, env in MODES.items():
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        db_file.close()
+        try:
+            output = subprocess.run(
+                [sys.executable, __file__, '--worker', '--clients', str(args.clients), '--duration', str(args.duration)],
+                env=dict(os.environ, SPOTIFY_SYNC_ENABLED='0', DATABASE_URL='sqlite:///' + db_file.name, **env),
+                capture_output=True, text=True, check=True
+            ).stdout
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_file.name + suffix):
+                    os.unlink(db_file.name + suffix)
+        result = json.loads(output.strip().splitlines()[-1])
+        batch = f"  avg batch {result['avg_batch_size']:.1f}" if 'avg_batch_size' in result else ''
+        print(f"{mode:<8} {result['per_second']:8.1f} writes/s  errors {result['errors']}{batch}")
+        if mode != 'default' and result['errors']:
+            failures += 1
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
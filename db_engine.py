@@ -0,0 +1,113 @@
+"""Inställningar för databasmotorn: pool, SQLite-pragmas, läsrepliker och dialektberoende SQL.
+
+Appen kör mot en primär databas (DATABASE_URL) och valfritt en läsreplika
+(DATABASE_REPLICA_URL). RoutingSession skickar läsningar i routes som markerats som
+read-only till repliken och allt annat till den primära.
+
+SQLite har som standard en rollback-journal där en skrivning låser hela filen även för
+läsare. Med WAL (write-ahead log) kan läsare fortsätta medan någon skriver, och med
+synchronous=NORMAL görs fsync vid checkpoint istället för vid varje commit. Det är
+säkert i WAL-läge, en krasch kan bara tappa de senaste transaktionerna, aldrig korrupta
+filen. busy_timeout gör att en anslutning som möter ett lås väntar istället för att
+direkt få "database is locked".
+"""
+import sqlite3
+
+from flask import g, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA = 'replica'
+
+# busy_timeout först, så att den gäller redan när journal_mode byts. Det är den enda
+# inställningen för hur länge en anslutning väntar på ett lås.
+SQLITE_PRAGMAS = {
+    'busy_timeout': 15000,         # millisekunder
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -20000,          # negativt betyder KiB, alltså ungefär 20 MB per anslutning
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+def is_sqlite_file(uri):
+    return uri.startswith('sqlite') and ':memory:' not in uri and uri.rstrip('/') != 'sqlite:'
+
+
+def engine_options(uri, pool_size=10, max_overflow=20, pool_timeout=30):
+    """SQLALCHEMY_ENGINE_OPTIONS för en databas-URI."""
+    options = {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+    }
+    if uri.startswith('sqlite'):
+        if not is_sqlite_file(uri):
+            # En minnesdatabas finns bara i sin egen anslutning, där bestämmer Flask-SQLAlchemy poolen
+            return {}
+        # Anslutningar delas mellan trådar via poolen. Väntan på lås sätts med busy_timeout i SQLITE_PRAGMAS.
+        options['connect_args'] = {'check_same_thread': False}
+    else:
+        options['pool_pre_ping'] = True
+    return options
+
+
+def install_sqlite_pragmas(pragmas=SQLITE_PRAGMAS):
+    """Sätter pragmas på varje ny SQLite-anslutning, för alla engines i processen."""
+    if not pragmas:
+        return
+
+    def set_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    event.listen(Engine, 'connect', set_pragmas)
+
+
+class RoutingSession(Session):
+    """Läsningar går till repliken när requesten har satt g.db_read_replica, allt annat till den primära.
+
+    Skrivningar (flush, INSERT, UPDATE, DELETE) går alltid till den primära, och markerar
+    requesten med g.db_wrote så att appen kan läsa från den primära ett tag efteråt.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or isinstance(clause, UpdateBase):
+                g.db_wrote = True
+            elif g.get('db_read_replica') and REPLICA in self._db.engines:
+                return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def dialect_insert(dialect_name):
+    """insert() med on_conflict_do_nothing/on_conflict_do_update för databasen, SQLite eller PostgreSQL."""
+    # Importeras här, PostgreSQL-dialekten tar lika lång tid att importera som resten av modulen
+    if dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    raise NotImplementedError(f"Upserts are not supported on {dialect_name}")
+
+
+def copy_sqlite_database(source_path, target_path):
+    """Kopierar en SQLite-databas med backup-API:t, även medan den används.
+
+    Används som replikering när repliken lokalt är en andra SQLite-fil.
+    """
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
@@ -0,0 +1,179 @@
+"""Följargrafen i minnet, så att "följer A B?" och antal följare inte behöver fråga databasen.
+
+Varje användar-id får ett litet heltal, och för varje heltal finns två mängder med
+heltal: vilka användaren följer och vilka som följer användaren. Medlemskap och antal
+är då O(1), och en mängd med heltal tar betydligt mindre plats än en med UUID-strängar.
+
+Grafen läses in från followers-tabellen första gången den används och uppdateras av
+follow- och unfollow-routes efter commit. Varje process har sin egen graf. För att en
+follow i en annan process ska märkas ökar varje follow och unfollow en version i
+databasen i samma transaktion. changed() jämför den med versionen som grafen lästes in
+med, och då läses grafen om (se reload()). Ändringar som processen gjorde själv och
+redan har lagt in med add() och remove() räknas upp direkt och ger ingen omläsning.
+"""
+import threading
+import time
+
+
+class FollowGraph:
+
+    def __init__(self, loader=None, version_loader=None, clock=time.monotonic):
+        # loader() returnerar alla (follower_id, followed_id) i followers-tabellen,
+        # version_loader() versionen som ökas av varje follow och unfollow
+        self._loader = loader
+        self._version_loader = version_loader
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._state = None
+        self.version = None
+        self.loaded_at = None
+        self.checked_at = None
+
+    @staticmethod
+    def _build(pairs):
+        # (userId -> heltal, heltal -> userId, heltal -> följer, heltal -> följare)
+        state = ({}, [], [], [])
+        for follower_id, followed_id in pairs:
+            follower = FollowGraph._number(state, follower_id)
+            followed = FollowGraph._number(state, followed_id)
+            state[2][follower].add(followed)
+            state[3][followed].add(follower)
+        return state
+
+    @staticmethod
+    def _number(state, user_id):
+        index, ids, following, followers = state
+        number = index.get(user_id)
+        if number is None:
+            number = index[user_id] = len(ids)
+            ids.append(user_id)
+            following.append(set())
+            followers.append(set())
+        return number
+
+    def load(self, pairs, version=None):
+        """Ersätter hela grafen med kanterna i pairs."""
+        state = self._build(pairs)
+        with self._lock:
+            self._state = state
+            self.version = version
+            self.loaded_at = self.checked_at = self._clock()
+
+    def _read(self):
+        # Versionen läses före tabellen. Kommer en follow emellan är versionen för gammal och
+        # grafen läses om en gång till, men ingen ändring missas.
+        version = self._version_loader() if self._version_loader is not None else None
+        return list(self._loader()), version
+
+    def reload(self):
+        """Läser om grafen med loader(). Returnerar (saknades, fanns_för_mycket) jämfört med förut."""
+        # Låset hålls medan tabellen läses, så att en add() som kommer under tiden inte tappas
+        with self._lock:
+            pairs, version = self._read()
+            drift = self.diff(pairs) if self._state is not None else (set(), set())
+            self.load(pairs, version)
+        return drift
+
+    def reset(self):
+        """Glömmer grafen, den läses in igen vid nästa användning."""
+        with self._lock:
+            self._state = None
+            self.version = None
+            self.loaded_at = self.checked_at = None
+
+    def stale(self, max_age):
+        return self.loaded_at is not None and self._clock() - self.loaded_at > max_age
+
+    def unchecked(self, max_age):
+        """Sant om det var mer än max_age sekunder sedan versionen i databasen jämfördes."""
+        return self.checked_at is not None and self._clock() - self.checked_at > max_age
+
+    def changed(self):
+        """Sant om followers har ändrats i databasen sedan grafen lästes in, av någon annan än add() och remove()."""
+        self.checked_at = self._clock()
+        return self._version_loader is not None and self._version_loader() != self.version
+
+    def _current(self):
+        state = self._state
+        if state is None:
+            with self._lock:
+                if self._state is None:
+                    self.load(*self._read())
+                state = self._state
+        return state
+
+    def _advance(self, version):
+        # Bara nästa version i ordning. Har en annan process ändrat något emellan
+        # stämmer inte versionen, och changed() läser om grafen.
+        if version is not None and self.version is not None and version == self.version + 1:
+            self.version = version
+
+    def add(self, follower_id, followed_id, version=None):
+        """Lägger till en kant. version är den som follow-transaktionen gav, om den ändrade tabellen."""
+        with self._lock:
+            state = self._current()
+            follower = self._number(state, follower_id)
+            followed = self._number(state, followed_id)
+            state[2][follower].add(followed)
+            state[3][followed].add(follower)
+            self._advance(version)
+
+    def remove(self, follower_id, followed_id, version=None):
+        with self._lock:
+            index, _, following, followers = self._current()
+            follower, followed = index.get(follower_id), index.get(followed_id)
+            if follower is not None and followed is not None:
+                following[follower].discard(followed)
+                followers[followed].discard(follower)
+            self._advance(version)
+
+    def is_following(self, follower_id, followed_id):
+        index, _, following, _ = self._current()
+        follower, followed = index.get(follower_id), index.get(followed_id)
+        return follower is not None and followed in following[follower]
+
+    def followers_count(self, user_id):
+        index, _, _, followers = self._current()
+        number = index.get(user_id)
+        return 0 if number is None else len(followers[number])
+
+    def following_count(self, user_id):
+        index, _, following, _ = self._current()
+        number = index.get(user_id)
+        return 0 if number is None else len(following[number])
+
+    def following_ids(self, user_id):
+        """Id:na på de konton som user_id följer."""
+        index, ids, following, _ = self._current()
+        number = index.get(user_id)
+        return [] if number is None else [ids[n] for n in list(following[number])]
+
+    def follower_ids(self, user_id):
+        """Id:na på de konton som följer user_id."""
+        index, ids, _, followers = self._current()
+        number = index.get(user_id)
+        return [] if number is None else [ids[n] for n in list(followers[number])]
+
+    def pairs(self):
+        """Alla kanter som (follower_id, followed_id)."""
+        _, ids, following, _ = self._current()
+        return {(ids[follower], ids[followed])
+                for follower in range(len(following)) for followed in list(following[follower])}
+
+    def __len__(self):
+        return sum(len(followed) for followed in self._current()[2])
+
+    def diff(self, pairs):
+        """Jämför grafen med pairs från tabellen. Returnerar (saknas_i_grafen, finns_bara_i_grafen)."""
+        table = set(pairs)
+        graph = self.pairs()
+        return table - graph, graph - table
+
+    def check_symmetry(self):
+        """Antal kanter där följer- och följarmängderna inte stämmer med varandra, ska vara 0."""
+        _, _, following, followers = self._current()
+        broken = 0
+        for number in range(len(following)):
+            broken += sum(1 for followed in following[number] if number not in followers[followed])
+            broken += sum(1 for follower in followers[number] if number not in following[follower])
+        return broken
@@ -0,0 +1,152 @@
+"""Bearbetning av uppladdade bilder i bakgrunden.
+
+Uppladdningen sparas som den är och requesten returnerar direkt. En pool av trådar
+öppnar sedan bilden, vrider den rätt enligt EXIF, och skriver nedskalade varianter i
+WebP utan metadata bredvid originalet, t.ex. "bild.jpg" -> "bild.480w.webp". Mallarna
+lägger varianterna i srcset så att webbläsaren bara hämtar den storlek den behöver.
+
+Originalet i JPEG eller PNG skrivs om en gång utan EXIF, innan varianterna skrivs. Så
+länge variants() inte hittar något kan originalet alltså fortfarande ändras.
+
+Animerade bilder (GIF, WebP, APNG) får inga varianter och lämnas som de är. Varianterna är
+stillbilder, och webbläsaren väljer srcset före originalet, så animationen skulle försvinna.
+
+Pillow är valfritt. Saknas det görs ingen bearbetning och mallarna visar originalen.
+Det importeras först när den första bilden bearbetas, så att appen startar snabbare.
+"""
+import importlib.util
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from markupsafe import Markup, escape
+
+PILLOW_AVAILABLE = importlib.util.find_spec('PIL') is not None
+
+
+def variant_name(filename, width):
+    return f"{filename.rsplit('.', 1)[0]}.{width}w.webp"
+
+
+class ImagePipeline:
+
+    def __init__(self, static_folder, sizes, workers=2, quality=80, on_processed=None):
+        # sizes: mapp -> bredder att skala ner till, t.ex. {'post_pics': (480, 960)}
+        self.static_folder = static_folder
+        self.sizes = sizes
+        self.quality = quality
+        self.on_processed = on_processed
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-pipeline')
+        # (mapp, filnamn) -> [(variant, bredd)] för bilder vars varianter finns på disk
+        self._variants = {}
+        self._lock = threading.Lock()
+        if not PILLOW_AVAILABLE:
+            print("Pillow is not installed, uploaded images are served as is")
+
+    @property
+    def available(self):
+        return PILLOW_AVAILABLE
+
+    def submit(self, folder, filename):
+        """Lägger bilden i kön. Returnerar en Future, eller None om Pillow saknas."""
+        if not self.available or not filename:
+            return None
+        return self._executor.submit(self._run, folder, filename)
+
+    def _run(self, folder, filename):
+        try:
+            self.process(folder, filename)
+        except Exception as e:
+            print(f"Image processing failed for {folder}/{filename}: {e}")
+            return
+        if self.on_processed is not None:
+            self.on_processed()
+
+    def process(self, folder, filename):
+        """Skriver varianterna för en bild och tar bort metadata ur originalet."""
+        from PIL import Image, ImageOps
+
+        path = os.path.join(self.static_folder, folder, filename)
+        with Image.open(path) as original:
+            if getattr(original, 'is_animated', False):
+                with self._lock:
+                    self._variants[(folder, filename)] = []
+                return []
+            original_format = original.format
+            image = ImageOps.exif_transpose(original)
+            image.load()
+
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+
+        # Vi skalar aldrig upp. Är bilden smalare än en storlek får den storleken en kopia i
+        # bildens egen bredd, och de större storlekarna hoppas över.
+        widths = []
+        for width in sorted(self.sizes.get(folder, ())):
+            widths.append(width)
+            if width >= image.width:
+                break
+
+        # Originalet kan ha GPS-position och annat i EXIF. JPEG och PNG sparas om utan det,
+        # GIF och annat lämnas som de är. Det görs före varianterna, så att
+        # originalet inte ändras mer när variants() har hittat dem.
+        if original_format == 'JPEG':
+            self._save(image.convert('RGB'), path, 'JPEG', quality=90)
+        elif original_format == 'PNG':
+            self._save(image, path, 'PNG', optimize=True)
+
+        # Den minsta varianten skrivs sist. Finns den på disk är bilden klar, se variants().
+        written = []
+        for width in reversed(widths):
+            variant = image
+            if width < image.width:
+                height = max(1, round(image.height * width / image.width))
+                variant = image.resize((width, height), Image.LANCZOS)
+            name = variant_name(filename, width)
+            self._save(variant, os.path.join(self.static_folder, folder, name), 'WEBP', quality=self.quality)
+            written.insert(0, (name, width))
+
+        with self._lock:
+            self._variants[(folder, filename)] = written
+        return written
+
+    @staticmethod
+    def _save(image, path, image_format, **options):
+        # Skriv till en temporär fil först så att ingen hämtar en halvskriven bild
+        tmp_path = f"{path}.tmp"
+        image.save(tmp_path, image_format, **options)
+        os.replace(tmp_path, path)
+
+    def variants(self, folder, filename):
+        """Varianterna som finns för en bild, minst först."""
+        if not filename:
+            return []
+        key = (folder, filename)
+        with self._lock:
+            known = self._variants.get(key)
+        if known is not None:
+            return known
+
+        # Bilder som bearbetats av en annan process eller innan omstart letar vi upp på disk.
+        # Bara färdiga bilder sparas, en bild som fortfarande bearbetas kollas igen nästa gång.
+        widths = sorted(self.sizes.get(folder, ()))
+        directory = os.path.join(self.static_folder, folder)
+        if not widths or not os.path.exists(os.path.join(directory, variant_name(filename, widths[0]))):
+            return []
+        found = [
+            (variant_name(filename, width), width) for width in widths
+            if os.path.exists(os.path.join(directory, variant_name(filename, width)))
+        ]
+        with self._lock:
+            self._variants[key] = found
+        return found
+
+    def srcset(self, folder, filename, url_for, sizes):
+        """srcset- och sizes-attribut för en <img>, eller en tom sträng om det inte finns några varianter."""
+        variants = self.variants(folder, filename)
+        if not variants:
+            return Markup('')
+        candidates = ', '.join(
+            f"{url_for('static', filename=f'{folder}/{name}')} {width}w" for name, width in variants
+        )
+        return Markup(f'srcset="{escape(candidates)}" sizes="{escape(sizes)}"')
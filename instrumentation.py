@@ -0,0 +1,292 @@
+"""Mätning per request: total tid, SQL-satser, mallrendering och anrop till Spotify.
+
+start_request() lägger en RequestStats i en ContextVar, så att lyssnarna hittar requesten
+som pågår i samma tråd. SQL mäts med SQLAlchemys before/after_cursor_execute på alla
+engines, mallarna med Flasks signaler before_render_template och template_rendered, och
+Spotify-anropen av den delade HTTP-sessionen i spotify_client.py. finish_request() lägger
+ihop allt per route och skriver en rad i loggen om requesten tog längre än slow_threshold.
+
+Spotify-anrop räknas även utanför requests, t.ex. i bakgrundssynken, men då bara per
+endpoint. SQL utanför requests räknas inte, utom jobb som requesten lämnar till en annan
+tråd och väntar på (skrivkön), om de körs via bind(). Mallarnas tid innehåller de queries som körs
+medan mallen renderas (lazy loads), de räknas alltså både där och som SQL.
+
+Siffrorna finns per process och visas i Prometheus textformat av render(). Körs appen med
+flera processer (serve.py) svarar /metrics med siffrorna för den process som tog emot
+requesten, label `pid` skiljer dem åt.
+
+Appen mäter bara med METRICS_ENABLED=1, och /metrics kräver METRICS_TOKEN eller ett anrop
+från den egna maskinen, se app.py.
+"""
+import bisect
+import math
+import os
+import re
+import threading
+import time
+from contextvars import ContextVar
+from urllib.parse import urlsplit
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Antal SQL-satser per request. Många satser på en route är oftast en N+1-query.
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+_current = ContextVar('request_stats', default=None)
+
+# Delen efter de här i Spotifys URL:er är ett id, och byts mot :id så att antalet endpoints hålls nere
+_ID_AFTER = {'users', 'playlists', 'tracks', 'artists', 'albums', 'shows', 'episodes'}
+_ID_SEGMENT = re.compile(r'^(\d+|[0-9A-Za-z]{22})$')
+
+
+def spotify_endpoint(url):
+    """Värd och sökväg utan query-sträng och id:n, t.ex. api.spotify.com/v1/playlists/:id/tracks."""
+    parts = urlsplit(url)
+    segments = []
+    previous = None
+    for segment in parts.path.strip('/').split('/'):
+        segments.append(':id' if previous in _ID_AFTER or _ID_SEGMENT.match(segment) else segment)
+        previous = segment
+    return parts.netloc + '/' + '/'.join(segments)
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in labels.items())
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{_number(bound)}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {_number(self.sum)}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class RequestStats:
+    """Det som mäts under en request. Tiderna är i sekunder."""
+
+    __slots__ = ('started', 'sql_statements', 'sql_seconds', 'render_seconds', 'spotify_calls',
+                 'spotify_seconds', '_render_depth', '_render_started')
+
+    def __init__(self, started):
+        self.started = started
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.render_seconds = 0.0
+        self.spotify_calls = 0
+        self.spotify_seconds = 0.0
+        self._render_depth = 0
+        self._render_started = None
+
+
+class Metrics:
+
+    def __init__(self, slow_threshold=None, log=print, clock=time.perf_counter):
+        # slow_threshold i sekunder, None stänger av loggen för långsamma requests
+        self.slow_threshold = slow_threshold
+        self._log = log
+        self._clock = clock
+        self._lock = threading.Lock()
+        # (route, method, status) -> antal
+        self._requests = {}
+        # route -> Histogram
+        self._latency = {}
+        self._statements = {}
+        # route -> [SQL-tid, renderingstid, Spotify-anrop, Spotify-tid]
+        self._totals = {}
+        # endpoint -> Histogram, (endpoint, status) -> antal
+        self._spotify = {}
+        self._spotify_status = {}
+        # (prefix, funktion) för siffror som andra delar av appen redan räknar, t.ex. bakgrundssynken
+        self._gauges = []
+        self._sql_installed = False
+
+    # Requests
+
+    def start_request(self):
+        stats = RequestStats(self._clock())
+        _current.set(stats)
+        return stats
+
+    def finish_request(self, route, method, status):
+        """Lägger ihop requesten som pågår i den här tråden. Returnerar dess RequestStats, eller None."""
+        stats = _current.get()
+        if stats is None:
+            return None
+        _current.set(None)
+        elapsed = self._clock() - stats.started
+        with self._lock:
+            key = (route, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            if route not in self._latency:
+                self._latency[route] = Histogram(LATENCY_BUCKETS)
+                self._statements[route] = Histogram(STATEMENT_BUCKETS)
+                self._totals[route] = [0.0, 0.0, 0, 0.0]
+            self._latency[route].observe(elapsed)
+            self._statements[route].observe(stats.sql_statements)
+            totals = self._totals[route]
+            totals[0] += stats.sql_seconds
+            totals[1] += stats.render_seconds
+            totals[2] += stats.spotify_calls
+            totals[3] += stats.spotify_seconds
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self._log(
+                f"Slow request: {method} {route} {status} {elapsed * 1000:.0f} ms, "
+                f"{stats.sql_statements} SQL statements {stats.sql_seconds * 1000:.0f} ms, "
+                f"render {stats.render_seconds * 1000:.0f} ms, "
+                f"{stats.spotify_calls} Spotify calls {stats.spotify_seconds * 1000:.0f} ms"
+            )
+        return stats
+
+    def bind(self, fn):
+        """fn som räknas till requesten i den här tråden, även när den körs i en annan tråd.
+
+        Requesten ska vänta på fn, statistiken är inte skyddad mot att två trådar räknar samtidigt.
+        """
+        stats = _current.get()
+        if stats is None:
+            return fn
+
+        def run():
+            token = _current.set(stats)
+            try:
+                return fn()
+            finally:
+                _current.reset(token)
+        return run
+
+    # SQL
+
+    def install_sql(self):
+        """Lyssnar på alla SQL-satser i processen. Anropas en gång, senare anrop gör inget."""
+        if self._sql_installed:
+            return
+        self._sql_installed = True
+        clock = self._clock
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if context is not None and _current.get() is not None:
+                context._instrumentation_started = clock()
+
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            started = getattr(context, '_instrumentation_started', None)
+            stats = _current.get()
+            if started is not None and stats is not None:
+                stats.sql_statements += 1
+                stats.sql_seconds += clock() - started
+
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    # Mallar. En mall som renderas inuti en annan räknas inte två gånger.
+
+    def render_started(self, *args, **kwargs):
+        stats = _current.get()
+        if stats is not None:
+            if stats._render_depth == 0:
+                stats._render_started = self._clock()
+            stats._render_depth += 1
+
+    def render_finished(self, *args, **kwargs):
+        stats = _current.get()
+        if stats is not None and stats._render_depth > 0:
+            stats._render_depth -= 1
+            if stats._render_depth == 0:
+                stats.render_seconds += self._clock() - stats._render_started
+
+    # Spotify
+
+    def record_spotify(self, method, url, status, seconds):
+        """Ett HTTP-anrop till Spotify. status är None om anropet inte fick något svar."""
+        endpoint = f'{method} {spotify_endpoint(url)}'
+        status = status if status is not None else 'error'
+        stats = _current.get()
+        if stats is not None:
+            stats.spotify_calls += 1
+            stats.spotify_seconds += seconds
+        with self._lock:
+            if endpoint not in self._spotify:
+                self._spotify[endpoint] = Histogram(LATENCY_BUCKETS)
+            self._spotify[endpoint].observe(seconds)
+            key = (endpoint, status)
+            self._spotify_status[key] = self._spotify_status.get(key, 0) + 1
+
+    def add_gauges(self, prefix, fn):
+        """fn() returnerar {namn: värde}, som visas som prefix_namn. Värden som inte är tal hoppas över."""
+        self._gauges.append((prefix, fn))
+
+    # Prometheus textformat
+
+    def render(self):
+        pid = os.getpid()
+        lines = []
+
+        def header(name, kind, text):
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            header('app_requests_total', 'counter', 'Requests by route, method and status.')
+            for (route, method, status), count in sorted(self._requests.items(), key=str):
+                lines.append(f'app_requests_total{{{_labels(pid=pid, route=route, method=method, status=status)}}} {count}')
+
+            header('app_request_duration_seconds', 'histogram', 'Total time per request.')
+            for route, histogram in sorted(self._latency.items()):
+                lines.extend(histogram.lines('app_request_duration_seconds', _labels(pid=pid, route=route)))
+
+            header('app_request_sql_statements', 'histogram', 'SQL statements per request.')
+            for route, histogram in sorted(self._statements.items()):
+                lines.extend(histogram.lines('app_request_sql_statements', _labels(pid=pid, route=route)))
+
+            for index, (name, kind, text) in enumerate((
+                ('app_request_sql_seconds_total', 'counter', 'Time spent in SQL statements.'),
+                ('app_request_render_seconds_total', 'counter', 'Time spent rendering templates.'),
+                ('app_request_spotify_calls_total', 'counter', 'Calls to Spotify made during requests.'),
+                ('app_request_spotify_seconds_total', 'counter', 'Time spent waiting for Spotify during requests.'),
+            )):
+                header(name, kind, text)
+                for route, totals in sorted(self._totals.items()):
+                    lines.append(f'{name}{{{_labels(pid=pid, route=route)}}} {_number(totals[index])}')
+
+            header('app_spotify_requests_total', 'counter', 'Calls to Spotify by endpoint and status, also outside requests.')
+            for (endpoint, status), count in sorted(self._spotify_status.items(), key=str):
+                lines.append(f'app_spotify_requests_total{{{_labels(pid=pid, endpoint=endpoint, status=status)}}} {count}')
+
+            header('app_spotify_request_duration_seconds', 'histogram', 'Latency of calls to Spotify.')
+            for endpoint, histogram in sorted(self._spotify.items()):
+                lines.extend(histogram.lines('app_spotify_request_duration_seconds', _labels(pid=pid, endpoint=endpoint)))
+
+        for prefix, fn in self._gauges:
+            for name, value in sorted(fn().items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'# TYPE {prefix}_{name} gauge')
+                    lines.append(f'{prefix}_{name}{{{_labels(pid=pid)}}} {_number(value)}')
+        return '\n'.join(lines) + '\n'
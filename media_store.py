@@ -0,0 +1,133 @@
+"""Lagring av uppladdade filer under namn som är hashen av innehållet.
+
+En fil med SHA-256 "abcdef..." och ändelsen .jpg sparas som "ab/cd/abcdef....jpg" i sin
+uppladdningsmapp. Två användare som laddar upp samma bild delar alltså på en fil, och två
+uppladdningar kan aldrig skriva över varandra. De två första nivåerna av kataloger håller
+nere antalet filer per katalog.
+
+Namnet är hashen av filen som laddades upp. Bildbearbetningen (image_pipeline.py) skriver
+om JPEG- och PNG-original en gång utan EXIF, sedan ändras filen aldrig, så när den är klar
+kan filerna cachas för alltid av webbläsare och proxies. Vilka filer som fortfarande
+används håller appen reda på (se MediaRef i app.py), modulen här sköter bara själva filerna.
+"""
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+
+CHUNK_SIZE = 64 * 1024
+
+# "ab/cd/<64 hex>.ext" plus varianter som "ab/cd/<64 hex>.480w.webp"
+STORED_NAME = re.compile(r'^([0-9a-f]{2})/([0-9a-f]{2})/(\1\2[0-9a-f]{60})(\.[0-9a-z]+)*$')
+
+
+def is_stored_name(name):
+    """Sant om namnet pekar in i lagret, och inte är en äldre fil som "default.jpg"."""
+    return bool(name) and STORED_NAME.match(name) is not None
+
+
+class MediaStore:
+
+    def __init__(self, root, folders):
+        self.root = root
+        self.folders = set(folders)
+
+    def create_folders(self):
+        for folder in self.folders:
+            os.makedirs(os.path.join(self.root, folder), exist_ok=True)
+
+    def path(self, folder, name):
+        return os.path.join(self.root, folder, name)
+
+    def save(self, folder, stream, extension):
+        """Sparar innehållet i stream. Returnerar (namn, ny) där ny är False om filen redan fanns."""
+        if folder not in self.folders:
+            raise ValueError(f"Unknown media folder: {folder}")
+
+        # Skriv till en temporär fil och hasha samtidigt, så att hela filen aldrig behöver ligga i minnet
+        digest = hashlib.sha256()
+        os.makedirs(os.path.join(self.root, folder), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, folder), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+            return self.adopt(folder, tmp_path, digest.hexdigest(), extension)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def adopt(self, folder, tmp_path, content_hash, extension):
+        """Flyttar in en redan hashad fil, t.ex. en uppladdning som skrevs medan requesten lästes.
+
+        Om tmp_path finns kvar efteråt, t.ex. för att filen redan fanns, tar anroparen bort den.
+        Returnerar (namn, ny).
+        """
+        if folder not in self.folders:
+            raise ValueError(f"Unknown media folder: {folder}")
+        extension = re.sub(r'[^0-9a-z]', '', (extension or '').lower())[:10] or 'bin'
+        name = f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.{extension}"
+        target = self.path(folder, name)
+        if os.path.exists(target):
+            # Rör filen så att gc() inte tar den medan referensen sparas
+            os.utime(target)
+            return name, False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(tmp_path, target)
+        except OSError:
+            # tmp_path ligger på ett annat filsystem. Kopiera in bredvid målet och byt namn där.
+            fd, copy_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as dst, open(tmp_path, 'rb') as src:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            os.replace(copy_path, target)
+        return name, True
+
+    def delete(self, folder, name):
+        """Tar bort filen och alla varianter av den, t.ex. nedskalade bilder."""
+        if not is_stored_name(name):
+            return
+        directory = os.path.dirname(self.path(folder, name))
+        prefix = os.path.basename(name).split('.', 1)[0] + '.'
+        try:
+            entries = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.startswith(prefix):
+                try:
+                    os.remove(os.path.join(directory, entry))
+                except FileNotFoundError:
+                    pass
+
+    def originals(self, folder):
+        """Alla uppladdade filer i mappen som (namn, ändrad_vid), utan varianter."""
+        base = os.path.join(self.root, folder)
+        if not os.path.isdir(base):
+            return
+        for shard1 in sorted(os.listdir(base)):
+            if not re.fullmatch(r'[0-9a-f]{2}', shard1):
+                continue
+            for shard2 in sorted(os.listdir(os.path.join(base, shard1))):
+                directory = os.path.join(base, shard1, shard2)
+                for entry in sorted(os.listdir(directory)):
+                    name = f"{shard1}/{shard2}/{entry}"
+                    if entry.count('.') == 1 and is_stored_name(name):
+                        yield name, os.path.getmtime(os.path.join(directory, entry))
+
+    def gc(self, folder, referenced, grace=3600, clock=time.time):
+        """Tar bort filer som inget pekar på och som är äldre än grace sekunder.
+
+        Grace-tiden skyddar filer som precis har laddats upp men vars referens inte har
+        sparats i databasen än. Returnerar antalet borttagna filer.
+        """
+        cutoff = clock() - grace
+        removed = 0
+        for name, modified_at in list(self.originals(folder)):
+            if name not in referenced and modified_at < cutoff:
+                self.delete(folder, name)
+                removed += 1
+        return removed
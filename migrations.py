@@ -0,0 +1,248 @@
+"""Schemamigreringar för databaser som redan finns, t.ex. instance/users.db.
+
+db.create_all() skapar bara tabeller som saknas, den lägger inte till kolumner eller
+index på befintliga tabeller. Varje migrering här körs en gång per databas och
+versionen sparas i tabellen schema_migrations. Stegen använder rå SQL och inte
+modellerna i app.py, så att de fortsätter fungera när modellerna ändras. SQL:en ska
+fungera på både SQLite och PostgreSQL, det som bara finns i SQLite kollar conn.dialect.name.
+upgrade() skapar först tabeller som saknas (metadata.create_all), så helt nya tabeller finns
+redan när stegen körs.
+
+Varje process i gunicorn eller uvicorn kör create_app() och därmed upgrade() samtidigt. Allt
+görs därför i en transaktion som först tar skrivlåset (BEGIN EXCLUSIVE i SQLite, ett advisory
+lock i PostgreSQL), och schema_migrations läses först när låset är taget. Processerna som
+väntade hittar då allt gjort och gör ingenting.
+"""
+import json
+import time
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+
+def _add_column(conn, table, column, ddl):
+    # ALTER TABLE ... ADD COLUMN, men bara om kolumnen inte redan finns (t.ex. i en ny databas)
+    columns = {col['name'] for col in inspect(conn).get_columns(table)}
+    if column not in columns:
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+def _post_counters(conn):
+    _add_column(conn, 'posts', 'like_count', 'INTEGER NOT NULL DEFAULT 0')
+    _add_column(conn, 'posts', 'comment_count', 'INTEGER NOT NULL DEFAULT 0')
+    # Fyller i räknarna för posts som redan finns
+    conn.execute(text(
+        'UPDATE posts SET '
+        'like_count = (SELECT COUNT(*) FROM likes WHERE likes."postId" = posts."postId"), '
+        'comment_count = (SELECT COUNT(*) FROM comments WHERE comments."postId" = posts."postId")'
+    ))
+
+
+def _timeline_backfill(conn):
+    # Fyller tidslinjen med egna posts och posts från de man följer
+    sqlite = conn.dialect.name == 'sqlite'
+    conn.execute(text(
+        ('INSERT OR IGNORE' if sqlite else 'INSERT') + ' INTO timeline ("userId", "postId", "authorId", created_at) '
+        'SELECT "userId", "postId", "userId", created_at FROM posts '
+        'UNION '
+        'SELECT followers.follower_id, posts."postId", posts."userId", posts.created_at '
+        'FROM posts JOIN followers ON followers.followed_id = posts."userId"'
+        + ('' if sqlite else ' ON CONFLICT DO NOTHING')
+    ))
+
+
+def _secondary_indexes(conn):
+    # Dubbletter i likes måste bort innan det unika indexet kan skapas
+    conn.execute(text(
+        'DELETE FROM likes WHERE "likeId" NOT IN '
+        '(SELECT MIN("likeId") FROM likes GROUP BY "userId", "postId")'
+    ))
+    conn.execute(text(
+        'UPDATE posts SET like_count = '
+        '(SELECT COUNT(*) FROM likes WHERE likes."postId" = posts."postId")'
+    ))
+    # Tidslinjens index fick postId som sista kolumn för pagineringen
+    conn.execute(text('DROP INDEX IF EXISTS ix_timeline_user_created'))
+    for statement in (
+        'CREATE INDEX IF NOT EXISTS ix_users_username ON users (username)',
+        'CREATE INDEX IF NOT EXISTS ix_posts_user_created ON posts ("userId", created_at, "postId")',
+        'CREATE INDEX IF NOT EXISTS ix_posts_created ON posts (created_at, "postId")',
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_likes_user_post ON likes ("userId", "postId")',
+        'CREATE INDEX IF NOT EXISTS ix_likes_post ON likes ("postId")',
+        'CREATE INDEX IF NOT EXISTS ix_comments_post_created ON comments ("postId", created_at, "commentId")',
+        'CREATE INDEX IF NOT EXISTS ix_followers_followed ON followers (followed_id, follower_id)',
+        'CREATE INDEX IF NOT EXISTS ix_timeline_user_created ON timeline ("userId", created_at, "postId")',
+    ):
+        conn.execute(text(statement))
+
+
+def _spotify_synced_at(conn):
+    _add_column(conn, 'users', 'spotify_synced_at', 'TIMESTAMP')
+
+
+def _username_search_index(conn):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_users_username_lower ON users (lower(username), "userId")'))
+
+
+def _song_search_index(conn):
+    # Fulltextindex över låtkatalogen. Triggers håller det i synk med songs-tabellen.
+    # Saknar SQLite FTS5, eller är det inte SQLite, hoppar vi över det. Sökningen faller då tillbaka på LIKE.
+    if conn.dialect.name != 'sqlite':
+        return
+    try:
+        conn.execute(text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5('
+            "title, artist, album, content='songs', content_rowid='rowid', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        ))
+    except OperationalError as e:
+        print(f"Skipping song search index: {e}")
+        return
+    conn.execute(text(
+        'CREATE TRIGGER IF NOT EXISTS songs_fts_insert AFTER INSERT ON songs BEGIN '
+        'INSERT INTO songs_fts (rowid, title, artist, album) '
+        'VALUES (new.rowid, new.title, new.artist, new.album); END'
+    ))
+    conn.execute(text(
+        'CREATE TRIGGER IF NOT EXISTS songs_fts_delete AFTER DELETE ON songs BEGIN '
+        "INSERT INTO songs_fts (songs_fts, rowid, title, artist, album) "
+        "VALUES ('delete', old.rowid, old.title, old.artist, old.album); END"
+    ))
+    conn.execute(text(
+        'CREATE TRIGGER IF NOT EXISTS songs_fts_update AFTER UPDATE ON songs BEGIN '
+        "INSERT INTO songs_fts (songs_fts, rowid, title, artist, album) "
+        "VALUES ('delete', old.rowid, old.title, old.artist, old.album); "
+        'INSERT INTO songs_fts (rowid, title, artist, album) '
+        'VALUES (new.rowid, new.title, new.artist, new.album); END'
+    ))
+    conn.execute(text("INSERT INTO songs_fts (songs_fts) VALUES ('rebuild')"))
+
+
+def _drop_column(conn, table, column):
+    # SQLite kan DROP COLUMN från 3.35. Med en äldre version ligger kolumnen kvar, den läses inte längre.
+    try:
+        conn.execute(text(f'ALTER TABLE {table} DROP COLUMN "{column}"'))
+    except OperationalError as e:
+        print(f"Could not drop {table}.{column}, leaving it unused: {e}")
+
+
+def _favorites_tables(conn):
+    # Tabellerna user_favorite_songs och user_genres skapas av db.create_all(). Här flyttas datan
+    # från de gamla kolumnerna i users, som sedan tas bort.
+    columns = {col['name'] for col in inspect(conn).get_columns('users')}
+
+    if 'favorite_songs' in columns:
+        songs = []
+        for user_id, value in conn.execute(text(
+                'SELECT "userId", favorite_songs FROM users WHERE favorite_songs IS NOT NULL')):
+            try:
+                parsed = json.loads(value)
+            except ValueError:
+                continue
+            valid = [song for song in parsed if isinstance(song, dict) and song.get('title') and song.get('artist')] \
+                if isinstance(parsed, list) else []
+            songs += [
+                {'user_id': user_id, 'position': position, 'title': song['title'], 'artist': song['artist'],
+                 'icon': song.get('icon'), 'spotify_id': song.get('spotify_id')}
+                for position, song in enumerate(valid)
+            ]
+        if songs:
+            conn.execute(text(
+                'INSERT INTO user_favorite_songs ("userId", position, title, artist, icon, spotify_id) '
+                'VALUES (:user_id, :position, :title, :artist, :icon, :spotify_id)'
+            ), songs)
+        _drop_column(conn, 'users', 'favorite_songs')
+
+    if 'favoriteGenres' in columns:
+        # Samma funktion som User.set_genres(), så att migrerade genrer blir som nya. Importeras
+        # här och inte överst, resten av migreringarna använder inte modellerna.
+        from models import normalize_genres
+
+        genres = []
+        for user_id, value in conn.execute(text(
+                'SELECT "userId", "favoriteGenres" FROM users WHERE "favoriteGenres" IS NOT NULL')):
+            # Kommaseparerat i den gamla kolumnen
+            genres += [{'user_id': user_id, 'genre': name} for name in normalize_genres(value.split(','))]
+        if genres:
+            conn.execute(text('INSERT INTO user_genres ("userId", genre) VALUES (:user_id, :genre)'), genres)
+        _drop_column(conn, 'users', 'favoriteGenres')
+
+
+def _follower_counts(conn):
+    _add_column(conn, 'users', 'follower_count', 'INTEGER NOT NULL DEFAULT 0')
+    conn.execute(text(
+        'UPDATE users SET follower_count = '
+        '(SELECT COUNT(*) FROM followers WHERE followers.followed_id = users."userId")'
+    ))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_users_follower_count ON users (follower_count)'))
+
+
+def _taste_changed_at(conn):
+    _add_column(conn, 'users', 'taste_changed_at', 'TIMESTAMP')
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_users_taste_changed_at ON users (taste_changed_at)'))
+
+
+# Så länge väntar en process på att en annan ska migrera klart, i sekunder
+LOCK_TIMEOUT = 600
+# Nyckeln till pg_advisory_xact_lock, ett tal som inget annat i databasen använder
+ADVISORY_LOCK_KEY = 72401
+
+
+def _lock(conn, timeout=LOCK_TIMEOUT):
+    # Låset släpps när transaktionen committas eller rullas tillbaka
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': ADVISORY_LOCK_KEY})
+    elif conn.dialect.name == 'sqlite':
+        # busy_timeout räcker inte om en annan process kör en lång migrering
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                conn.exec_driver_sql('BEGIN EXCLUSIVE')
+                return
+            except OperationalError as e:
+                if 'locked' not in str(e) or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+
+# (version, beskrivning, funktion). Lägg alltid till nya migreringar sist.
+MIGRATIONS = [
+    (1, 'like_count och comment_count på posts', _post_counters),
+    (2, 'fyll hemtidslinjen från posts och followers', _timeline_backfill),
+    (3, 'sekundärindex och unik like per användare och post', _secondary_indexes),
+    (4, 'users.spotify_synced_at för bakgrundssynken', _spotify_synced_at),
+    (5, 'fulltextindex för låtkatalogen', _song_search_index),
+    (6, 'index för sökning och sortering i användarlistan', _username_search_index),
+    (7, 'favoritlåtar och genrer i egna tabeller istället för users.favorite_songs och favoriteGenres',
+     _favorites_tables),
+    (8, 'users.follower_count för fan-out och pull-läget i feeden', _follower_counts),
+    (9, 'users.taste_changed_at så att förslagen märker ändringar från andra processer', _taste_changed_at),
+]
+
+
+def upgrade(engine, metadata=None):
+    """Skapar tabeller som saknas i metadata och kör alla migreringar som inte har körts.
+
+    Returnerar listan med versioner som kördes.
+    """
+    applied = []
+    with engine.begin() as conn:
+        _lock(conn)
+        if metadata is not None:
+            metadata.create_all(conn)
+        conn.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_migrations ('
+            'version INTEGER PRIMARY KEY, description VARCHAR(200), applied_at TIMESTAMP)'
+        ))
+        done = {row[0] for row in conn.execute(text('SELECT version FROM schema_migrations'))}
+        for version, description, step in MIGRATIONS:
+            if version in done:
+                continue
+            step(conn)
+            conn.execute(
+                text('INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)'),
+                {'v': version, 'd': description, 't': datetime.utcnow()}
+            )
+            applied.append(version)
+    return applied
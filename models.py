@@ -1,73 +1,350 @@
-from flask_sqlalchemy import SQLAlchemy
+"""Databasmodellerna. Det här är den enda platsen där tabellerna definieras.
+
+db är inte kopplad till någon app här, app.py anropar db.init_app(app). Så kan modellerna
+importeras av skript och migreringar utan att appen, Spotify-klienterna och allt annat
+byggs upp.
+"""
+import uuid
+from datetime import datetime
+
 from flask_login import UserMixin
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from db_engine import RoutingSession
+from follow_graph import FollowGraph
+
+# Läsningar kan gå till en läsreplika, se RoutingSession i db_engine.py
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
-db = SQLAlchemy()
+# Först ut så är tabellen för followers, med ID för den som följer och blir följd.
+followers = db.Table('followers',
+    db.Column('follower_id', db.String(36), db.ForeignKey('users.userId'), primary_key=True),
+    db.Column('followed_id', db.String(36), db.ForeignKey('users.userId'), primary_key=True),
+    # Primärnyckeln börjar på follower_id, så "vilka följer X" behöver ett eget index
+    db.Index('ix_followers_followed', 'followed_id', 'follower_id')
+)
 
-# Tabell för användaren
-class User(db.Model, UserMixin):
+def load_follow_pairs():
+    return db.session.execute(db.select(followers.c.follower_id, followers.c.followed_id)).all()
+
+def load_follow_version():
+    return db.session.scalar(db.select(ChangeCounter.value).where(ChangeCounter.name == 'follows')) or 0
+
+# Följargrafen i minnet, se follow_graph.py. Läses in från followers första gången den används.
+follow_graph = FollowGraph(load_follow_pairs, load_follow_version)
+
+# Genrenamn med blanktecken ihopslagna, utan tomma och dubbletter (oavsett versaler). Första
+# stavningen vinner. Används både av User.set_genres() och migreringen från favoriteGenres.
+def normalize_genres(names):
+    seen = set()
+    result = []
+    for name in names:
+        name = ' '.join((name or '').split())
+        if name and name.lower() not in seen:
+            seen.add(name.lower())
+            result.append(name)
+    return result
+
+# Allt som sparas i databasen för en User
+class User(UserMixin, db.Model):
     __tablename__ = 'users'
-    userId = db.Column(db.String, primary_key=True)
-    username = db.Column(db.String(80), nullable=False)
+    userId = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    username = db.Column(db.String(80), nullable=False, index=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password = db.Column(db.String(128))
     profilePicture = db.Column(db.String, nullable=True, default='default.jpg')
-    favoriteGenres = db.Column(db.PickleType, nullable=True)
-    createdAt = db.Column(db.DateTime, default=db.func.current_timestamp())
+    createdAt = db.Column(db.DateTime, default=datetime.utcnow)
     spotify_access_token = db.Column(db.String(255), nullable=True)
     spotify_refresh_token = db.Column(db.String(255), nullable=True)
     spotify_user_id = db.Column(db.String(255), nullable=True)
     spotify_token_expiry = db.Column(db.DateTime, nullable=True)
-    
-    # För inloggning
+    bio = db.Column(db.Text, nullable=True)
+    sotd_title = db.Column(db.String(200), nullable=True)
+    sotd_artist = db.Column(db.String(200), nullable=True)
+    song_picture = db.Column(db.String(200), nullable=True)
+    spotify_synced_at = db.Column(db.DateTime, nullable=True)  # Senaste lyckade bakgrundssynken
+    # Räknas upp och ner av follow() och unfollow() i samma transaktion som followers. Fan-out och
+    # pull-läget i feeden utgår från den, så att alla processer gör samma val.
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Senaste ändringen av det som förslagen på /users bygger på: genrer, favoritlåtar, Song of the Day,
+    # Spotify-data och follows. Andra processer letar efter den, se Recommender.pull_changes().
+    taste_changed_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Användarlistan sorteras och prefixsöks på användarnamnet utan hänsyn till versaler
+        db.Index('ix_users_username_lower', func.lower(username), userId),
+        # De få konton som är i pull-läge
+        db.Index('ix_users_follower_count', follower_count),
+        db.Index('ix_users_taste_changed_at', taste_changed_at),
+    )
+
+    # Followers relationen med mer explicit metod
+    followed = db.relationship(
+        'User', 
+        secondary=followers,
+        primaryjoin=(followers.c.follower_id == userId),
+        secondaryjoin=(followers.c.followed_id == userId),
+        backref=db.backref('followers', lazy='dynamic'),
+        lazy='dynamic'
+    )
+
+    # Favoritlåtar och genrer ligger i egna tabeller, se FavoriteSong och UserGenre
+    favorite_songs = db.relationship(
+        'FavoriteSong', order_by='FavoriteSong.position', cascade='all, delete-orphan'
+    )
+    genres = db.relationship('UserGenre', order_by='UserGenre.genre', cascade='all, delete-orphan')
+
+    # Lägg till following som en property för kompatibilitet
+    @property
+    def following(self):
+        return self.followed
+
+    # Hämtar id:et för en användare
     def get_id(self):
         return self.userId
+
+    def __init__(self, username, email, password=None, **kwargs):
+        # ETT UUID genereras om inte det finns
+        self.userId = kwargs.get('userId', str(uuid.uuid4()))
+        
+        #Grundläggande information tilldelas och om ett lösen finns så hashas det.
+        self.username = username
+        self.email = email
+        if password:
+            self.set_password(password)
+        
+        # Här kollar vi på attributen som skickats med och lägger till de som redan finns i klassen
+        for key, value in kwargs.items():
+            if hasattr(self, key):
+                setattr(self, key, value)
     
-    def is_authenticated(self):
-        return True
+    # Dessa är ganska självklara
+    def set_password(self, password):
+        self.password = generate_password_hash(password)
+        
+    def check_password(self, password):
+        return check_password_hash(self.password, password)
     
-    def is_active(self):
-        return True
+    # follow() och unfollow() ändrar bara tabellen. Den som anropar dem uppdaterar follow_graph efter commit.
+    def follow(self, user):
+        """Follow another user."""
+        if not self.followed.filter(followers.c.followed_id == user.userId).count():
+            self.followed.append(user)
+            user.follower_count = (user.follower_count or 0) + 1
+            
+    def unfollow(self, user):
+        """Unfollow another user."""
+        if self.followed.filter(followers.c.followed_id == user.userId).count():
+            self.followed.remove(user)
+            user.follower_count -= 1
+
+    def is_following(self, user):
+        """Check if current user is following another user."""
+        return follow_graph.is_following(self.userId, user.userId)
     
-    def is_anonymous(self):
-        return False
+    def followers_count(self):
+        """Get the number of followers."""
+        return follow_graph.followers_count(self.userId)
+
+    @property
+    def genre_names(self):
+        return [row.genre for row in self.genres]
+
+    def set_genres(self, names):
+        """Ersätter användarens genrer. Tomma namn och dubbletter (oavsett versaler) hoppas över."""
+        wanted = {name.lower(): name for name in normalize_genres(names)}
+        # Rader som redan finns återanvänds, annars krockar den nya raden med den gamla primärnyckeln
+        existing = {row.genre.lower(): row for row in self.genres}
+        self.genres = [existing.get(key) or UserGenre(genre=name) for key, name in wanted.items()]
 
-# Tabell för följare
-class Follower(db.Model):
-    __tablename__ = 'followers'
-    followerId = db.Column(db.String, db.ForeignKey('users.userId'), primary_key=True)
-    followingId = db.Column(db.String, db.ForeignKey('users.userId'), primary_key=True)
+    def set_favorite_songs(self, songs):
+        """Ersätter favoritlåtarna med songs, dicts med title, artist och valfritt icon och spotify_id."""
+        self.favorite_songs = [
+            FavoriteSong(
+                position=position, title=song['title'], artist=song['artist'],
+                icon=song.get('icon'), spotify_id=song.get('spotify_id')
+            ) for position, song in enumerate(songs)
+        ]
 
-# Tabell för posts
+    # Om en användare gillar ett inlägg så kollar den upp i databasen efter userid, postid och om det hittas blir det en like, annars none.
+    def has_liked_post(self, post):
+        return Like.query.filter_by(userId=self.userId, postId=post.postId).first() is not None
+
+    
+    # Tabell i databasen för posts
 class Post(db.Model):
     __tablename__ = 'posts'
-    postId = db.Column(db.String, primary_key=True)
-    userId = db.Column(db.String, db.ForeignKey('users.userId'), nullable=False)
-    songId = db.Column(db.String, nullable=False)
-    caption = db.Column(db.Text, nullable=True)
-    likes = db.Column(db.Integer, default=0)
-    createdAt = db.Column(db.DateTime, default=db.func.current_timestamp())
-
-# Tabell för gilla-markeringar
+    postId = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    userId = db.Column(db.String(36), db.ForeignKey('users.userId'), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    post_picture = db.Column(db.String(200), nullable=True) 
+    # Räknare som hålls uppdaterade av like_post() och add_comment(), så att vi slipper COUNT(*) vid varje visning
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        # Profilsidan och pull-läget i feeden: en användares posts, nyast först
+        db.Index('ix_posts_user_created', 'userId', 'created_at', 'postId'),
+        # Den globala feeden för utloggade
+        db.Index('ix_posts_created', 'created_at', 'postId'),
+    )
+    
+    user = db.relationship('User', backref=db.backref('posts', lazy='dynamic'))
+    likes = db.relationship('Like', primaryjoin='Post.postId==Like.postId', 
+                            backref='post', lazy='dynamic')
+    comments = db.relationship('Comment', primaryjoin='Post.postId==Comment.postId', 
+                               backref='post', lazy='dynamic')
+
+# Favoritlåtarna på en profil, i den ordning de visas. Låg tidigare som JSON i users.favorite_songs.
+class FavoriteSong(db.Model):
+    __tablename__ = 'user_favorite_songs'
+    id = db.Column(db.Integer, primary_key=True)
+    userId = db.Column(db.String(36), db.ForeignKey('users.userId'), nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    title = db.Column(db.String(300), nullable=False)
+    artist = db.Column(db.String(300), nullable=False)
+    icon = db.Column(db.String(16), nullable=True)
+    spotify_id = db.Column(db.String(64), nullable=True)  # Sätts om låten valdes från katalogen
+
+    __table_args__ = (
+        db.Index('ix_user_favorite_songs_user', 'userId', 'position'),
+        # Alla som har en viss artist bland favoriterna
+        db.Index('ix_user_favorite_songs_artist', func.lower(artist), 'userId'),
+    )
+
+    def as_dict(self):
+        return {'title': self.title, 'artist': self.artist, 'icon': self.icon, 'spotify_id': self.spotify_id}
+
+# En rad per genre som en användare gillar. Låg tidigare som en sträng i users.favoriteGenres.
+class UserGenre(db.Model):
+    __tablename__ = 'user_genres'
+    userId = db.Column(db.String(36), db.ForeignKey('users.userId'), primary_key=True)
+    genre = db.Column(db.String(100), primary_key=True)
+
+    __table_args__ = (
+        # Alla som gillar en genre, utan hänsyn till versaler, t.ex. /users?genre=techno
+        db.Index('ix_user_genres_genre', func.lower(genre), 'userId'),
+    )
+
+# Tabell för likes
 class Like(db.Model):
     __tablename__ = 'likes'
-    likeId = db.Column(db.String, primary_key=True)
-    userId = db.Column(db.String, db.ForeignKey('users.userId'), nullable=False)
-    postId = db.Column(db.String, db.ForeignKey('posts.postId'), nullable=False)
+    likeId = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    userId = db.Column(db.String(36), db.ForeignKey('users.userId'), nullable=False)
+    postId = db.Column(db.String(36), db.ForeignKey('posts.postId'), nullable=False)
+
+    __table_args__ = (
+        # En användare kan bara gilla en post en gång, och indexet används för has_liked_post
+        db.Index('uq_likes_user_post', 'userId', 'postId', unique=True),
+        db.Index('ix_likes_post', 'postId'),
+    )
+    
+    # Relation med user
+    user = db.relationship('User', backref='likes')
 
 # Tabell för kommentarer
 class Comment(db.Model):
     __tablename__ = 'comments'
-    commentId = db.Column(db.String, primary_key=True)
-    userId = db.Column(db.String, db.ForeignKey('users.userId'), nullable=False)
-    postId = db.Column(db.String, db.ForeignKey('posts.postId'), nullable=False)
+    commentId = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    userId = db.Column(db.String(36), db.ForeignKey('users.userId'), nullable=False)
+    postId = db.Column(db.String(36), db.ForeignKey('posts.postId'), nullable=False)
     content = db.Column(db.Text, nullable=False)
-    createdAt = db.Column(db.DateTime, default=db.func.current_timestamp())
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-# Tabell för sånger
+    __table_args__ = (
+        # Kommentarerna för en post i den ordning de visas
+        db.Index('ix_comments_post_created', 'postId', 'created_at', 'commentId'),
+    )
+    
+    # Relation
+    user = db.relationship('User', backref='comments')
+
+# Låtkatalogen. En rad per Spotify-låt, fylls på av bakgrundssynken. Söks via FTS5-tabellen songs_fts (se migrations.py).
 class Song(db.Model):
     __tablename__ = 'songs'
-    songId = db.Column(db.String, primary_key=True)
-    title = db.Column(db.String, nullable=False)
-    artist = db.Column(db.String, nullable=False)
-    album = db.Column(db.String, nullable=True)
-    coverUrl = db.Column(db.String, nullable=True)
\ No newline at end of file
+    songId = db.Column(db.String(64), primary_key=True)  # Spotifys track-id
+    title = db.Column(db.String(300), nullable=False)
+    artist = db.Column(db.String(300), nullable=False)
+    album = db.Column(db.String(300), nullable=True)
+    coverUrl = db.Column(db.String(500), nullable=True)
+
+    def as_dict(self):
+        return {
+            'id': self.songId,
+            'title': self.title,
+            'artist': self.artist,
+            'album': self.album,
+            'cover_url': self.coverUrl
+        }
+
+# Topplåtar och spellistor som bakgrundssynken har hämtat från Spotify. Profilsidan läser bara härifrån.
+class SpotifyTopTrack(db.Model):
+    __tablename__ = 'spotify_top_tracks'
+    userId = db.Column(db.String(36), db.ForeignKey('users.userId'), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)
+    spotify_id = db.Column(db.String(64), nullable=False)
+    name = db.Column(db.String(300), nullable=False)
+    artist = db.Column(db.String(300), nullable=False)
+    album_art = db.Column(db.String(500), nullable=True)
+    external_url = db.Column(db.String(500), nullable=True)
+    preview_url = db.Column(db.String(500), nullable=True)
+
+    # Samma format som fetch_spotify_top_tracks() returnerar
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'artist': self.artist,
+            'album_art': self.album_art,
+            'external_url': self.external_url,
+            'preview_url': self.preview_url,
+            'spotify_id': self.spotify_id,
+            'embed_url': f"https://open.spotify.com/embed/track/{self.spotify_id}"
+        }
+
+class SpotifyPlaylist(db.Model):
+    __tablename__ = 'spotify_playlists'
+    userId = db.Column(db.String(36), db.ForeignKey('users.userId'), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(300), nullable=False)
+    tracks_count = db.Column(db.Integer, nullable=False, default=0)
+    external_url = db.Column(db.String(500), nullable=True)
+    image_url = db.Column(db.String(500), nullable=True)
+
+    # Samma format som fetch_spotify_playlists() returnerar
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'tracks_count': self.tracks_count,
+            'external_url': self.external_url,
+            'image_url': self.image_url
+        }
+
+# Förberäknad hemtidslinje. Varje rad är en post i en användares feed, så att läsningen blir
+# en enda range scan på (userId, created_at) istället för en IN-query över alla man följer.
+class TimelineEntry(db.Model):
+    __tablename__ = 'timeline'
+    userId = db.Column(db.String(36), db.ForeignKey('users.userId'), primary_key=True)  # Vems feed
+    postId = db.Column(db.String(36), db.ForeignKey('posts.postId'), primary_key=True)
+    authorId = db.Column(db.String(36), db.ForeignKey('users.userId'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_timeline_user_created', 'userId', 'created_at', 'postId'),
+    )
+
+# Räknare som ökas i samma transaktion som en ändring, så att andra processer ser att något har
+# ändrats med en billig läsning. 'follows' ökas av varje follow och unfollow, se follow_graph.py.
+class ChangeCounter(db.Model):
+    __tablename__ = 'change_counters'
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+# Hur många rader som pekar på en fil i media_store. Filer utan referenser tas bort av gc-media.
+class MediaRef(db.Model):
+    __tablename__ = 'media_refs'
+    path = db.Column(db.String(300), primary_key=True)  # t.ex. 'post_pics/ab/cd/abcd....jpg'
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
@@ -0,0 +1,195 @@
+"""Cache för hela sidor som ser likadana ut för alla utloggade besökare.
+
+En sida sparas som färdig HTML tillsammans med en ETag och tiden den renderades, så att
+webbläsare kan fråga "har den ändrats?" och få 304 tillbaka. Backenden kan vara i minnet
+(per process) eller på disk (delas mellan processer på samma maskin), och båda har ett tak
+för antalet sidor. En sida gäller i högst ttl sekunder.
+
+När något som syns på sidorna ändras skriver invalidate() en ny generation till en fil.
+Varje sida sparas med generationen som gällde när den började renderas, och läses den
+med en annan generation räknas den som borta. Så töms cachen i alla processer som delar
+filen, även de med minnesbackenden.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+
+class CachedPage:
+    __slots__ = ('body', 'mimetype', 'etag', 'last_modified', 'generation', 'expires_at')
+
+    def __init__(self, body, mimetype, etag, last_modified, generation, expires_at):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = etag
+        self.last_modified = last_modified
+        self.generation = generation
+        self.expires_at = expires_at
+
+    def __getstate__(self):
+        return (self.body, self.mimetype, self.etag, self.last_modified, self.generation, self.expires_at)
+
+    def __setstate__(self, state):
+        self.body, self.mimetype, self.etag, self.last_modified, self.generation, self.expires_at = state
+
+
+class MemoryBackend:
+    """Sidorna i en LRU i processens minne. Nyckeln innehåller query-strängen, därav taket."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            page = self._entries.get(key)
+            if page is not None:
+                self._entries.move_to_end(key)
+            return page
+
+    def set(self, key, page):
+        with self._lock:
+            self._entries[key] = page
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskBackend:
+    """En fil per sida i en katalog. Alla processer som pekar på samma katalog delar cache.
+
+    Blir det fler än max_entries filer tas de äldsta bort. Katalogen skapas av PageCache.create_folders().
+    """
+
+    def __init__(self, directory, max_entries=256):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.page')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.PickleError, EOFError, ValueError):
+            return None
+
+    def set(self, key, page):
+        # Skriv till en temporär fil och byt namn, så att ingen läser en halvskriven sida
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(page, f)
+        os.replace(tmp_path, self._path(key))
+        self._trim()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _pages(self):
+        with os.scandir(self.directory) as entries:
+            return [entry for entry in entries if entry.name.endswith('.page')]
+
+    def _trim(self):
+        pages = self._pages()
+        if len(pages) <= self.max_entries:
+            return
+        ages = []
+        for entry in pages:
+            try:
+                ages.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+        ages.sort()
+        for _, path in ages[:len(ages) - self.max_entries]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for entry in self._pages():
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+class PageCache:
+
+    def __init__(self, backend, generation_file, ttl=300, clock=time.time):
+        self.backend = backend
+        self.generation_file = generation_file
+        self.ttl = ttl
+        self._clock = clock
+
+    def create_folders(self):
+        """Skapar katalogen för generation_file, och för sidorna om de ligger på disk."""
+        os.makedirs(os.path.dirname(self.generation_file), exist_ok=True)
+        if isinstance(self.backend, DiskBackend):
+            os.makedirs(self.backend.directory, exist_ok=True)
+
+    def generation(self):
+        """Generationen som gäller just nu. Läses innan sidan renderas och skickas sedan till get och store."""
+        try:
+            with open(self.generation_file) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
+
+    def get(self, key, generation):
+        page = self.backend.get(key)
+        if page is None:
+            return None
+        if page.generation != generation or page.expires_at <= self._clock():
+            self.backend.delete(key)
+            return None
+        return page
+
+    def store(self, key, body, mimetype, generation):
+        page = CachedPage(
+            body=body,
+            mimetype=mimetype,
+            etag=hashlib.sha1(body).hexdigest(),
+            # HTTP-datum har bara hela sekunder
+            last_modified=datetime.now(timezone.utc).replace(microsecond=0),
+            generation=generation,
+            expires_at=self._clock() + self.ttl
+        )
+        self.backend.set(key, page)
+        return page
+
+    def invalidate(self):
+        """Tömmer alla cachade sidor, i alla processer som delar generation_file."""
+        # Ett slumpat värde och inte en räknare, så att två processer som invaliderar samtidigt inte skriver samma
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.generation_file), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(uuid.uuid4().hex)
+        os.replace(tmp_path, self.generation_file)
+        self.backend.clear()
+
+
+def create_backend(kind, directory=None, max_entries=256):
+    if kind == 'disk':
+        return DiskBackend(directory, max_entries)
+    if kind == 'memory':
+        return MemoryBackend(max_entries)
+    raise ValueError(f"Unknown page cache backend: {kind}")
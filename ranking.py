@@ -0,0 +1,250 @@
+"""Rankad feed med engagemangspoäng som uppdateras när någon gillar eller kommenterar.
+
+Varje like, kommentar och själva posten är en händelse med en vikt. En posts poäng är
+summan av vikterna, där varje händelse halveras var `half_life` sekund efter att den
+hände. Gamla posts sjunker alltså av sig själva, och en post som får likes nu stiger.
+
+Poängen räknas aldrig om med tiden. Alla poäng avtar lika fort, så ordningen mellan dem
+ändras bara när en händelse kommer. Därför sparas log(summa av vikt * e^(decay * t)) som
+nyckel, och en ny händelse läggs till med logaddexp. Den aktuella poängen är
+e^(nyckel - decay * nu), men den behövs bara för att visa den.
+
+Per författare finns två parallella listor i sorterad ordning, högst poäng först: en
+array med -nyckel (8 byte per post) och en lista med postId, med högst `per_author` posts. Den rankade feeden för någon är en top-K-merge (heapq.merge)
+av listorna för de konton de följer, så den kostar K steg plus ett per konto, oavsett hur
+många posts det finns totalt.
+
+Poängen finns bara i minnet. De läses in från like_count och comment_count på posts som
+inte är för gamla, som om allt engagemang hände när posten skrevs (likes har ingen tid).
+Varje process har sina egna poäng och läser om dem med jämna mellanrum, se app.py. Då
+behålls den poäng som är högst av den inlästa och den vi redan hade, så att engagemang
+som den här processen har sett inte skrivs över med en sämre gissning.
+
+reload() läser databasen och bygger de nya listorna utan låset, så top() svarar med de
+gamla poängen under tiden. Likes, kommentarer och nya posts som kommer under inläsningen
+läggs in i de gamla poängen som vanligt och postId sparas. När de nya listorna byts in
+tas de postsen över från de gamla poängen, där de är högre.
+"""
+import bisect
+import heapq
+import math
+import threading
+import time
+from array import array
+from datetime import datetime
+from itertools import islice
+
+# Nycklarna räknas i sekunder från den här tidpunkten, så att e^(decay * t) inte blir för stort
+EPOCH = datetime(2024, 1, 1)
+
+
+def logaddexp(a, b):
+    high, low = (a, b) if a >= b else (b, a)
+    return high + math.log1p(math.exp(low - high))
+
+
+class RankingEngine:
+
+    def __init__(self, loader=None, half_life=12 * 3600, post_weight=1.0, like_weight=1.0,
+                 comment_weight=2.0, per_author=200, clock=time.monotonic):
+        # loader() returnerar (postId, userId, created_at, like_count, comment_count) för posts som ska rankas
+        self._loader = loader
+        self.decay = math.log(2) / half_life
+        self.post_weight = post_weight
+        self.like_weight = like_weight
+        self.comment_weight = comment_weight
+        self.per_author = per_author
+        self._clock = clock
+        # postId -> (nyckel, nyckel när posten skrevs, författare)
+        self._posts = {}
+        # författare -> (array med -nyckel, lista med postId), sorterade på (-nyckel, postId)
+        self._by_author = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+        # postId för händelser under en reload(), None när ingen reload pågår
+        self._touched = None
+        self.loaded_at = None
+
+    def _time_key(self, when):
+        return self.decay * (when - EPOCH).total_seconds()
+
+    def base_key(self, created_at, weight=None):
+        """Nyckeln för en post med engagemanget weight, allt vid created_at."""
+        return math.log(weight if weight is not None else self.post_weight) + self._time_key(created_at)
+
+    def _build(self, rows, keep=None):
+        # Nya (posts, by_author) från rows, utan att röra de som används nu
+        posts, by_author = {}, {}
+        for post_id, author_id, created_at, likes, comments in rows:
+            weight = self.post_weight + self.like_weight * likes + self.comment_weight * comments
+            key = self.base_key(created_at, weight)
+            if keep and post_id in keep:
+                key = max(key, keep[post_id][0])
+            self._insert(posts, by_author, post_id, author_id, key, self.base_key(created_at))
+        return posts, by_author
+
+    def load(self, rows, keep=None):
+        """Ersätter alla poäng. rows är samma tupler som loader() returnerar.
+
+        keep är gamla poäng, postId -> [nyckel, ...], som används där de är högre än de inlästa.
+        """
+        posts, by_author = self._build(rows, keep)
+        with self._lock:
+            self._posts, self._by_author = posts, by_author
+            self._loaded = True
+            self.loaded_at = self._clock()
+
+    def reload(self):
+        """Läser in poängen igen med loader(). Posts som inte finns kvar i databasen försvinner."""
+        with self._lock:
+            # Bara uppslag i keep, och poängen byts in med max(), så det gör inget att den ändras under tiden
+            keep = self._posts if self._loaded else None
+            self._touched = set()
+        try:
+            posts, by_author = self._build(self._loader(), keep)
+        except BaseException:
+            with self._lock:
+                self._touched = None
+            raise
+        with self._lock:
+            # Det som hände under inläsningen finns bara i de gamla poängen
+            for post_id in self._touched:
+                current = self._posts.get(post_id)
+                loaded = posts.get(post_id)
+                if current is not None and (loaded is None or loaded[0] < current[0]):
+                    self._insert(posts, by_author, post_id, current[2], current[0], current[1])
+            self._touched = None
+            old = (self._posts, self._by_author)
+            self._posts, self._by_author = posts, by_author
+            self._loaded = True
+            self.loaded_at = self._clock()
+        self._release(*old)
+
+    @staticmethod
+    def _release(*old):
+        # Att frigöra en miljon poster på en gång tar tiotals millisekunder, och under tiden kan
+        # ingen annan tråd köra. Här töms de gamla bit för bit så att requesterna hinner emellan.
+        for entries in old:
+            while entries:
+                for _ in range(min(1000, len(entries))):
+                    entries.popitem()
+                time.sleep(0)
+
+    def reset(self):
+        with self._lock:
+            self._posts = {}
+            self._by_author = {}
+            self._loaded = False
+            self.loaded_at = None
+
+    def stale(self, max_age):
+        return self.loaded_at is not None and self._clock() - self.loaded_at > max_age
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self.load(self._loader() if self._loader else ())
+
+    @staticmethod
+    def _index(keys, ids, negative_key, post_id):
+        # Första platsen där (-nyckel, postId) inte är mindre än det som söks
+        index = bisect.bisect_left(keys, negative_key)
+        while index < len(ids) and keys[index] == negative_key and ids[index] < post_id:
+            index += 1
+        return index
+
+    # Anropas med låset taget
+    def _set(self, post_id, author_id, key, base):
+        if self._touched is not None:
+            self._touched.add(post_id)
+        self._insert(self._posts, self._by_author, post_id, author_id, key, base)
+
+    def _insert(self, posts, by_author, post_id, author_id, key, base):
+        entries = by_author.get(author_id)
+        if entries is None:
+            entries = by_author[author_id] = (array('d'), [])
+        keys, ids = entries
+        current = posts.get(post_id)
+        if current is not None:
+            index = self._index(keys, ids, -current[0], post_id)
+            if index < len(ids) and ids[index] == post_id:
+                del keys[index]
+                del ids[index]
+        index = self._index(keys, ids, -key, post_id)
+        keys.insert(index, -key)
+        ids.insert(index, post_id)
+        posts[post_id] = (key, base, author_id)
+        # Bara de bästa per författare sparas. En post som trillar ut kommer tillbaka om den får en like.
+        while len(ids) > self.per_author:
+            keys.pop()
+            del posts[ids.pop()]
+
+    def add_post(self, post_id, author_id, created_at):
+        """En ny post, med bara postens egen vikt."""
+        key = self.base_key(created_at)
+        with self._lock:
+            # Inte inläst än, då kommer posten med när poängen läses in från databasen.
+            # Pågår inläsningen sparas den ändå, den kanske skrevs efter att databasen lästes.
+            if self._loaded or self._touched is not None:
+                self._set(post_id, author_id, key, key)
+
+    def engage(self, post_id, author_id, created_at, weight, when=None):
+        """En like eller kommentar på posten. weight < 0 tar bort engagemang, t.ex. när en like tas bort."""
+        event = math.log(abs(weight)) + self._time_key(when or datetime.utcnow())
+        with self._lock:
+            if not self._loaded and self._touched is None:
+                return
+            current = self._posts.get(post_id)
+            if current is None:
+                base = self.base_key(created_at)
+                key = base
+            else:
+                key, base, _ = current
+            if weight > 0:
+                key = logaddexp(key, event)
+            elif key > event:
+                # Drar bort händelsens vikt som den är värd nu, men aldrig under postens egen vikt
+                key = max(base, key + math.log1p(-math.exp(event - key)))
+            else:
+                key = base
+            self._set(post_id, author_id, key, base)
+
+    def like(self, post_id, author_id, created_at, liked=True):
+        self.engage(post_id, author_id, created_at, self.like_weight if liked else -self.like_weight)
+
+    def comment(self, post_id, author_id, created_at):
+        self.engage(post_id, author_id, created_at, self.comment_weight)
+
+    def score(self, post_id, now=None):
+        """Postens aktuella poäng, eller None om den inte rankas."""
+        self._ensure_loaded()
+        current = self._posts.get(post_id)
+        if current is None:
+            return None
+        return math.exp(current[0] - self._time_key(now or datetime.utcnow()))
+
+    def top(self, author_ids, limit, after=None):
+        """De limit bästa posts från author_ids som [(nyckel, postId)], högst först.
+
+        after är (nyckel, postId) för den sista posten på föregående sida.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            iterators = []
+            for author_id in set(author_ids):
+                entries = self._by_author.get(author_id)
+                if not entries:
+                    continue
+                keys, ids = entries
+                if not after:
+                    iterators.append(zip(keys, ids))
+                    continue
+                offset = self._index(keys, ids, -after[0], after[1])
+                if offset < len(ids) and keys[offset] == -after[0] and ids[offset] == after[1]:
+                    offset += 1
+                iterators.append(zip(islice(keys, offset, None), islice(ids, offset, None)))
+            return [(-negative_key, post_id) for negative_key, post_id in islice(heapq.merge(*iterators), limit)]
+
+    def __len__(self):
+        return len(self._posts)
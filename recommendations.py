@@ -0,0 +1,337 @@
+"""Förslag på konton att följa ("who to follow") utifrån musiksmak.
+
+Varje användare blir en gles vektor med en dimension per genre, artist och konto som den
+följer. Underlaget är genrerna, artisterna bland favoritlåtarna och Song of the Day,
+artisterna bland Spotify-topplåtarna och follow_graph. Vikterna skalas med IDF, så att en
+artist som nästan alla har betyder mindre än en ovanlig. Vektorerna normaliseras, så att
+skalärprodukten blir cosinuslikheten.
+
+För varje användare sparas de `top_n` mest lika. Hela listan byggs med NumPy och SciPy om de
+finns: vektorerna läggs i en CSR-matris och likheterna räknas `batch_size` rader i taget
+(X[rader] @ X.T). Utan dem används ett inverterat index i ren Python. Det jämför bara
+användare som har minst en dimension gemensamt och ger samma resultat.
+
+Bygget tar tid (sekunder för några tusen användare utan NumPy), så appen kör rebuild() i en
+bakgrundstråd och similar() svarar med en tom lista tills det är klart.
+
+När en profil ändras anropas invalidate(), och apply_pending() räknar sedan bara den
+användarens likhet mot alla om, med det inverterade indexet. Listorna för andra användare
+uppdateras där den nya likheten tar sig in, eller där användaren redan fanns med. IDF-vikterna
+räknas bara om när allt byggs om från början, vilket görs med jämna mellanrum (se app.py).
+Appen kör apply_pending() i en bakgrundstråd, så att profilerna läses från den primära
+databasen och inte i en request som kanske läser från repliken.
+
+Ändringar i andra processer, t.ex. Spotify-synken när den körs för sig (serve.py), märks
+med pull_changes(). Den frågar changes_loader() vilka användare som har ändrats sedan förra
+gången och invaliderar dem.
+"""
+import heapq
+import importlib.util
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Hela bygget görs med NumPy/SciPy om båda finns, annars i ren Python
+NUMPY_AVAILABLE = all(importlib.util.find_spec(name) is not None for name in ('numpy', 'scipy'))
+
+GENRE_WEIGHT = 1.0
+ARTIST_WEIGHT = 1.0
+# Att följa samma konton säger något, men mindre än samma musik
+FOLLOW_WEIGHT = 0.5
+
+
+def _normalize_name(value):
+    return ' '.join(value.lower().split()) if value else ''
+
+
+def taste_features(genres, artists, following):
+    """En användares dimensioner som {namn: vikt}, innan IDF och normalisering.
+
+    artists är alla artister från profilen och Spotify, en artist som förekommer flera gånger väger mer.
+    """
+    features = {}
+
+    def add(name, weight):
+        features[name] = features.get(name, 0.0) + weight
+
+    for genre in genres:
+        if _normalize_name(genre):
+            add('genre:' + _normalize_name(genre), GENRE_WEIGHT)
+    for artist in artists:
+        if _normalize_name(artist):
+            add('artist:' + _normalize_name(artist), ARTIST_WEIGHT)
+    for user_id in following:
+        add('follows:' + user_id, FOLLOW_WEIGHT)
+    return features
+
+
+class Recommender:
+
+    def __init__(self, loader, changes_loader=None, top_n=50, batch_size=256, use_numpy=None,
+                 changes_overlap=60, clock=time.monotonic):
+        # loader(user_ids) returnerar [(userId, {dimension: vikt})] för user_ids, eller alla om None.
+        # Användare som saknas i svaret har tagits bort. changes_loader(since) returnerar
+        # [(userId, ändrad_vid)] för användare som har ändrats efter since (UTC).
+        self._loader = loader
+        self._changes_loader = changes_loader
+        # Den som ändrar sätter tiden innan sin commit, så changes_loader() frågas så här många
+        # sekunder bakåt för att inte missa en transaktion som var långsam
+        self.changes_overlap = changes_overlap
+        self.top_n = top_n
+        self.batch_size = batch_size
+        self.use_numpy = NUMPY_AVAILABLE if use_numpy is None else use_numpy
+        self._clock = clock
+        self._lock = threading.RLock()
+        # Hålls medan allt byggs om eller ändringar läggs in, så att de inte skriver över varandra
+        self._updating = threading.Lock()
+        self._pending = set()
+        self._built = False
+        self.built_at = None
+        # Varifrån pull_changes() letar nästa gång, och vad den hittade förra gången
+        self._changes_since = None
+        self._changes_seen = {}
+        self.checked_at = None
+        self._idf = {}
+        self._unknown_idf = 1.0
+        # userId -> {dimension: vikt}, normaliserad
+        self._vectors = {}
+        # dimension -> {userId: vikt}
+        self._postings = {}
+        # userId -> [(likhet, userId)], mest lik först
+        self._top = {}
+        # userId -> de användare vars lista den finns med i
+        self._listed_in = {}
+        # Listor som har tappat en användare och räknas om nästa gång de behövs
+        self._stale = set()
+
+    # Vikterna efter IDF, med längden 1. Tom om användaren inte har något att jämföra med.
+    def _vector(self, features, idf=None, unknown_idf=None):
+        idf = self._idf if idf is None else idf
+        unknown_idf = self._unknown_idf if unknown_idf is None else unknown_idf
+        vector = {
+            name: weight * idf.get(name, unknown_idf)
+            for name, weight in features.items() if weight > 0
+        }
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {name: weight / norm for name, weight in vector.items()} if norm else {}
+
+    def _best(self, scores):
+        entries = heapq.nsmallest(
+            self.top_n, ((-score, user_id) for user_id, score in scores.items() if score > 1e-12)
+        )
+        return [(-negative, user_id) for negative, user_id in entries]
+
+    def _similarities(self, user_id, vector, postings=None):
+        """Cosinuslikheten mellan vector och alla som har någon dimension gemensamt, som {userId: likhet}."""
+        postings = self._postings if postings is None else postings
+        scores = {}
+        for name, weight in vector.items():
+            for other, other_weight in postings.get(name, {}).items():
+                scores[other] = scores.get(other, 0.0) + weight * other_weight
+        scores.pop(user_id, None)
+        return scores
+
+    def _set_top(self, user_id, entries):
+        for _, other in self._top.get(user_id, ()):
+            self._listed_in.get(other, set()).discard(user_id)
+        if entries:
+            self._top[user_id] = entries
+            for _, other in entries:
+                self._listed_in.setdefault(other, set()).add(user_id)
+        else:
+            self._top.pop(user_id, None)
+
+    def _top_python(self, vectors, postings):
+        return {user_id: self._best(self._similarities(user_id, vector, postings)) for user_id, vector in vectors.items()}
+
+    def _top_numpy(self, vectors):
+        import numpy as np
+        from scipy import sparse
+
+        user_ids = list(vectors)
+        columns = {}
+        indptr, indices, data = [0], [], []
+        for user_id in user_ids:
+            for name, weight in vectors[user_id].items():
+                indices.append(columns.setdefault(name, len(columns)))
+                data.append(weight)
+            indptr.append(len(indices))
+        matrix = sparse.csr_matrix(
+            (np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+            shape=(len(user_ids), len(columns))
+        )
+        transposed = matrix.T.tocsr()
+        order = np.array(user_ids, dtype=object)
+
+        top = {}
+        for start in range(0, len(user_ids), self.batch_size):
+            similarities = (matrix[start:start + self.batch_size] @ transposed).tocsr()
+            for row in range(similarities.shape[0]):
+                begin, end = similarities.indptr[row], similarities.indptr[row + 1]
+                others, scores = similarities.indices[begin:end], similarities.data[begin:end]
+                keep = (others != start + row) & (scores > 1e-12)
+                others, scores = others[keep], scores[keep]
+                if len(scores) > self.top_n:
+                    best = np.argpartition(-scores, self.top_n - 1)[:self.top_n]
+                    others, scores = others[best], scores[best]
+                if len(scores):
+                    top[user_ids[start + row]] = sorted(zip(scores.tolist(), order[others].tolist()),
+                                                        key=lambda entry: (-entry[0], entry[1]))
+        return top
+
+    def rebuild(self):
+        """Bygger om vektorer, IDF och alla listor från loader()."""
+        with self._updating:
+            started = datetime.utcnow()
+            # Det som redan är ändrat kommer med i bygget och ska inte räknas om av pull_changes()
+            seen = self._load_changes(started)
+            rows = list(self._loader(None))
+            document_frequency = {}
+            for _, features in rows:
+                for name in features:
+                    document_frequency[name] = document_frequency.get(name, 0) + 1
+            idf = {
+                name: math.log((1 + len(rows)) / (1 + count)) + 1
+                for name, count in document_frequency.items()
+            }
+            # En dimension som ingen hade vid bygget räknas som om en användare hade den
+            unknown_idf = math.log((1 + len(rows)) / 2) + 1
+            vectors, postings = {}, {}
+            for user_id, features in rows:
+                vector = self._vector(features, idf, unknown_idf)
+                if vector:
+                    vectors[user_id] = vector
+                    for name, weight in vector.items():
+                        postings.setdefault(name, {})[user_id] = weight
+            # Det tunga görs utan låset, så att suggestions() kan svara från de gamla listorna under tiden
+            top = self._top_numpy(vectors) if self.use_numpy else self._top_python(vectors, postings)
+
+            with self._lock:
+                self._idf, self._unknown_idf = idf, unknown_idf
+                self._vectors, self._postings = vectors, postings
+                self._top = {}
+                self._listed_in = {}
+                self._stale = set()
+                for user_id, entries in top.items():
+                    self._set_top(user_id, entries)
+                self._built = True
+                self.built_at = self.checked_at = self._clock()
+                self._changes_since = started
+                self._changes_seen = seen
+
+    @property
+    def built(self):
+        return self._built
+
+    def stale(self, max_age):
+        return self.built_at is not None and self._clock() - self.built_at > max_age
+
+    def unchecked(self, max_age):
+        """Sant om pull_changes() inte har körts på max_age sekunder."""
+        return self.checked_at is not None and self._clock() - self.checked_at > max_age
+
+    @property
+    def pending(self):
+        return bool(self._pending)
+
+    def _load_changes(self, since):
+        if self._changes_loader is None:
+            return {}
+        return dict(self._changes_loader(since - timedelta(seconds=self.changes_overlap)))
+
+    def pull_changes(self):
+        """Invaliderar användare som changes_loader() säger har ändrats sedan förra gången. Returnerar antalet.
+
+        Det som redan hittades förra gången, med samma tid, hoppas över.
+        """
+        if self._changes_loader is None or self._changes_since is None:
+            return 0
+        # Samma lås som rebuild(), som också sätter _changes_since
+        with self._updating:
+            self.checked_at = self._clock()
+            started = datetime.utcnow()
+            found = self._load_changes(self._changes_since)
+            changed = [user_id for user_id, when in found.items() if self._changes_seen.get(user_id) != when]
+            self._changes_since, self._changes_seen = started, found
+        with self._lock:
+            self._pending.update(changed)
+        return len(changed)
+
+    def invalidate(self, user_id):
+        """Användarens profil, Spotify-data eller follows har ändrats. Räknas om av apply_pending()."""
+        with self._lock:
+            self._pending.add(user_id)
+
+    def apply_pending(self):
+        """Räknar om användarna som har invaliderats. Gör inget om någon annan tråd redan håller på."""
+        if not self._pending or not self._updating.acquire(blocking=False):
+            return 0
+        try:
+            with self._lock:
+                user_ids, self._pending = self._pending, set()
+            features = dict(self._loader(list(user_ids)))
+            with self._lock:
+                for user_id in user_ids:
+                    self._update(user_id, features.get(user_id, {}))
+            return len(user_ids)
+        finally:
+            self._updating.release()
+
+    # Anropas med låset taget
+    def _update(self, user_id, features):
+        for name in self._vectors.pop(user_id, {}):
+            self._postings[name].pop(user_id, None)
+        vector = self._vector(features)
+        if vector:
+            self._vectors[user_id] = vector
+            for name, weight in vector.items():
+                self._postings.setdefault(name, {})[user_id] = weight
+        scores = self._similarities(user_id, vector)
+        self._set_top(user_id, self._best(scores))
+        self._stale.discard(user_id)
+
+        # Listor där användaren redan fanns: uppdatera likheten. Platsar den inte längre tas den bort,
+        # och listan räknas om när den behövs, eftersom någon annan då kan ha förtjänat platsen.
+        listed_in = set(self._listed_in.get(user_id, ()))
+        for other in listed_in:
+            entries = [entry for entry in self._top[other] if entry[1] != user_id]
+            score = scores.get(other, 0.0)
+            floor = self._top[other][-1][0] if len(self._top[other]) >= self.top_n else 0.0
+            if score > 1e-12 and score >= floor:
+                entries.append((score, user_id))
+                entries.sort(key=lambda entry: (-entry[0], entry[1]))
+                self._set_top(other, entries)
+            else:
+                self._set_top(other, entries)
+                self._stale.add(other)
+
+        # Listor där användaren nu tar sig in
+        for other, score in scores.items():
+            if other in listed_in:
+                continue
+            entries = self._top.get(other, [])
+            if len(entries) < self.top_n or (-score, user_id) < (-entries[-1][0], entries[-1][1]):
+                entries = sorted(entries + [(score, user_id)], key=lambda entry: (-entry[0], entry[1]))
+                self._set_top(other, entries[:self.top_n])
+
+    def similar(self, user_id):
+        """De mest lika användarna som [(likhet, userId)], mest lik först. Tom tills rebuild() har körts.
+
+        Ändringar som inte har lagts in med apply_pending() än syns inte.
+        """
+        if not self._built:
+            return []
+        with self._lock:
+            if user_id in self._stale:
+                self._stale.discard(user_id)
+                self._set_top(user_id, self._best(self._similarities(user_id, self._vectors.get(user_id, {}))))
+            return list(self._top.get(user_id, ()))
+
+    def suggestions(self, user_id, limit, exclude=()):
+        """Id:n på upp till limit konton att föreslå, utan de i exclude (t.ex. de man redan följer)."""
+        exclude = set(exclude)
+        return [other for _, other in self.similar(user_id) if other not in exclude][:limit]
+
+    def __len__(self):
+        return len(self._vectors)
@@ -0,0 +1,104 @@
+"""Startar appen för produktion med flera processer och/eller trådar.
+
+Anrop mot Spotify görs av bakgrundssynken (se spotify_sync.py) och inte i requesterna,
+utom när en användare kopplar sitt konto (/spotify/callback). Det som avgör hur många
+profilsidor vi klarar är hur många requests som kan köras samtidigt. Servern väljs efter vad som är installerat:
+
+    python serve.py                          # gunicorn om det finns, annars waitress, annars Werkzeug
+    python serve.py --server gunicorn --workers 4 --threads 8
+    python serve.py --server uvicorn --workers 4   # ASGI, kräver uvicorn och asgiref
+
+Med fler än en process körs Spotify-synken i en egen process (flask spotify-sync) och
+stängs av i webbprocesserna, annars skulle varje process synka samma användare.
+"""
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+
+SERVERS = ('gunicorn', 'waitress', 'uvicorn', 'werkzeug')
+
+
+def installed(module):
+    return importlib.util.find_spec(module) is not None
+
+
+def pick_server():
+    for server, module in (('gunicorn', 'gunicorn'), ('waitress', 'waitress')):
+        if installed(module):
+            return server
+    return 'werkzeug'
+
+
+def start_sync_process():
+    env = dict(os.environ, FLASK_APP='app.py')
+    return subprocess.Popen([sys.executable, '-m', 'flask', 'spotify-sync'], env=env)
+
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{args.host}:{args.port}')
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+
+        def load(self):
+            from wsgi import app
+            return app
+
+    Application().run()
+
+
+def run_waitress(args):
+    from waitress import serve
+    from wsgi import app
+    serve(app, host=args.host, port=args.port, threads=args.threads)
+
+
+def run_uvicorn(args):
+    import uvicorn
+    # Trådpoolen i asgiref är den som kör Flask-koden
+    os.environ.setdefault('ASGI_THREADS', str(args.threads))
+    uvicorn.run('asgi:app', host=args.host, port=args.port, workers=args.workers)
+
+
+def run_werkzeug(args):
+    from werkzeug.serving import run_simple
+    from wsgi import app
+    run_simple(args.host, args.port, app, threaded=True, processes=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=('auto',) + SERVERS, default='auto')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=(os.cpu_count() or 1) * 2 + 1, help='Antal processer')
+    parser.add_argument('--threads', type=int, default=8, help='Trådar per process')
+    args = parser.parse_args()
+
+    server = pick_server() if args.server == 'auto' else args.server
+    # waitress och Werkzeug kör bara en process
+    if server in ('waitress', 'werkzeug'):
+        args.workers = 1
+    print(f"Serving with {server}: {args.workers} process(es) x {args.threads} threads on {args.host}:{args.port}")
+
+    sync_process = None
+    if args.workers > 1 and os.getenv('SPOTIFY_SYNC_ENABLED', '1') == '1':
+        sync_process = start_sync_process()
+        os.environ['SPOTIFY_SYNC_ENABLED'] = '0'
+
+    try:
+        {'gunicorn': run_gunicorn, 'waitress': run_waitress, 'uvicorn': run_uvicorn, 'werkzeug': run_werkzeug}[server](args)
+    finally:
+        if sync_process is not None:
+            sync_process.terminate()
+            sync_process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Cache för data som hämtas från Spotify Web API, t.ex. topplåtar och spellistor.
+
+Profilsidan behöver topplåtar och spellistor vid varje visning, men de ändras sällan.
+Cachen håller svaren per Spotify-användare i en begränsad LRU. Ett svar är färskt i
+`ttl` sekunder. Efter det serveras det gamla svaret ändå (stale-while-revalidate) medan
+en bakgrundstråd hämtar ett nytt, fram till `max_stale` sekunder. Är svaret äldre än så,
+eller saknas det, hämtas det direkt i requesten.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SpotifyCache:
+
+    def __init__(self, ttl=300, max_stale=3600, max_users=1000, refresh_workers=2, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_users = max_users
+        self._clock = clock
+        # spotify_user_id -> {kind: (värde, hämtat_vid)}, äldst använda först
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix='spotify-cache')
+
+    def get(self, spotify_user_id, kind, loader):
+        """Returnerar det cachade värdet för (användare, typ) och anropar loader() om det behövs.
+
+        loader får kasta exceptions. Vid en synkron hämtning skickas de vidare till anroparen,
+        vid en bakgrundshämtning behålls det gamla värdet.
+        """
+        if not spotify_user_id:
+            return loader()
+
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(spotify_user_id, {}).get(kind)
+            if entry is not None:
+                self._entries.move_to_end(spotify_user_id)
+                value, fetched_at = entry
+                age = now - fetched_at
+                if age < self.ttl:
+                    return value
+                if age < self.max_stale:
+                    self._schedule_refresh(spotify_user_id, kind, loader)
+                    return value
+
+        value = loader()
+        self._store(spotify_user_id, kind, value)
+        return value
+
+    def invalidate(self, spotify_user_id):
+        """Tar bort allt som är cachat för en Spotify-användare."""
+        if not spotify_user_id:
+            return
+        with self._lock:
+            self._entries.pop(spotify_user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _store(self, spotify_user_id, kind, value):
+        with self._lock:
+            self._entries.setdefault(spotify_user_id, {})[kind] = (value, self._clock())
+            self._entries.move_to_end(spotify_user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    # Anropas med låset taget. Högst en bakgrundshämtning per (användare, typ) åt gången.
+    def _schedule_refresh(self, spotify_user_id, kind, loader):
+        key = (spotify_user_id, kind)
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        self._executor.submit(self._refresh, spotify_user_id, kind, loader)
+
+    def _refresh(self, spotify_user_id, kind, loader):
+        try:
+            value = loader()
+        except Exception as e:
+            print(f"Spotify cache refresh failed for {spotify_user_id}/{kind}: {e}")
+        else:
+            # Användaren kan ha kopplats bort medan vi hämtade, då ska inget nytt sparas
+            with self._lock:
+                invalidated = spotify_user_id not in self._entries
+            if not invalidated:
+                self._store(spotify_user_id, kind, value)
+        finally:
+            with self._lock:
+                self._refreshing.discard((spotify_user_id, kind))
@@ -0,0 +1,120 @@
+"""Delade Spotify-klienter som återanvänder samma HTTP-anslutningar.
+
+Varje spotipy.Spotify och SpotifyOAuth bygger annars en egen requests.Session, vilket
+betyder en ny TCP- och TLS-handskakning för varje anrop. Här delar alla klienter på en
+session med en anslutningspool och keep-alive.
+
+spotipy och requests importeras först när en klient behövs. Tillsammans tar de ungefär
+lika lång tid att importera som Flask, och CLI-kommandon, tester och arbetarprocesser som
+aldrig pratar med Spotify ska inte behöva vänta på dem.
+"""
+import threading
+import time
+
+# Samma som spotipy.oauth2.SpotifyOAuth.OAUTH_TOKEN_URL, här så att appen slipper importera spotipy
+OAUTH_TOKEN_URL = 'https://accounts.spotify.com/api/token'
+
+
+def build_session(pool_size=10, trace=None):
+    """trace(method, url, status, sekunder) anropas efter varje anrop, med status None om inget svar kom."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    # Sessionen lever lika länge som processen. spotipy stänger sessionen i Spotify.__del__
+    # och SpotifyOAuth.__del__, vilket skulle tömma poolen varje gång en klient skräpsamlas.
+    session.close = lambda: None
+    # Bara anslutningsfel försöks igen här. 429 och andra statuskoder skickas vidare till
+    # anroparen, så att bakgrundssynken kan vänta enligt Retry-After.
+    retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.3)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if trace is not None:
+        send = session.request
+
+        def request(method, url, *args, **kwargs):
+            started = time.perf_counter()
+            status = None
+            try:
+                response = send(method, url, *args, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                trace(method, url, status, time.perf_counter() - started)
+
+        session.request = request
+    return session
+
+
+def no_cache_handler():
+    """Tokens sparas per användare i databasen. SpotifyOAuth delas mellan alla användare,
+    så den får inte komma ihåg någons token själv."""
+    from spotipy.cache_handler import CacheHandler
+
+    class NoCacheHandler(CacheHandler):
+
+        def get_cached_token(self):
+            return None
+
+        def save_token_to_cache(self, token_info):
+            pass
+
+    return NoCacheHandler()
+
+
+class SpotifyClientFactory:
+
+    def __init__(self, client_id, client_secret, redirect_uri, scopes, api_url, token_url,
+                 pool_size=10, timeout=5, trace=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self.scopes = scopes
+        self.api_url = api_url
+        self.token_url = token_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.trace = trace
+        self._session = None
+        self._oauth = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """Den delade HTTP-sessionen, som skapas vid första anropet."""
+        with self._lock:
+            if self._session is None:
+                self._session = build_session(self.pool_size, self.trace)
+            return self._session
+
+    def client(self, access_token):
+        """En Spotify-klient för en användares access token, på den delade sessionen."""
+        import spotipy
+
+        sp = spotipy.Spotify(auth=access_token, requests_session=self.session, requests_timeout=self.timeout)
+        sp.prefix = self.api_url
+        return sp
+
+    def oauth(self, show_dialog=False):
+        """Den delade SpotifyOAuth-instansen."""
+        from spotipy.oauth2 import SpotifyOAuth
+
+        session = self.session
+        with self._lock:
+            if show_dialog not in self._oauth:
+                sp_oauth = SpotifyOAuth(
+                    client_id=self.client_id,
+                    client_secret=self.client_secret,
+                    redirect_uri=self.redirect_uri,
+                    scope=' '.join(self.scopes),
+                    show_dialog=show_dialog,
+                    requests_session=session,
+                    requests_timeout=self.timeout,
+                    cache_handler=no_cache_handler(),
+                    open_browser=False
+                )
+                sp_oauth.OAUTH_TOKEN_URL = self.token_url
+                self._oauth[show_dialog] = sp_oauth
+            return self._oauth[show_dialog]
@@ -0,0 +1,168 @@
+"""Bakgrundsjobb som synkar Spotify-data till databasen.
+
+Requests ska aldrig vänta på Spotify. Istället lägger vi jobb ("synka användare X") i en
+kö som en pool av trådar jobbar sig igenom, och en schemaläggare lägger till jobb för
+alla kopplade användare med jämna mellanrum. Svarar Spotify med 429 väntar vi så länge
+som Retry-After säger, andra fel försöks igen med exponentiell backoff.
+
+Modulen vet inget om Flask eller databasen. Appen skickar in två funktioner:
+`sync_fn(user_id)` som gör själva synken och `due_fn()` som returnerar de användare
+som behöver synkas nu.
+"""
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+
+class SyncWorker:
+
+    def __init__(self, sync_fn, due_fn, workers=2, interval=900, max_attempts=5,
+                 base_backoff=2.0, max_backoff=600.0, name='spotify-sync', clock=time.monotonic):
+        self.sync_fn = sync_fn
+        self.name = name
+        self.due_fn = due_fn
+        self.workers = workers
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._clock = clock
+
+        self._queue = queue.Queue()
+        # Jobb som väntar på backoff: (kör_vid, löpnummer, user_id, försök)
+        self._delayed = []
+        self._counter = itertools.count()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+        self._metrics = {
+            'jobs_enqueued': 0,
+            'jobs_succeeded': 0,
+            'jobs_failed': 0,
+            'jobs_retried': 0,
+            'rate_limited': 0,
+            'last_lag_seconds': 0.0,
+            'max_lag_seconds': 0.0,
+        }
+
+    @property
+    def running(self):
+        return bool(self._threads)
+
+    def start(self):
+        with self._start_lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'{self.name}-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._schedule, name=f'{self.name}-scheduler', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._wakeup.set()
+        for _ in range(self.workers):
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def enqueue(self, user_id):
+        """Lägger till ett synkjobb för användaren, om det inte redan finns ett i kön.
+
+        Körs inte workern i den här processen (t.ex. en webbprocess när synken körs i en egen
+        process) görs ingenting, jobbet plockas istället upp av schemaläggaren där.
+        """
+        with self._lock:
+            if not self._threads or user_id in self._pending:
+                return False
+            self._pending.add(user_id)
+            self._metrics['jobs_enqueued'] += 1
+        self._queue.put((user_id, 1, self._clock()))
+        return True
+
+    def metrics(self):
+        """Räknare och kö-lagg, i sekunder."""
+        with self._lock:
+            result = dict(self._metrics)
+            result['queue_depth'] = self._queue.qsize()
+            result['delayed'] = len(self._delayed)
+        return result
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            user_id, attempt, ready_at = job
+            lag = max(0.0, self._clock() - ready_at)
+            with self._lock:
+                self._metrics['last_lag_seconds'] = lag
+                self._metrics['max_lag_seconds'] = max(self._metrics['max_lag_seconds'], lag)
+            try:
+                self.sync_fn(user_id)
+            except Exception as e:
+                self._retry_later(user_id, attempt, e)
+            else:
+                with self._lock:
+                    self._metrics['jobs_succeeded'] += 1
+                    self._pending.discard(user_id)
+
+    def _retry_later(self, user_id, attempt, error):
+        status = getattr(error, 'http_status', None)
+        with self._lock:
+            if status == 429:
+                self._metrics['rate_limited'] += 1
+            if attempt >= self.max_attempts:
+                self._metrics['jobs_failed'] += 1
+                self._pending.discard(user_id)
+                print(f"{self.name} gave up on {user_id}: {error}")
+                return
+            self._metrics['jobs_retried'] += 1
+            delay = self._backoff(attempt, error if status == 429 else None)
+            heapq.heappush(self._delayed, (self._clock() + delay, next(self._counter), user_id, attempt + 1))
+        self._wakeup.set()
+
+    def _backoff(self, attempt, rate_limit_error):
+        # Vid 429 följer vi Retry-After om Spotify skickade den
+        if rate_limit_error is not None:
+            headers = getattr(rate_limit_error, 'headers', None) or {}
+            try:
+                return min(float(headers.get('Retry-After')), self.max_backoff)
+            except (TypeError, ValueError):
+                pass
+        return min(self.base_backoff * 2 ** (attempt - 1), self.max_backoff)
+
+    def _schedule(self):
+        next_scan = self._clock()
+        while not self._stopping.is_set():
+            now = self._clock()
+            if now >= next_scan:
+                try:
+                    for user_id in self.due_fn():
+                        self.enqueue(user_id)
+                except Exception as e:
+                    print(f"{self.name} scheduling failed: {e}")
+                next_scan = now + self.interval
+
+            # Flyttar jobb vars backoff har gått ut till kön
+            with self._lock:
+                while self._delayed and self._delayed[0][0] <= now:
+                    run_at, _, user_id, attempt = heapq.heappop(self._delayed)
+                    self._queue.put((user_id, attempt, run_at))
+                wait = next_scan - now
+                if self._delayed:
+                    wait = min(wait, self._delayed[0][0] - now)
+
+            self._wakeup.wait(max(wait, 0.01))
+            self._wakeup.clear()
@@ -0,0 +1,105 @@
+"""Uppladdningar som skrivs till disk medan requesten läses.
+
+Werkzeug läser en multipart-request bit för bit och skriver varje fils bitar till den
+ström som Request._get_file_stream() returnerar. Här är den strömmen en UploadStream som
+skriver direkt till en temporär fil, hashar innehållet under tiden, och kollar filens
+första bytes ("magic bytes") mot bildformaten vi tar emot. Är det inte en bild slutar vi
+skriva redan efter första biten. När requesten är klar flyttar media_store filen på plats
+med hashen som namn, så den behöver aldrig läsas om.
+
+Minnet per uppladdning är alltså en bit från Werkzeug, oavsett hur stor filen är.
+"""
+import hashlib
+import os
+import tempfile
+
+from flask import Request, current_app
+
+# Formaten vi tar emot och vilken ändelse de sparas med. Ändelsen från klienten används inte.
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+SNIFF_BYTES = 12
+
+
+def sniff_image(head):
+    """Bildformatets ändelse utifrån filens första bytes, eller None."""
+    for signature, extension in SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class UploadStream:
+    """En fil i en multipart-request, skriven till en temporär fil i directory."""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix='.upload')
+        self._file = os.fdopen(fd, 'w+b')
+        self._digest = hashlib.sha256()
+        self._head = b''
+        self.size = 0
+        self.rejected = False
+
+    @property
+    def extension(self):
+        """Bildformatets ändelse, eller None om det inte är en bild vi tar emot."""
+        if self.rejected:
+            return None
+        return sniff_image(self._head)
+
+    @property
+    def content_hash(self):
+        return self._digest.hexdigest()
+
+    def write(self, data):
+        if self.rejected:
+            return len(data)
+        if len(self._head) < SNIFF_BYTES:
+            self._head += data[:SNIFF_BYTES - len(self._head)]
+            if len(self._head) == SNIFF_BYTES and sniff_image(self._head) is None:
+                # Inte en bild. Resten av filen läses av Werkzeug men skrivs inte.
+                self.rejected = True
+                self._file.truncate(0)
+                return len(data)
+        self._digest.update(data)
+        self._file.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        # Anropas när requesten är klar. Har filen inte flyttats in i media_store tas den bort.
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class StreamingRequest(Request):
+    """Request-klass som skriver uppladdade filer till app.config['UPLOAD_TMP_DIR']."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadStream(current_app.config['UPLOAD_TMP_DIR'])
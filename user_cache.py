@@ -0,0 +1,101 @@
+"""Cache för den inloggade användaren, så att en sidvisning inte behöver slå upp den i databasen.
+
+Flask-Login anropar load_user() vid varje request från en inloggad användare. Istället för
+en User-rad från databasen får current_user en UserSnapshot: en liten kopia med bara de
+fält som mallarna visar. current_user.is_following() svarar från follow_graph.
+
+Cachen finns per process, är begränsad i storlek och varje snapshot lever i `ttl` sekunder.
+Routes som ändrar användaren anropar invalidate() efter commit, men andra processer ser
+ändringen först när deras snapshot har gått ut. Routes som ska ändra något i användaren
+hämtar raden själva, en snapshot går inte att spara.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from models import follow_graph, Like
+
+# Fälten som kopieras från User. Det är de som mallarna och routes läser från current_user.
+SNAPSHOT_FIELDS = (
+    'userId', 'username', 'email', 'profilePicture', 'bio',
+    'sotd_title', 'sotd_artist', 'song_picture', 'spotify_user_id',
+)
+
+
+class UserSnapshot:
+    """Det Flask-Login och mallarna behöver av en inloggad användare, utan koppling till sessionen."""
+
+    __slots__ = SNAPSHOT_FIELDS + ('favorite_songs', 'genre_names')
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, user):
+        for field in SNAPSHOT_FIELDS:
+            setattr(self, field, getattr(user, field))
+        # Raderna i user_favorite_songs och user_genres kopieras som vanliga värden
+        self.favorite_songs = tuple(song.as_dict() for song in user.favorite_songs)
+        self.genre_names = tuple(user.genre_names)
+
+    def get_id(self):
+        return self.userId
+
+    # I mallarna jämförs current_user med User-rader, t.ex. "current_user == user"
+    def __eq__(self, other):
+        return getattr(other, 'userId', None) == self.userId
+
+    def __hash__(self):
+        return hash(self.userId)
+
+    def is_following(self, user):
+        return follow_graph.is_following(self.userId, user.userId)
+
+    def has_liked_post(self, post):
+        return Like.query.filter_by(userId=self.userId, postId=post.postId).first() is not None
+
+
+class UserCache:
+
+    def __init__(self, ttl=30, max_users=1000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._clock = clock
+        # userId -> (UserSnapshot, hämtad_vid), äldst använda först
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, loader):
+        """Snapshoten för user_id. loader(user_id) anropas om den saknas eller har gått ut."""
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        snapshot = loader(user_id)
+        # Användare som inte finns cachas inte, Flask-Login loggar då ut sessionen
+        if snapshot is not None:
+            with self._lock:
+                self._entries[user_id] = (snapshot, now)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
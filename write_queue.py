@@ -0,0 +1,107 @@
+"""En kö där en enda tråd gör små skrivningar och committar dem i grupper.
+
+Med SQLite kan bara en anslutning skriva åt gången, och varje commit kostar en
+skrivning till disk. Många samtidiga likes, kommentarer och follows slåss därför om
+låset. Här lägger requesten istället sin skrivning (en funktion) i kön och väntar på
+svaret. Skrivtråden tar allt som ligger i kön, upp till max_batch jobb, kör dem i samma
+transaktion och committar en gång (group commit).
+
+Går något jobb fel rullas hela gruppen tillbaka och jobben körs om ett i taget, så att
+ett trasigt jobb inte tar med sig de andra. Jobben ska därför bara ändra databasen.
+
+Modulen vet inget om Flask. Appen skickar in `execute_batch(jobs)` som kör jobben i en
+transaktion och returnerar en lista med (resultat, exception) per jobb.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class WriteQueue:
+
+    def __init__(self, execute_batch, max_batch=64, max_wait=0.002, name='db-writer'):
+        self.execute_batch = execute_batch
+        self.max_batch = max_batch
+        # Hur länge skrivtråden väntar på fler jobb innan den kör en grupp, i sekunder
+        self.max_wait = max_wait
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._metrics = {'jobs': 0, 'batches': 0, 'failed_batches': 0, 'max_batch_size': 0}
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._work, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+        self._thread = None
+
+    def submit(self, job):
+        """Lägger jobbet i kön och returnerar en Future med jobbets returvärde."""
+        if self._thread is None:
+            self.start()
+        future = Future()
+        self._queue.put((job, future))
+        return future
+
+    def metrics(self):
+        with self._lock:
+            result = dict(self._metrics)
+        result['queue_depth'] = self._queue.qsize()
+        result['avg_batch_size'] = result['jobs'] / result['batches'] if result['batches'] else 0.0
+        return result
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            stopping = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._run(batch)
+            if stopping:
+                return
+
+    def _run(self, batch):
+        try:
+            outcomes = self.execute_batch([job for job, _ in batch])
+        except Exception as e:
+            with self._lock:
+                self._metrics['failed_batches'] += 1
+            outcomes = [(None, e)] * len(batch)
+
+        with self._lock:
+            self._metrics['jobs'] += len(batch)
+            self._metrics['batches'] += 1
+            self._metrics['max_batch_size'] = max(self._metrics['max_batch_size'], len(batch))
+
+        for (_, future), (result, error) in zip(batch, outcomes):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
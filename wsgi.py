@@ -0,0 +1,7 @@
+"""WSGI-ingång för produktion, t.ex. gunicorn 'wsgi:app' eller waitress-serve wsgi:app.
+
+Se serve.py för att starta appen med flera processer och trådar.
+"""
+from app import create_app
+
+app = create_app()